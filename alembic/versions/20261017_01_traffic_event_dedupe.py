@@ -0,0 +1,35 @@
+"""traffic_events dedupe key (node, subscription, engine, period end, counter_seq)
+
+Revision ID: 20261017_01
+Revises: 20250902_02
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '20261017_01'
+down_revision = '20250902_02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    engine_type = postgresql.ENUM('xray', 'wireguard', name='engine_type', create_type=False)
+    op.add_column('traffic_events', sa.Column('subscription_id', postgresql.UUID(as_uuid=True), nullable=True))
+    op.add_column('traffic_events', sa.Column('engine', engine_type, nullable=True))
+    op.add_column('traffic_events', sa.Column('counter_seq', sa.BigInteger(), nullable=True))
+    # event_time doubles as the sample period end; NULL counter_seq rows (legacy HTTP ingest) never conflict
+    op.create_unique_constraint(
+        'uq_traffic_event_dedupe',
+        'traffic_events',
+        ['node_id', 'subscription_id', 'engine', 'event_time', 'counter_seq'],
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_traffic_event_dedupe', 'traffic_events', type_='unique')
+    op.drop_column('traffic_events', 'counter_seq')
+    op.drop_column('traffic_events', 'engine')
+    op.drop_column('traffic_events', 'subscription_id')
@@ -0,0 +1,28 @@
+"""rollup watermarks for incremental traffic rollups
+
+Revision ID: 20261017_02
+Revises: 20261017_01
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261017_02'
+down_revision = '20261017_01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'rollup_watermarks',
+        sa.Column('name', sa.String(length=60), nullable=False),
+        sa.Column('last_id', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('name', name='pk_rollup_watermarks'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('rollup_watermarks')
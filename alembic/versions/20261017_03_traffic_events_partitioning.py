@@ -0,0 +1,122 @@
+"""partition traffic_events by day (RANGE on event_time)
+
+Revision ID: 20261017_03
+Revises: 20261017_02
+Create Date: 2026-10-17
+
+Rebuilds traffic_events as a partitioned parent (PK and dedupe key include the
+partition column event_time), copies existing rows into daily partitions and
+keeps the id sequence so rollup watermarks stay valid. A DEFAULT partition
+catches stragglers outside the managed window; the scheduler creates
+partitions ahead (moving matching DEFAULT rows into them), detaches/drops
+expired ones and prunes expired rows from the DEFAULT partition.
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '20261017_03'
+down_revision = '20261017_02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION ensure_traffic_events_partitions(start_date date, end_date date)
+        RETURNS void LANGUAGE plpgsql AS $$
+        DECLARE
+            d date;
+            part_name text;
+        BEGIN
+            IF end_date <= start_date THEN
+                RAISE EXCEPTION 'end_date must be greater than start_date';
+            END IF;
+            d := start_date;
+            WHILE d < end_date LOOP
+                part_name := format('traffic_events_%s', to_char(d, 'YYYYMMDD'));
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF traffic_events FOR VALUES FROM (%L) TO (%L);',
+                    part_name,
+                    d::timestamp AT TIME ZONE 'UTC',
+                    (d + 1)::timestamp AT TIME ZONE 'UTC'
+                );
+                d := d + 1;
+            END LOOP;
+        END;
+        $$;
+        """
+    )
+
+    op.execute("ALTER TABLE traffic_events RENAME TO traffic_events_unpartitioned;")
+    op.execute("ALTER TABLE traffic_events_unpartitioned RENAME CONSTRAINT uq_traffic_event_dedupe TO uq_traffic_event_dedupe_old;")
+    op.execute("ALTER INDEX IF EXISTS pk_traffic_events RENAME TO pk_traffic_events_old;")
+    op.execute("DROP INDEX IF EXISTS ix_traffic_events_user_time, ix_traffic_events_node_time, ix_traffic_events_event_time, ix_traffic_events_created_at, ix_traffic_events_user_id, ix_traffic_events_node_id;")
+    op.execute(
+        """
+        CREATE TABLE traffic_events (
+            id BIGINT NOT NULL DEFAULT nextval('traffic_events_id_seq'),
+            event_time TIMESTAMPTZ NOT NULL,
+            user_id UUID REFERENCES users(id) ON DELETE SET NULL,
+            node_id UUID REFERENCES nodes(id) ON DELETE SET NULL,
+            subscription_id UUID,
+            engine engine_type,
+            counter_seq BIGINT,
+            bytes_up BIGINT NOT NULL DEFAULT 0,
+            bytes_down BIGINT NOT NULL DEFAULT 0,
+            source traffic_source NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL,
+            CONSTRAINT pk_traffic_events PRIMARY KEY (id, event_time),
+            CONSTRAINT uq_traffic_event_dedupe UNIQUE (node_id, subscription_id, engine, event_time, counter_seq)
+        ) PARTITION BY RANGE (event_time);
+        """
+    )
+    op.execute("ALTER SEQUENCE traffic_events_id_seq OWNED BY traffic_events.id;")
+    op.execute("CREATE INDEX ix_traffic_events_event_time ON traffic_events (event_time);")
+    op.execute("CREATE INDEX ix_traffic_events_created_at ON traffic_events (created_at);")
+    op.execute("CREATE INDEX ix_traffic_events_user_time ON traffic_events (user_id, event_time);")
+    op.execute("CREATE INDEX ix_traffic_events_node_time ON traffic_events (node_id, event_time);")
+    op.execute("CREATE TABLE traffic_events_default PARTITION OF traffic_events DEFAULT;")
+
+    # Partitions for existing data plus the managed window (yesterday .. +7 days)
+    op.execute(
+        """
+        SELECT ensure_traffic_events_partitions(
+            LEAST(COALESCE((SELECT min(event_time AT TIME ZONE 'UTC')::date FROM traffic_events_unpartitioned), CURRENT_DATE), CURRENT_DATE - 1),
+            GREATEST(COALESCE((SELECT max(event_time AT TIME ZONE 'UTC')::date FROM traffic_events_unpartitioned), CURRENT_DATE), CURRENT_DATE + 7) + 1
+        );
+        """
+    )
+    op.execute("INSERT INTO traffic_events SELECT id, event_time, user_id, node_id, subscription_id, engine, counter_seq, bytes_up, bytes_down, source, created_at FROM traffic_events_unpartitioned;")
+    op.execute("DROP TABLE traffic_events_unpartitioned;")
+
+    op.execute(
+        """
+        CREATE OR REPLACE VIEW traffic_events_partitions AS
+        SELECT inhrelid::regclass AS partition_table,
+               pg_catalog.pg_get_expr(pg_class.relpartbound, pg_class.oid) AS bounds
+        FROM pg_inherits
+        JOIN pg_class ON pg_class.oid = inhrelid
+        JOIN pg_class parent ON parent.oid = inhparent
+        WHERE parent.relname = 'traffic_events';
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP VIEW IF EXISTS traffic_events_partitions;")
+    op.execute("ALTER TABLE traffic_events RENAME TO traffic_events_partitioned;")
+    op.execute("ALTER TABLE traffic_events_partitioned RENAME CONSTRAINT uq_traffic_event_dedupe TO uq_traffic_event_dedupe_part;")
+    op.execute("ALTER INDEX pk_traffic_events RENAME TO pk_traffic_events_part;")
+    op.execute("DROP INDEX IF EXISTS ix_traffic_events_event_time, ix_traffic_events_created_at, ix_traffic_events_user_time, ix_traffic_events_node_time;")
+    op.execute("CREATE TABLE traffic_events (LIKE traffic_events_partitioned INCLUDING DEFAULTS);")
+    op.execute("ALTER TABLE traffic_events ADD CONSTRAINT pk_traffic_events PRIMARY KEY (id);")
+    op.execute("ALTER TABLE traffic_events ADD CONSTRAINT uq_traffic_event_dedupe UNIQUE (node_id, subscription_id, engine, event_time, counter_seq);")
+    op.execute("INSERT INTO traffic_events SELECT * FROM traffic_events_partitioned;")
+    op.execute("ALTER SEQUENCE traffic_events_id_seq OWNED BY traffic_events.id;")
+    op.execute("DROP TABLE traffic_events_partitioned CASCADE;")
+    op.execute("CREATE INDEX ix_traffic_events_event_time ON traffic_events (event_time);")
+    op.execute("CREATE INDEX ix_traffic_events_created_at ON traffic_events (created_at);")
+    op.execute("CREATE INDEX ix_traffic_events_user_time ON traffic_events (user_id, event_time);")
+    op.execute("CREATE INDEX ix_traffic_events_node_time ON traffic_events (node_id, event_time);")
+    op.execute("DROP FUNCTION IF EXISTS ensure_traffic_events_partitions(date, date);")
@@ -0,0 +1,40 @@
+"""daily and monthly traffic rollup tiers
+
+Revision ID: 20261017_04
+Revises: 20261017_03
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '20261017_04'
+down_revision = '20261017_03'
+branch_labels = None
+depends_on = None
+
+
+def _rollup_table(name: str, period: str) -> None:
+    op.create_table(
+        name,
+        sa.Column(period, sa.Date(), nullable=False),
+        sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('tenant_id', postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column('bytes_up', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('bytes_down', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint(period, 'user_id', name=f'pk_{name}'),
+    )
+    op.create_index(f'ix_{name}_tenant_id', name, ['tenant_id'])
+    op.create_index(f'ix_{name}_user_{period}', name, ['user_id', period])
+
+
+def upgrade() -> None:
+    _rollup_table('traffic_rollups_daily', 'day')
+    _rollup_table('traffic_rollups_monthly', 'month')
+
+
+def downgrade() -> None:
+    op.drop_table('traffic_rollups_monthly')
+    op.drop_table('traffic_rollups_daily')
@@ -0,0 +1,33 @@
+"""hourly traffic sketches (active users, top users)
+
+Revision ID: 20261017_05
+Revises: 20261017_04
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '20261017_05'
+down_revision = '20261017_04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'traffic_sketches_hourly',
+        sa.Column('scope', sa.String(length=16), nullable=False),
+        sa.Column('scope_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('hour_start', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('active_users', sa.LargeBinary(), nullable=False),
+        sa.Column('top_users', sa.JSON(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('scope', 'scope_id', 'hour_start', name='pk_traffic_sketches_hourly'),
+    )
+    op.create_index('ix_traffic_sketches_hourly_hour_start', 'traffic_sketches_hourly', ['hour_start'])
+
+
+def downgrade() -> None:
+    op.drop_table('traffic_sketches_hourly')
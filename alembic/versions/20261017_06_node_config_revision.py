@@ -0,0 +1,22 @@
+"""per-node config revision for FullNodeConfigPush
+
+Revision ID: 20261017_06
+Revises: 20261017_05
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261017_06'
+down_revision = '20261017_05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('nodes', sa.Column('config_revision', sa.BigInteger(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('nodes', 'config_revision')
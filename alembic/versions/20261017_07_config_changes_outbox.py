@@ -0,0 +1,33 @@
+"""node config change outbox
+
+Revision ID: 20261017_07
+Revises: 20261017_06
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '20261017_07'
+down_revision = '20261017_06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'config_changes',
+        sa.Column('id', sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column('node_id', postgresql.UUID(as_uuid=True), sa.ForeignKey('nodes.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('revision', sa.BigInteger(), nullable=False),
+        sa.Column('user_ids', sa.JSON(), nullable=False, server_default='[]'),
+        sa.Column('inbounds', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.UniqueConstraint('node_id', 'revision', name='uq_config_change_node_revision'),
+    )
+    op.create_index('ix_config_changes_created_at', 'config_changes', ['created_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('config_changes')
@@ -0,0 +1,22 @@
+"""subscriptions named by each node config change
+
+Revision ID: 20261017_08
+Revises: 20261017_07
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261017_08'
+down_revision = '20261017_07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('config_changes', sa.Column('subscription_ids', sa.JSON(), nullable=False, server_default='[]'))
+
+
+def downgrade() -> None:
+    op.drop_column('config_changes', 'subscription_ids')
@@ -0,0 +1,59 @@
+"""node_id in the traffic rollup keys, NO_ID bucket for events without a user or node
+
+Revision ID: 20261017_09
+Revises: 20261017_08
+Create Date: 2026-10-17
+
+Hourly, daily and monthly rollups are keyed by (period, user, node) so per-node
+totals outlive raw event retention. Primary key columns cannot be NULL, so
+traffic without a user or node is stored under the max UUID (NO_ID). Existing
+rows were aggregated across nodes and keep NO_ID as their node.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '20261017_09'
+down_revision = '20261017_08'
+branch_labels = None
+depends_on = None
+
+NO_ID = 'ffffffff-ffff-ffff-ffff-ffffffffffff'  # models.NO_ID
+TIERS = [('traffic_rollups_hourly', 'hour_start', 'day'), ('traffic_rollups_daily', 'day'), ('traffic_rollups_monthly', 'month')]
+
+
+def upgrade() -> None:
+    op.execute(f"UPDATE traffic_rollups_hourly SET node_id = '{NO_ID}' WHERE node_id IS NULL;")
+    op.alter_column('traffic_rollups_hourly', 'node_id', nullable=False)
+    for name in ('traffic_rollups_daily', 'traffic_rollups_monthly'):
+        op.add_column(name, sa.Column('node_id', postgresql.UUID(as_uuid=True), nullable=False, server_default=NO_ID))
+        op.alter_column(name, 'node_id', server_default=None)
+    for name, *period in TIERS:
+        op.drop_constraint(f'pk_{name}', name, type_='primary')
+        op.create_primary_key(f'pk_{name}', name, [period[0], 'user_id', 'node_id', *period[1:]])
+    op.create_index('ix_traffic_rollups_daily_node_day', 'traffic_rollups_daily', ['node_id', 'day'])
+    op.create_index('ix_traffic_rollups_monthly_node_month', 'traffic_rollups_monthly', ['node_id', 'month'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_traffic_rollups_monthly_node_month', table_name='traffic_rollups_monthly')
+    op.drop_index('ix_traffic_rollups_daily_node_day', table_name='traffic_rollups_daily')
+    for name, *period in TIERS:
+        keys = ', '.join([period[0], 'user_id', *period[1:]])
+        op.drop_constraint(f'pk_{name}', name, type_='primary')
+        op.alter_column(name, 'node_id', nullable=True)
+        # Fold the per-node rows back into one row per (period, user); user-less traffic was never rolled up
+        op.execute(f"""
+            CREATE TEMP TABLE rollup_merge AS
+            SELECT {keys}, (array_agg(tenant_id) FILTER (WHERE tenant_id IS NOT NULL))[1] AS tenant_id,
+                   sum(bytes_up) AS bytes_up, sum(bytes_down) AS bytes_down, min(created_at) AS created_at
+            FROM {name} WHERE user_id <> '{NO_ID}' GROUP BY {keys};
+            DELETE FROM {name};
+            INSERT INTO {name} ({keys}, tenant_id, bytes_up, bytes_down, created_at)
+            SELECT {keys}, tenant_id, bytes_up, bytes_down, created_at FROM rollup_merge;
+            DROP TABLE rollup_merge;
+        """)
+        op.create_primary_key(f'pk_{name}', name, [period[0], 'user_id', *period[1:]])
+    op.drop_column('traffic_rollups_monthly', 'node_id')
+    op.drop_column('traffic_rollups_daily', 'node_id')
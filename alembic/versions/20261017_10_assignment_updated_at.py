@@ -0,0 +1,25 @@
+"""assignments.updated_at, part of the client config render version
+
+Revision ID: 20261017_10
+Revises: 20261017_09
+Create Date: 2026-10-17
+
+A moved assignment keeps its count and created_at; updated_at lets the render
+cache version key (apps/control_api/render_cache.py) see the move.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261017_10'
+down_revision = '20261017_09'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('assignments', sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()))
+
+
+def downgrade() -> None:
+    op.drop_column('assignments', 'updated_at')
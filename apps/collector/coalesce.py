@@ -0,0 +1,99 @@
+"""Optional pre-aggregation window in front of ``traffic_events``.
+
+Samples are merged per (subscription, node, engine, window bucket) and held in
+memory until the bucket closes (bucket end + grace). One row per bucket is then
+written, keeping only the detail readers still need: bucket end as
+``event_time``, summed bytes, and the highest ``counter_seq`` folded in.
+
+Per-row dedupe keys no longer identify individual samples once they are merged,
+so redeliveries are dropped here against a per (node, subscription, engine)
+``counter_seq`` high-water mark instead. Agents send samples for a key in seq
+order (spool replay before live samples), which keeps the mark exact. The mark
+only advances in memory; ``seed`` loads it from the rows already written (each
+row carries its bucket's highest seq), so a restarted collector does not count
+a replay twice.
+
+Each sample carries an opaque ack ticket that stays with its bucket until the
+bucket is flushed. A redelivery of a sample whose bucket is still open joins
+that bucket's tickets, so it is not acked before the original is durable.
+"""
+import time
+from typing import Any, Hashable, Mapping
+
+ADDED = "added"  # folded into an open bucket, which holds its ticket
+HELD = "held"  # redelivery of a sample still in an open bucket; the ticket waits for it
+DUPLICATE = "duplicate"  # redelivery of a sample already flushed; ack it now
+
+
+class Coalescer:
+    def __init__(self, window_seconds: int, grace_seconds: float = 5.0):
+        if window_seconds <= 0:
+            raise ValueError("window_seconds must be positive")
+        self.window_seconds = window_seconds
+        self.grace_seconds = grace_seconds
+        self._buckets: dict[tuple, dict] = {}
+        self._tickets: dict[tuple, list] = {}
+        self._high_water: dict[tuple, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def bucket_end(self, period_end_unix: int) -> int:
+        w = self.window_seconds
+        return -(-period_end_unix // w) * w  # ceil to the window boundary
+
+    def seed(self, high_water: Mapping[tuple, int]) -> None:
+        """Raise the marks of ``(node_id, subscription_id, engine)`` keys to the given persisted seqs."""
+        for key, seq in high_water.items():
+            if seq > self._high_water.get(key, -1):
+                self._high_water[key] = seq
+
+    def add(self, sample: dict[str, Any], ticket: Hashable | None = None) -> str:
+        """Fold ``sample`` into its bucket; returns ``ADDED``, ``HELD`` or ``DUPLICATE``."""
+        stream_key = (sample.get("node_id"), sample.get("subscription_id"), sample.get("engine"))
+        seq = sample.get("counter_seq")
+        end = self.bucket_end(int(sample.get("period_end_unix") or time.time()))
+        key = stream_key + (end,)
+        if seq is not None:
+            if seq <= self._high_water.get(stream_key, -1):
+                if key not in self._buckets:
+                    return DUPLICATE
+                if ticket is not None:
+                    self._tickets[key].append(ticket)
+                return HELD
+            self._high_water[stream_key] = seq
+        agg = self._buckets.get(key)
+        if agg is None:
+            agg = self._buckets[key] = {
+                "node_id": sample.get("node_id"),
+                "subscription_id": sample.get("subscription_id"),
+                "user_id": sample.get("user_id"),
+                "engine": sample.get("engine"),
+                "period_end_unix": end,
+                "counter_seq": seq,
+                "bytes_up": 0,
+                "bytes_down": 0,
+            }
+            self._tickets[key] = []
+        agg["bytes_up"] += int(sample.get("bytes_up") or 0)
+        agg["bytes_down"] += int(sample.get("bytes_down") or 0)
+        if seq is not None and (agg["counter_seq"] is None or seq > agg["counter_seq"]):
+            agg["counter_seq"] = seq
+        if ticket is not None:
+            self._tickets[key].append(ticket)
+        return ADDED
+
+    def next_close(self) -> float | None:
+        """Unix time at which the oldest open bucket becomes flushable."""
+        if not self._buckets:
+            return None
+        return min(k[-1] for k in self._buckets) + self.grace_seconds
+
+    def pop_closed(self, now: float | None = None) -> list[tuple[dict, list]]:
+        """Closed buckets as ``(row, tickets)``."""
+        now = time.time() if now is None else now
+        closed = [k for k in self._buckets if k[-1] + self.grace_seconds <= now]
+        return [(self._buckets.pop(k), self._tickets.pop(k)) for k in closed]
+
+    def pop_all(self) -> list[tuple[dict, list]]:
+        return self.pop_closed(now=float("inf"))
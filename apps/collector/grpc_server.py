@@ -0,0 +1,98 @@
+"""TrafficIngest.StreamTraffic server (grpc.aio).
+
+Each node keeps one long-lived bidirectional stream: samples flow in, and one
+``TrafficIngestAck`` flows back per write-behind flush that contained samples
+from that stream. Node identity comes from the mTLS peer certificate (SAN =
+node_id) once at stream start instead of per-request HTTP auth.
+
+With a ``PhasePlanner`` the acks also carry the sampling phase the node should
+use, so the fleet's pushes spread evenly over the sampling interval.
+"""
+import asyncio
+from typing import Any, AsyncIterator, Callable
+
+import grpc
+
+from packages.common.vpnpanel_common.grpc_tls import peer_node_id, server_credentials
+from packages.common.vpnpanel_common.logging import get_logger
+
+from .ingest import TrafficWriter, sample_to_dict
+from .phases import PhasePlanner
+
+log = get_logger("collector.grpc")
+
+
+class _StreamAcks:
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue[int] = asyncio.Queue()
+        self.pending = 0
+
+    def ack(self, persisted: int) -> None:
+        self.pending -= persisted
+        self.queue.put_nowait(persisted)
+
+
+class TrafficIngestServicer:
+    def __init__(self, writer: TrafficWriter, ack_factory: Callable[..., Any], phases: PhasePlanner | None = None):
+        self.writer = writer
+        self.ack_factory = ack_factory
+        self.phases = phases
+
+    async def StreamTraffic(self, request_iterator: AsyncIterator[Any], context: Any) -> AsyncIterator[Any]:
+        acks = _StreamAcks()
+        identity = peer_node_id(context)
+        phase: dict = {}  # node_id -> preferred phase in ms, once the first sample names the node
+
+        async def pump() -> None:
+            async for sample in request_iterator:
+                if identity and sample.node_id != identity:
+                    await context.abort(grpc.StatusCode.PERMISSION_DENIED, "node_id does not match client certificate")
+                if self.phases is not None and not phase and sample.node_id:
+                    phase[sample.node_id] = round(self.phases.assign(sample.node_id) * 1000)
+                try:
+                    row = sample_to_dict(sample)
+                except ValueError as e:
+                    await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+                acks.pending += 1
+                await self.writer.put(row, acks)
+
+        reader = asyncio.create_task(pump())
+        try:
+            while not (reader.done() and acks.pending <= 0):
+                if reader.done():
+                    if not reader.cancelled() and reader.exception() is not None:
+                        break
+                    persisted = await acks.queue.get()
+                else:
+                    getter = asyncio.ensure_future(acks.queue.get())
+                    await asyncio.wait({getter, reader}, return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        continue
+                    persisted = getter.result()
+                extra = {"preferred_phase_ms": next(iter(phase.values()))} if phase else {}
+                yield self.ack_factory(accepted=True, message="persisted", persisted=persisted, **extra)
+            await reader  # surface abort / stream errors
+        finally:
+            if not reader.done():
+                reader.cancel()
+            for node_id in phase:
+                self.phases.release(node_id)
+
+
+async def serve(settings, writer: TrafficWriter) -> grpc.aio.Server:  # pragma: no cover - needs generated stubs
+    from packages.common.vpnpanel_common.proto import node_control_pb2, node_control_pb2_grpc
+
+    server = grpc.aio.server(options=[("grpc.keepalive_time_ms", 30_000), ("grpc.http2.max_pings_without_data", 0)])
+    phases = PhasePlanner(settings.sample_interval_seconds) if settings.ingest_phase_spreading else None
+    node_control_pb2_grpc.add_TrafficIngestServicer_to_server(
+        TrafficIngestServicer(writer, node_control_pb2.TrafficIngestAck, phases), server
+    )
+    creds = server_credentials(settings)
+    if creds is not None:
+        server.add_secure_port(settings.collector_grpc_address, creds)
+    else:
+        server.add_insecure_port(settings.collector_grpc_address)
+    await server.start()
+    log.info("collector_grpc_started", address=settings.collector_grpc_address, tls=creds is not None)
+    return server
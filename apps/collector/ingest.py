@@ -0,0 +1,336 @@
+"""Write-behind batching between the TrafficIngest streams and PostgreSQL.
+
+Streams enqueue samples into one bounded queue; a single writer task drains it
+and flushes a batch whenever ``max_batch`` rows are buffered or
+``flush_interval`` seconds have passed since the first buffered row. A full
+queue blocks the producing stream, which propagates backpressure to the node
+through gRPC flow control instead of dropping samples.
+
+After a batch commits, every stream that contributed to it is acked with its
+sample count. Acks are released in the order the stream sent the samples: an
+ack of ``n`` means the next ``n`` samples the stream sent are durable (or, for
+a row the database can never take, dead-lettered to the log). Each flush also
+adds the bytes it inserted to the subscriptions' ``consumed_bytes`` and
+deactivates any it pushed over quota, in the same transaction, or, with
+``UsageCounters`` configured, increments the Redis hot counters that are
+folded into the database periodically (quota is still checked before the
+commit, against the stored value plus the pending delta).
+
+With a ``Coalescer`` configured, samples are held until their window closes,
+so they become durable out of send order; a stream's acks then wait for its
+earliest open bucket. A redelivered sample is acked only once the row it was
+folded into is written. The coalescer's ``counter_seq`` high-water marks are
+seeded from ``traffic_events`` the first time a node shows up (looking back
+``high_water_lookback`` seconds), so a replay after a collector restart is
+not counted twice.
+"""
+import asyncio
+import time
+import uuid
+import weakref
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Hashable, Iterable, Mapping, Protocol
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from packages.common.vpnpanel_common.db.ingest import RecentKeyFilter, build_event_rows, bulk_insert_traffic_events
+from packages.common.vpnpanel_common.db.models import EngineType, Subscription, TrafficEvent, TrafficSource
+from packages.common.vpnpanel_common.db.quota import charge_usage, per_subscription
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import (
+    traffic_ingest_bytes_total,
+    traffic_ingest_duplicates_total,
+    traffic_ingest_lag_seconds,
+    traffic_ingest_queue_depth,
+    traffic_ingest_rejected_total,
+)
+from packages.common.vpnpanel_common.usage import UsageCounters, report_enforcements
+
+from .coalesce import ADDED, DUPLICATE, Coalescer
+from .sketches import SketchAggregator
+
+log = get_logger("collector.ingest")
+
+ENGINES = frozenset(e.value for e in EngineType)
+# Failures a retry cannot fix: a row that does not convert or that the database rejects
+PERMANENT_ERRORS = (ValueError, TypeError, IntegrityError, DataError)
+
+
+class AckSink(Protocol):
+    def ack(self, persisted: int) -> None: ...
+
+
+class _AckOrder:
+    """Acks one stream's samples in send order while they become durable out of order."""
+
+    def __init__(self, sink: AckSink):
+        self._sink = weakref.ref(sink)  # the registry is keyed weakly by the sink
+        self.issued = 0
+        self.acked = 0
+        self._done: set[int] = set()
+
+    def ticket(self) -> tuple:
+        ticket = (self, self.issued)
+        self.issued += 1
+        return ticket
+
+    def complete(self, positions: Iterable[int]) -> None:
+        self._done.update(positions)
+        start = self.acked
+        while self.acked in self._done:
+            self._done.remove(self.acked)
+            self.acked += 1
+        sink = self._sink()
+        if self.acked > start and sink is not None:
+            sink.ack(self.acked - start)
+
+
+def _complete(tickets: Iterable[tuple]) -> None:
+    by_order: dict[_AckOrder, list[int]] = {}
+    for order, pos in tickets:
+        by_order.setdefault(order, []).append(pos)
+    for order, positions in by_order.items():
+        order.complete(positions)
+
+
+class TrafficWriter:
+    def __init__(
+        self,
+        session_factory: async_sessionmaker,
+        *,
+        max_batch: int = 5000,
+        flush_interval: float = 1.0,
+        max_queue: int = 100_000,
+        recent_keys: RecentKeyFilter | None = None,
+        coalescer: Coalescer | None = None,
+        sketches: SketchAggregator | None = None,
+        counters: UsageCounters | None = None,
+        retry_max_seconds: float = 30.0,
+        high_water_lookback: float = 7 * 86400,
+    ):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.recent_keys = recent_keys or RecentKeyFilter()
+        self.coalescer = coalescer
+        self.sketches = sketches
+        self.counters = counters
+        self.retry_max_seconds = retry_max_seconds
+        self.high_water_lookback = high_water_lookback
+        self.queue: asyncio.Queue[tuple[dict, Hashable | None]] = asyncio.Queue(maxsize=max_queue)
+        self._orders: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()  # sink -> _AckOrder
+        self._seeded_nodes: set = set()
+        self._user_by_subscription: dict[uuid.UUID, uuid.UUID | None] = {}
+        self._tenant_by_subscription: dict[uuid.UUID, uuid.UUID | None] = {}
+        self._task: asyncio.Task | None = None
+
+    async def put(self, sample: dict, sink: AckSink | None = None) -> None:
+        ticket = None
+        if sink is not None:
+            order = self._orders.get(sink)
+            if order is None:
+                order = self._orders[sink] = _AckOrder(sink)
+            ticket = order.ticket()
+        await self.queue.put((sample, ticket))
+        traffic_ingest_queue_depth.set(self.queue.qsize())
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """Cancel the writer loop and flush whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while not self.queue.empty():
+            await self._process(self._drain(self.max_batch))
+        if self.coalescer is not None:
+            await self.flush(self.coalescer.pop_all())
+
+    async def run(self) -> None:
+        while True:
+            timeout = None
+            if self.coalescer is not None and (close_at := self.coalescer.next_close()) is not None:
+                timeout = max(0.0, close_at - time.time())
+            await self._process(await self.next_batch(timeout))
+
+    async def _process(self, batch: list[tuple[dict, Hashable | None]]) -> None:
+        if self.coalescer is None:
+            if batch:
+                await self.flush_with_retry([(sample, [ticket] if ticket is not None else []) for sample, ticket in batch])
+            return
+        await self._seed_high_water({sample.get("node_id") for sample, _ in batch})
+        redelivered, durable = 0, []
+        for sample, ticket in batch:
+            outcome = self.coalescer.add(sample, ticket)
+            if outcome != ADDED:
+                redelivered += 1
+                if ticket is not None and outcome == DUPLICATE:
+                    durable.append(ticket)  # the row it was folded into is already written
+        traffic_ingest_duplicates_total.labels(stage="memory").inc(redelivered)
+        _complete(durable)
+        ready = self.coalescer.pop_closed()
+        if ready:
+            await self.flush_with_retry(ready)
+
+    async def _seed_high_water(self, node_ids: set) -> None:
+        """Load the persisted ``counter_seq`` marks of nodes the coalescer has not seen yet."""
+        node_ids = {n for n in node_ids if n is not None} - self._seeded_nodes
+        if not node_ids:
+            return
+        t = TrafficEvent
+        stmt = (
+            select(t.node_id, t.subscription_id, t.engine, func.max(t.counter_seq))
+            .where(t.node_id.in_(node_ids), t.counter_seq.is_not(None),
+                   t.event_time >= datetime.now(timezone.utc) - timedelta(seconds=self.high_water_lookback))
+            .group_by(t.node_id, t.subscription_id, t.engine)
+        )
+        delay = 0.5
+        while True:
+            try:
+                async with self.session_factory() as session:
+                    rows = (await session.execute(stmt)).all()
+                break
+            except Exception:  # noqa: BLE001 - counting a replay twice is worse than waiting
+                log.exception("traffic_high_water_load_failed", nodes=len(node_ids), retry_in=delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+        self.coalescer.seed({(n, s, e.value if e is not None else None): seq for n, s, e, seq in rows})
+        self._seeded_nodes |= node_ids
+
+    def _drain(self, limit: int) -> list[tuple[dict, Hashable | None]]:
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return items
+
+    async def next_batch(self, timeout: float | None = None) -> list[tuple[dict, Hashable | None]]:
+        loop = asyncio.get_running_loop()
+        try:
+            batch = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.max_batch:
+            batch.extend(self._drain(self.max_batch - len(batch)))
+            remaining = deadline - loop.time()
+            if len(batch) >= self.max_batch or remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        traffic_ingest_queue_depth.set(self.queue.qsize())
+        return batch
+
+    async def flush_with_retry(self, batch: list[tuple[dict, list]]) -> None:
+        """Flush ``batch``, retrying transient failures until it commits.
+
+        Errors that retrying cannot fix (a row that does not convert, or one the
+        database rejects) split the batch in halves until the offending rows are
+        isolated; those are dead-lettered to the log and acked so their streams
+        keep moving, and the rest of the batch is written normally.
+        """
+        delay = 0.5
+        while True:
+            try:
+                await self.flush(batch)
+                return
+            except PERMANENT_ERRORS as e:
+                if len(batch) == 1:
+                    self._dead_letter(batch[0], e)
+                    return
+                mid = len(batch) // 2
+                await self.flush_with_retry(batch[:mid])
+                await self.flush_with_retry(batch[mid:])
+                return
+            except Exception:  # noqa: BLE001 - keep the batch (unacked) and retry
+                log.exception("traffic_flush_failed", rows=len(batch), retry_in=delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+
+    def _dead_letter(self, item: tuple[dict, list], error: Exception) -> None:
+        sample, tickets = item
+        log.error("traffic_sample_rejected", error=repr(error), **{k: str(v) for k, v in sample.items()})
+        traffic_ingest_rejected_total.inc(max(1, len(tickets)))
+        _complete(tickets)  # dropped for good; holding the ack would stall the stream
+
+    async def _resolve_users(self, session, rows: list[dict]) -> None:
+        missing = {r["subscription_id"] for r in rows if r["subscription_id"] and r["subscription_id"] not in self._user_by_subscription}
+        if missing:
+            res = await session.execute(
+                select(Subscription.id, Subscription.user_id, Subscription.tenant_id).where(Subscription.id.in_(missing))
+            )
+            found = {sub_id: (user_id, tenant_id) for sub_id, user_id, tenant_id in res.all()}
+            for sub_id in missing:
+                self._user_by_subscription[sub_id], self._tenant_by_subscription[sub_id] = found.get(sub_id, (None, None))
+        for r in rows:
+            if r["user_id"] is None and r["subscription_id"]:
+                r["user_id"] = self._user_by_subscription.get(r["subscription_id"])
+
+    async def flush(self, batch: list[tuple[dict, list]]) -> int:
+        """Persist ``(sample, ack tickets)`` items and ack their streams."""
+        if not batch:
+            return 0
+        rows = build_event_rows((sample for sample, _ in batch), source=TrafficSource.node_push)
+        fresh, dropped = self.recent_keys.filter(rows)
+        usage: Counter = Counter()
+        landed: list = []
+        async with self.session_factory() as session:
+            await self._resolve_users(session, fresh)
+            inserted = await bulk_insert_traffic_events(session, fresh, usage=usage, landed=landed)
+            now = datetime.now(timezone.utc)
+            if self.counters is None:
+                enforced = await charge_usage(session, per_subscription(usage), now)
+                await session.commit()
+            else:
+                enforced = await self.counters.charge_and_commit(session, usage, now)
+        # Only once rows and usage are committed together, or a retry would skip uncharged rows
+        self.recent_keys.remember(fresh)
+        report_enforcements(enforced)
+        self._record_metrics(fresh, dropped, inserted)
+        if self.sketches is not None:
+            self.sketches.observe(landed, self._tenant_by_subscription)
+        _complete(ticket for _, tickets in batch for ticket in tickets)
+        return inserted
+
+    def _record_metrics(self, rows: list[Mapping[str, Any]], dropped: int, inserted: int) -> None:
+        traffic_ingest_duplicates_total.labels(stage="memory").inc(dropped)
+        traffic_ingest_duplicates_total.labels(stage="db").inc(len(rows) - inserted)
+        for r in rows:
+            engine = r["engine"].value if r["engine"] else "unknown"
+            traffic_ingest_bytes_total.labels(engine=engine, dir="up").inc(r["bytes_up"])
+            traffic_ingest_bytes_total.labels(engine=engine, dir="down").inc(r["bytes_down"])
+        if rows:
+            oldest = min(r["event_time"] for r in rows)
+            traffic_ingest_lag_seconds.set(max(0.0, datetime.now(timezone.utc).timestamp() - oldest.timestamp()))
+
+
+def sample_to_dict(sample: Any) -> dict:
+    """Convert a ``TrafficSample`` message into the row-builder input shape.
+
+    Raises ``ValueError`` for ids that are not UUIDs and unknown engines.
+    """
+    if sample.engine and sample.engine not in ENGINES:
+        raise ValueError(f"unknown engine {sample.engine!r}")
+    return {
+        "node_id": uuid.UUID(sample.node_id) if sample.node_id else None,
+        "subscription_id": uuid.UUID(sample.subscription_id) if sample.subscription_id else None,
+        "engine": sample.engine or None,
+        "counter_seq": sample.counter_seq,
+        "period_end_unix": sample.period_end_unix or int(time.time()),
+        "bytes_up": sample.bytes_up,
+        "bytes_down": sample.bytes_down,
+    }
@@ -1,8 +1,14 @@
 from packages.common.vpnpanel_common.config import get_settings
 from packages.common.vpnpanel_common.logging import configure_logging, get_logger
 from packages.common.vpnpanel_common.metrics import metrics_app, service_info
+from packages.common.vpnpanel_common.db.ingest import RecentKeyFilter
+from packages.common.vpnpanel_common.db.session import get_sessionmaker
+from packages.common.vpnpanel_common.usage import UsageCounters
 from fastapi import FastAPI
-import asyncio
+
+from .coalesce import Coalescer
+from .ingest import TrafficWriter
+from .sketches import SketchAggregator
 
 settings = get_settings()
 configure_logging(service_name="collector", level=settings.log_level)
@@ -12,17 +18,53 @@ app = FastAPI(title="Collector", version="0.1.0")
 app.mount("/metrics", metrics_app)
 service_info.labels(service="collector", version="0.1.0").set(1)
 
+state = {}
+
 @app.get("/health")
 async def health():
     return {"status": "ok", "service": "collector"}
 
-# Placeholder gRPC server bootstrap (future) run in background
 async def start_grpc_server():  # pragma: no cover
-    while True:
-        await asyncio.sleep(60)
+    from .grpc_server import serve
+
+    sketches = SketchAggregator(
+        get_sessionmaker(),
+        flush_interval=settings.sketch_flush_interval_seconds,
+        top_capacity=settings.sketch_top_capacity,
+    )
+    counters = UsageCounters(get_sessionmaker()) if settings.usage_counters_enabled else None
+    writer = TrafficWriter(
+        get_sessionmaker(),
+        max_batch=settings.ingest_batch_max_rows,
+        flush_interval=settings.ingest_flush_interval_seconds,
+        max_queue=settings.ingest_queue_max,
+        recent_keys=RecentKeyFilter(ttl_seconds=settings.ingest_dedupe_ttl_seconds, max_keys=settings.ingest_dedupe_max_keys),
+        coalescer=Coalescer(settings.ingest_coalesce_window_seconds, settings.ingest_coalesce_grace_seconds) if settings.ingest_coalesce_window_seconds > 0 else None,
+        sketches=sketches,
+        counters=counters,
+    )
+    writer.start()
+    sketches.start()
+    state["writer"] = writer
+    state["sketches"] = sketches
+    if counters is not None:
+        counters.start(settings.usage_flush_interval_seconds)
+        state["counters"] = counters
+    state["grpc"] = await serve(settings, writer)
 
 @app.on_event("startup")
 async def startup():
     log.info("collector_startup")
-    asyncio.create_task(start_grpc_server())
+    await start_grpc_server()
 
+@app.on_event("shutdown")
+async def shutdown():  # pragma: no cover
+    if "grpc" in state:
+        await state["grpc"].stop(grace=5)
+    if "writer" in state:
+        await state["writer"].stop()
+    if "sketches" in state:
+        await state["sketches"].stop()
+    if "counters" in state:
+        await state["counters"].stop()
+    log.info("collector_shutdown")
@@ -0,0 +1,43 @@
+"""Spreads connected nodes' sampling phases evenly over the interval.
+
+The sampling interval is split into buckets (one per second, at most 600).
+When a node opens a traffic stream it is placed in the least loaded bucket,
+choosing the one nearest its own hashed phase among equals, so a fleet of a
+similar size keeps its phases across collector restarts. The bucket's center
+is advertised as ``TrafficIngestAck.preferred_phase_ms``. A node holds its
+bucket while it has a stream open.
+"""
+from packages.common.vpnpanel_common.sampling import node_phase
+
+
+class PhasePlanner:
+    def __init__(self, interval: float, buckets: int | None = None):
+        self.interval = interval
+        self.buckets = buckets or max(1, min(int(interval), 600))
+        self.load = [0] * self.buckets
+        self._nodes: dict[str, list[int]] = {}  # node_id -> [bucket, open streams]
+
+    def _phase(self, bucket: int) -> float:
+        return (bucket + 0.5) * self.interval / self.buckets
+
+    def assign(self, node_id: str) -> float:
+        """Preferred phase (seconds into the interval) for a node opening a stream."""
+        held = self._nodes.get(node_id)
+        if held is not None:
+            held[1] += 1
+            return self._phase(held[0])
+        home = int(node_phase(node_id, self.interval) / self.interval * self.buckets)
+        least = min(self.load)
+        bucket = min((b for b, n in enumerate(self.load) if n == least), key=lambda b: (b - home) % self.buckets)
+        self.load[bucket] += 1
+        self._nodes[node_id] = [bucket, 1]
+        return self._phase(bucket)
+
+    def release(self, node_id: str) -> None:
+        held = self._nodes.get(node_id)
+        if held is None:
+            return
+        held[1] -= 1
+        if held[1] <= 0:
+            self.load[held[0]] -= 1
+            del self._nodes[node_id]
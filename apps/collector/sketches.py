@@ -0,0 +1,90 @@
+"""In-memory per-hour sketches fed from flushed traffic rows.
+
+For every (node, hour) and (tenant, hour) touched by a flush, the aggregator
+adds the user to a HyperLogLog (distinct active users) and the user's bytes to
+a space-saving summary (top users by bandwidth). Deltas are merged into
+``traffic_sketches_hourly`` every ``flush_interval`` seconds and then reset, so
+memory stays proportional to the nodes/tenants active since the last persist.
+"""
+import asyncio
+import uuid
+from typing import Any, Mapping
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from packages.common.vpnpanel_common.db.sketches import HLL_PRECISION, SketchKey, merge_sketches, observe_rows
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.sketches import HyperLogLog, SpaceSaving
+
+log = get_logger("collector.sketches")
+
+
+class SketchAggregator:
+    def __init__(
+        self, session_factory: async_sessionmaker, *, flush_interval: float = 60.0, hll_precision: int = HLL_PRECISION,
+        top_capacity: int = 64,
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.hll_precision = hll_precision
+        self.top_capacity = top_capacity
+        self._deltas: dict[SketchKey, tuple[HyperLogLog, SpaceSaving]] = {}
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def _sketch(self, key: SketchKey) -> tuple[HyperLogLog, SpaceSaving]:
+        pair = self._deltas.get(key)
+        if pair is None:
+            pair = self._deltas[key] = (HyperLogLog(self.hll_precision), SpaceSaving(self.top_capacity))
+        return pair
+
+    def observe(self, rows: list[Mapping[str, Any]], tenant_by_subscription: Mapping[uuid.UUID, uuid.UUID | None]) -> None:
+        observe_rows(
+            self._deltas, rows, lambda r: tenant_by_subscription.get(r.get("subscription_id")),
+            top_capacity=self.top_capacity, hll_precision=self.hll_precision,
+        )
+
+    async def persist(self) -> int:
+        deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return 0
+        try:
+            async with self.session_factory() as session:
+                await merge_sketches(session, deltas)
+                await session.commit()
+        except Exception:
+            # Put the deltas back so the next persist retries them
+            for key, (hll, top) in deltas.items():
+                cur_hll, cur_top = self._sketch(key)
+                cur_hll.merge(hll)
+                cur_top.merge(top)
+            raise
+        return len(deltas)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                n = await self.persist()
+                if n:
+                    log.info("traffic_sketches_persisted", sketches=n)
+            except Exception:  # noqa: BLE001 - keep aggregating; retried next interval
+                log.exception("traffic_sketches_persist_failed")
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """Cancel the persist loop and persist whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.persist()
@@ -0,0 +1,321 @@
+"""Cached, versioned ``FullNodeConfigPush`` snapshots per node.
+
+A node's config is its Xray inbounds plus one ``SubscriptionEngineConfig`` per
+(subscription, engine) of every user assigned to it. Rebuilding that for every
+node on every change is O(nodes x users), so each node's snapshot is built once
+and then patched: a change names the users (or the node's inbounds) it affects,
+and only those users' entries are re-read from ``Assignment``, ``Subscription``,
+``Credential`` and ``UserEngines`` and diffed against the cached ones.
+
+Changes arrive from the ``config_changes`` outbox (see ``config_outbox``), which
+already carries the node revision each one produced. Applied changes are kept
+in a short per-node history, so a node at revision ``r`` can be sent just the
+entries that changed since ``r`` (``NodeConfigDelta``). When ``r`` predates the
+in-memory history (e.g. right after a control plane restart) the delta is
+derived from the retained outbox rows instead: every subscription they name is
+sent as its current entry, or as removed. Only a node older than the retained
+outbox gets ``full_resync``. Snapshots are built from scratch, at the node's
+current revision, when first asked for.
+"""
+import asyncio
+import json
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from packages.common.vpnpanel_common.db.models import (
+    Assignment,
+    ConfigChange,
+    Credential,
+    EngineType,
+    Node,
+    Plan,
+    Subscription,
+    User,
+    UserEngines,
+    XRayInbound,
+)
+from packages.common.vpnpanel_common.db.quota import effective_quota
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+log = get_logger("control_api.config_builder")
+
+EntryKey = tuple[str, str]  # (subscription_id, engine)
+
+
+@dataclass
+class NodeSnapshot:
+    node_id: uuid.UUID
+    revision: int
+    inbounds: list = field(default_factory=list)  # [pb.XrayInboundConfig]
+    entries: dict = field(default_factory=dict)  # EntryKey -> pb.SubscriptionEngineConfig
+    by_user: dict = field(default_factory=dict)  # user_id -> set[EntryKey]
+
+    def to_push(self):
+        return pb.FullNodeConfigPush(
+            node_id=str(self.node_id), revision=self.revision,
+            xray_inbounds=self.inbounds, subscriptions=[self.entries[k] for k in sorted(self.entries)],
+        )
+
+
+@dataclass
+class _Change:
+    base: int  # snapshot revision the change was applied on
+    revision: int
+    entries: dict  # EntryKey -> pb.SubscriptionEngineConfig | None (removed)
+    inbounds: bool
+    actions: dict = field(default_factory=dict)  # EntryKey -> suspend / resume / revoke
+
+
+def _action(old, new) -> str | None:
+    """Enforcement action for an entry going from ``old`` to ``new`` (None = absent)."""
+    if old is None:
+        return None  # new entries arrive with their status in the config
+    if new is None:
+        return "revoke"
+    if old.status != new.status:
+        return "resume" if new.status == "active" else "suspend"
+    return None
+
+
+def _status(active: bool, consumed: int, quota: int | None) -> str:
+    if active:
+        return "active"
+    return "exhausted" if quota is not None and consumed >= quota else "suspended"
+
+
+def _engine_entry(sub, engine: EngineType, secret: dict, email: str, quota: int | None):
+    entry = pb.SubscriptionEngineConfig(
+        subscription_id=str(sub.id), engine=engine.value, username=str(sub.id), display_name=email,
+        quota_bytes=quota or 0, status=_status(sub.active, sub.consumed_bytes, quota),
+    )
+    if engine is EngineType.xray:
+        entry.secret = str(secret.get("uuid", ""))
+    else:
+        entry.public_key = str(secret.get("public_key", ""))
+        if secret.get("address"):
+            entry.meta["address"] = str(secret["address"])
+    return entry
+
+
+def _inbound(row):
+    settings = dict(row.settings or {})
+    stream = settings.pop("streamSettings", None)
+    return pb.XrayInboundConfig(
+        inbound_id=str(row.id), tag=row.tag, port=row.port, protocol=row.protocol.value,
+        settings_json=json.dumps(settings, sort_keys=True),
+        stream_settings_json=json.dumps(stream, sort_keys=True) if stream is not None else "",
+    )
+
+
+async def _read_entries(session: AsyncSession, node_id: uuid.UUID, user_ids=None) -> dict:
+    """Current entries on ``node_id`` (for ``user_ids`` only, if given) as ``{user_id: {key: entry}}``."""
+    stmt = (
+        select(Assignment.user_id, Subscription, User.email, UserEngines.allow_xray, UserEngines.allow_wireguard,
+               effective_quota().label("quota"))
+        .join(Subscription, Subscription.user_id == Assignment.user_id)
+        .join(User, User.id == Assignment.user_id)
+        .outerjoin(UserEngines, UserEngines.user_id == Assignment.user_id)
+        .outerjoin(Plan, Plan.id == Subscription.plan_id)
+        .where(Assignment.node_id == node_id)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(Assignment.user_id.in_(list(user_ids)))
+    rows = (await session.execute(stmt)).all()
+    users = {r.user_id for r in rows}
+    secrets: dict = {}
+    if users:
+        creds = await session.execute(
+            select(Credential.user_id, Credential.engine, Credential.secret).where(Credential.user_id.in_(users))
+        )
+        for user_id, engine, secret in creds.all():
+            secrets[user_id, engine] = secret or {}
+    out: dict = {user_id: {} for user_id in (user_ids if user_ids is not None else users)}
+    for r in rows:
+        allowed = {EngineType.xray: r.allow_xray is not False, EngineType.wireguard: r.allow_wireguard is not False}
+        for engine, ok in allowed.items():
+            if ok and (r.user_id, engine) in secrets:
+                entry = _engine_entry(r.Subscription, engine, secrets[r.user_id, engine], r.email, r.quota)
+                out.setdefault(r.user_id, {})[str(r.Subscription.id), engine.value] = entry
+    return out
+
+
+async def _read_inbounds(session: AsyncSession, node_id: uuid.UUID) -> list:
+    rows = (await session.execute(select(XRayInbound).where(XRayInbound.node_id == node_id).order_by(XRayInbound.tag))).scalars()
+    return [_inbound(r) for r in rows]
+
+
+class ConfigBuilder:
+    def __init__(self, session_factory: async_sessionmaker, *, history: int = 256):
+        self.session_factory = session_factory
+        self.history = history
+        self._snapshots: dict[uuid.UUID, NodeSnapshot] = {}
+        self._changes: dict[uuid.UUID, deque] = {}
+        self._locks: dict[uuid.UUID, asyncio.Lock] = {}
+
+    def _lock(self, node_id: uuid.UUID) -> asyncio.Lock:
+        return self._locks.setdefault(node_id, asyncio.Lock())
+
+    async def snapshot(self, node_id: uuid.UUID) -> NodeSnapshot | None:
+        """The cached snapshot of ``node_id``, built on first use; None if the node does not exist."""
+        async with self._lock(node_id):
+            snap = self._snapshots.get(node_id)
+            if snap is None:
+                snap = await self._build(node_id)
+                if snap is None:
+                    return None
+                self._snapshots[node_id] = snap
+                self._changes[node_id] = deque(maxlen=self.history)
+            return snap
+
+    async def _build(self, node_id: uuid.UUID) -> NodeSnapshot | None:
+        # The entries are read over several statements, so a write may commit
+        # between them; every such write bumps the revision, so read it before
+        # and after and retry until they agree, or the snapshot could label
+        # newer state with an older revision.
+        async with self.session_factory() as session:
+            revision = (await session.execute(select(Node.config_revision).where(Node.id == node_id))).scalar()
+            while revision is not None:
+                snap = NodeSnapshot(node_id, revision, await _read_inbounds(session, node_id))
+                for user_id, entries in (await _read_entries(session, node_id)).items():
+                    snap.entries.update(entries)
+                    snap.by_user[user_id] = set(entries)
+                await session.rollback()  # end the read transaction so the re-check sees new commits
+                after = (await session.execute(select(Node.config_revision).where(Node.id == node_id))).scalar()
+                if after == revision:
+                    return snap
+                revision = after
+        return None
+
+    async def full(self, node_id: uuid.UUID):
+        snap = await self.snapshot(node_id)
+        return snap.to_push() if snap is not None else None
+
+    async def delta(self, node_id: uuid.UUID, since: int):
+        """Entries changed after revision ``since``; ``full_resync`` if neither history nor outbox reaches back."""
+        snap = await self.snapshot(node_id)
+        if snap is None:
+            return None
+        changes = self._changes[node_id]
+        if since >= snap.revision or (changes and changes[0].base <= since):
+            out = pb.NodeConfigDelta(node_id=str(node_id), from_revision=since, revision=snap.revision)
+            if since > snap.revision:
+                out.full_resync = True
+                return out
+            merged: dict = {}
+            for change in changes:
+                if change.revision > since:
+                    merged.update(change.entries)
+                    out.inbounds_changed |= change.inbounds
+            self._fill(out, snap, {key: entry is not None for key, entry in merged.items()})
+            return out
+        async with self._lock(node_id):  # the snapshot must not move while the log is read
+            return await self._delta_from_log(snap, since)
+
+    async def _delta_from_log(self, snap: NodeSnapshot, since: int):
+        out = pb.NodeConfigDelta(node_id=str(snap.node_id), from_revision=since, revision=snap.revision)
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                select(ConfigChange.subscription_ids, ConfigChange.inbounds)
+                .where(ConfigChange.node_id == snap.node_id, ConfigChange.revision > since,
+                       ConfigChange.revision <= snap.revision)
+            )).all()
+        if len(rows) != snap.revision - since:  # pruned: the gap cannot be reconstructed
+            out.full_resync = True
+            return out
+        keys = {(sub_id, engine.value) for row in rows for sub_id in row.subscription_ids for engine in EngineType}
+        out.inbounds_changed = any(row.inbounds for row in rows)
+        self._fill(out, snap, {key: key in snap.entries for key in keys})
+        return out
+
+    @staticmethod
+    def _fill(out, snap: NodeSnapshot, keys: dict) -> None:
+        """Add ``keys`` (key -> present) to ``out`` as current entries or removals."""
+        for key in sorted(keys):
+            if keys[key]:
+                out.upserts.append(snap.entries[key])
+            else:
+                out.removed.add(subscription_id=key[0], engine=key[1])
+        if out.inbounds_changed:
+            out.xray_inbounds.extend(snap.inbounds)
+
+    def actions(self, node_id: uuid.UUID, since: int) -> dict:
+        """Latest enforcement action per entry after revision ``since`` as ``{key: (action, revision)}``.
+
+        Only covers the in-memory history; older transitions are already
+        reflected in the statuses a resync sends.
+        """
+        out: dict = {}
+        for change in self._changes.get(node_id, ()):
+            if change.revision > since:
+                for key, action in change.actions.items():
+                    out[key] = (action, change.revision)
+        return out
+
+    def cached(self) -> dict[uuid.UUID, int]:
+        """Revision of every cached snapshot."""
+        return {node_id: snap.revision for node_id, snap in self._snapshots.items()}
+
+    def forget(self, node_id: uuid.UUID) -> None:
+        self._snapshots.pop(node_id, None)
+        self._changes.pop(node_id, None)
+
+    async def apply(self, node_id: uuid.UUID, *, base: int, revision: int, user_ids: Iterable[uuid.UUID] = (),
+                    inbounds: bool = False) -> bool:
+        """Move the cached snapshot from revision ``base`` to ``revision``; False if there was nothing to move.
+
+        ``user_ids`` and ``inbounds`` are the union of the outbox changes in
+        between. A snapshot that is not at ``base`` is dropped and rebuilt on
+        next use.
+        """
+        async with self._lock(node_id):
+            snap = self._snapshots.get(node_id)
+            if snap is None or snap.revision >= revision:
+                return False
+            if snap.revision != base:
+                self.forget(node_id)
+                return False
+            user_ids = set(user_ids)
+            async with self.session_factory() as session:
+                new_inbounds = await _read_inbounds(session, node_id) if inbounds else snap.inbounds
+                fresh = await _read_entries(session, node_id, user_ids) if user_ids else {}
+            changed: dict = {}
+            actions: dict = {}
+            for user_id, entries in fresh.items():
+                for key in snap.by_user.get(user_id, set()) - entries.keys():
+                    changed[key] = None
+                for key, entry in entries.items():
+                    if snap.entries.get(key) != entry:
+                        changed[key] = entry
+                if entries:
+                    snap.by_user[user_id] = set(entries)
+                else:
+                    snap.by_user.pop(user_id, None)
+            for key, entry in changed.items():
+                action = _action(snap.entries.get(key), entry)
+                if action is not None:
+                    actions[key] = action
+                if entry is None:
+                    snap.entries.pop(key, None)
+                else:
+                    snap.entries[key] = entry
+            inbounds_changed = inbounds and new_inbounds != snap.inbounds
+            snap.inbounds = new_inbounds
+            snap.revision = revision
+            # recorded even when empty so the history stays contiguous
+            self._changes[node_id].append(_Change(base, revision, changed, inbounds_changed, actions))
+            log.info("node_config_changed", node_id=str(node_id), revision=revision, entries=len(changed), inbounds=inbounds_changed)
+            return True
+
+
+@lru_cache
+def get_config_builder() -> ConfigBuilder:
+    from .db import AsyncSessionLocal
+
+    return ConfigBuilder(AsyncSessionLocal)
@@ -0,0 +1,169 @@
+"""Tails the ``config_changes`` outbox into the ``ConfigBuilder`` snapshots.
+
+Each poll compares the revision of every cached snapshot with
+``Node.config_revision`` and reads only the outbox rows of nodes that moved
+(``revision > cached``), so the cost is one lookup over the cached nodes plus
+O(changes), never a rescan of assignments or subscriptions. Because the revision
+bump and its outbox row commit together, the rows of a node are always
+contiguous; when the first one is missing (pruned) the snapshot is dropped and
+rebuilt on next use.
+
+Polling runs every ``CONFIG_OUTBOX_POLL_SECONDS``; on PostgreSQL the consumer
+also ``LISTEN``s on the channel writers ``NOTIFY`` and polls right away. After
+a node's snapshot moves, its ``NodeConfigDelta`` is handed to every listener
+registered with ``add_listener`` (the node push path).
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+from sqlalchemy import and_, delete, or_, select
+
+from packages.common.vpnpanel_common.db.models import ConfigChange, Node
+from packages.common.vpnpanel_common.db.outbox import CONFIG_CHANGES_CHANNEL
+from packages.common.vpnpanel_common.logging import get_logger
+
+from .config_builder import ConfigBuilder, get_config_builder
+
+log = get_logger("control_api.config_outbox")
+
+DeltaListener = Callable[[uuid.UUID, object], Awaitable[None]]  # (node_id, pb.NodeConfigDelta)
+
+
+class ConfigChangeConsumer:
+    def __init__(self, builder: ConfigBuilder, *, retention_seconds: int = 86400):
+        self.builder = builder
+        self.session_factory = builder.session_factory
+        self.retention_seconds = retention_seconds
+        self._listeners: list[DeltaListener] = []
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._tasks: list[asyncio.Task] = []
+
+    def add_listener(self, callback: DeltaListener) -> None:
+        self._listeners.append(callback)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    async def poll(self) -> dict[uuid.UUID, int]:
+        """Apply pending outbox rows to the cached snapshots; returns the new revision per node moved."""
+        async with self._lock:
+            cached = self.builder.cached()
+            if not cached:
+                return {}
+            async with self.session_factory() as session:
+                current = dict((await session.execute(
+                    select(Node.id, Node.config_revision).where(Node.id.in_(list(cached)))
+                )).all())
+                stale = {node_id: rev for node_id, rev in cached.items() if current.get(node_id, rev) > rev}
+                rows = []
+                if stale:
+                    rows = (await session.execute(
+                        select(ConfigChange.node_id, ConfigChange.revision, ConfigChange.user_ids, ConfigChange.inbounds)
+                        .where(or_(*(and_(ConfigChange.node_id == node_id, ConfigChange.revision > rev)
+                                     for node_id, rev in stale.items())))
+                        .order_by(ConfigChange.node_id, ConfigChange.revision)
+                    )).all()
+            for node_id in cached.keys() - current.keys():  # node deleted
+                self.builder.forget(node_id)
+            by_node: dict = {}
+            for row in rows:
+                by_node.setdefault(row.node_id, []).append(row)
+            moved = {}
+            for node_id, base in stale.items():
+                changes = by_node.get(node_id, [])
+                if not changes or changes[0].revision != base + 1:
+                    log.warning("config_outbox_gap", node_id=str(node_id), cached=base)
+                    self.builder.forget(node_id)
+                    continue
+                revision = changes[-1].revision
+                user_ids = {uuid.UUID(u) for c in changes for u in c.user_ids}
+                inbounds = any(c.inbounds for c in changes)
+                if await self.builder.apply(node_id, base=base, revision=revision, user_ids=user_ids, inbounds=inbounds):
+                    moved[node_id] = revision
+        for node_id in moved:
+            await self._publish(node_id, cached[node_id])
+        return moved
+
+    async def _publish(self, node_id: uuid.UUID, since: int) -> None:
+        if not self._listeners:
+            return
+        delta = await self.builder.delta(node_id, since)
+        if delta is None:
+            return
+        for callback in self._listeners:
+            try:
+                await callback(node_id, delta)
+            except Exception:  # noqa: BLE001 - one failing push must not stall the others
+                log.exception("config_delta_listener_failed", node_id=str(node_id))
+
+    async def prune(self, now: datetime | None = None) -> int:
+        """Delete outbox rows older than the retention; returns how many."""
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(seconds=self.retention_seconds)
+        async with self.session_factory() as session:
+            res = await session.execute(delete(ConfigChange).where(ConfigChange.created_at < cutoff))
+            await session.commit()
+        return res.rowcount or 0
+
+    async def run(self, interval: float) -> None:
+        pruned_at = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.poll()
+                if time.monotonic() - pruned_at >= 3600:
+                    pruned_at = time.monotonic()
+                    await self.prune()
+            except Exception:  # noqa: BLE001 - the rows stay in the outbox for the next poll
+                log.exception("config_outbox_poll_failed")
+
+    async def listen(self) -> None:
+        """Wake on ``NOTIFY`` (PostgreSQL only; elsewhere polling alone drives the consumer)."""
+        engine = self.session_factory.kw["bind"]
+        if engine.dialect.name != "postgresql":
+            return
+        delay = 1.0
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw = (await conn.get_raw_connection()).driver_connection
+                    await raw.add_listener(CONFIG_CHANGES_CHANNEL, lambda *_: self.wake())
+                    delay = 1.0
+                    self.wake()  # catch up on anything committed while not listening
+                    while not raw.is_closed():
+                        await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001 - keep polling; retry the listener with backoff
+                log.warning("config_outbox_listen_failed", error=str(e), retry_in=delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+
+    def start(self, interval: float) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self.run(interval)), asyncio.create_task(self.listen())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+
+@lru_cache
+def get_config_consumer() -> ConfigChangeConsumer:
+    from packages.common.vpnpanel_common.config import get_settings
+
+    return ConfigChangeConsumer(get_config_builder(), retention_seconds=get_settings().config_outbox_retention_seconds)
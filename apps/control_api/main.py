@@ -5,6 +5,8 @@ from packages.common.vpnpanel_common.config import Settings
 from packages.common.vpnpanel_common.logging import configure_logging
 from packages.common.vpnpanel_common.metrics import metrics_app
 
+from .config_builder import get_config_builder
+from .config_outbox import get_config_consumer
 from .db import init_db
 from .routers import auth, tenants, users, roles, memberships, nodes, plans, subscriptions, assignments, traffic, audit
 
@@ -14,7 +16,19 @@ configure_logging(service_name="control-api")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    consumer = get_config_consumer()
+    consumer.start(settings.config_outbox_poll_seconds)
+    from .node_control import NodeControlServicer, serve
+
+    servicer = NodeControlServicer(
+        get_config_builder(), consumer,
+        window=settings.enforcement_window, batch_size=settings.enforcement_batch_size,
+        retry_base=settings.enforcement_retry_base_seconds, retry_max=settings.enforcement_retry_max_seconds,
+    )
+    grpc_server = await serve(settings, servicer)
     yield
+    await grpc_server.stop(grace=5)
+    await consumer.stop()
 
 app = FastAPI(
     title="Control API",
@@ -0,0 +1,258 @@
+"""NodeControl gRPC server (grpc.aio) for node agents.
+
+Each node agent keeps one ``StreamEnforcements`` stream open. Its ``NodeHello``
+carries the config revision the node last applied, and the first message on
+the stream brings it up to date: a ``NodeConfigDelta`` whenever the builder's
+history or the retained outbox covers the gap, a ``FullNodeConfigPush`` only
+when the node is older than that. A control plane restart therefore costs each
+reconnecting node a delta, not a full config. After that, every delta the
+outbox consumer produces for the node is forwarded on the stream; if several
+arrive before the node has been sent the previous one they are merged into a
+single delta from the node's last revision.
+
+The same deltas yield ``EnforcementCommand``s (suspend / resume / revoke) for
+entries whose status changed, queued per connected node in a ``NodeQueue``.
+Bulk operations (a plan expiry, a tenant-wide suspension) can produce
+thousands at once, so the queue keeps one command per (subscription, engine) -
+a newer revision supersedes one still waiting - and sends them in batches with
+at most ``window`` unacknowledged. Commands not confirmed by
+``ReportEnforcementResult`` are resent with exponential backoff. Commands for a
+node that is not connected are not queued: the config sync on reconnect
+carries the statuses.
+"""
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+import grpc
+from google.protobuf.message import Message
+
+from packages.common.vpnpanel_common.grpc_tls import peer_node_id, server_credentials
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import (
+    enforcement_ack_latency_seconds,
+    enforcement_commands_total,
+    enforcement_queue_depth,
+    node_config_syncs_total,
+)
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+from .config_builder import ConfigBuilder
+from .config_outbox import ConfigChangeConsumer
+
+log = get_logger("control_api.node_control")
+
+
+@dataclass
+class _InFlight:
+    command: Any  # pb.EnforcementCommand
+    first_sent: float  # monotonic
+    due: float  # resend when still unacked by then
+    attempts: int = 1
+
+
+class NodeQueue:
+    """Outbound config updates and enforcement commands for one connected node."""
+
+    def __init__(self, *, window: int = 1000, batch_size: int = 200, retry_base: float = 2.0, retry_max: float = 60.0):
+        self.window = window
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.queued: dict = {}  # (subscription_id, engine) -> pb.EnforcementCommand, oldest first
+        self.inflight: dict = {}  # (subscription_id, engine) -> _InFlight
+        self.delta = None  # next pb.NodeConfigDelta to forward as is
+        self.resync = False  # deltas piled up: compute one from the last sent revision
+        self.closed = False
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.queued) + len(self.inflight)
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+
+    def put(self, command) -> None:
+        key = (command.subscription_id, command.engine)
+        newest = self.queued.get(key)
+        if newest is None and key in self.inflight:
+            newest = self.inflight[key].command
+        if newest is not None and newest.revision >= command.revision:
+            return
+        if key in self.queued:
+            enforcement_commands_total.labels(outcome="coalesced").inc()
+        self.queued[key] = command
+        self._wakeup.set()
+
+    def put_delta(self, delta) -> None:
+        if self.delta is None and not self.resync:
+            self.delta = delta
+        else:
+            self.delta, self.resync = None, True
+        self._wakeup.set()
+
+    def take(self, now: float) -> list:
+        """Next batch: due resends first, then queued commands while the window has room."""
+        batch = []
+        for key, f in self.inflight.items():
+            if len(batch) >= self.batch_size:
+                return batch
+            if f.due <= now and key not in self.queued:  # a queued newer revision replaces it instead
+                f.attempts += 1
+                f.due = now + self._backoff(f.attempts)
+                batch.append(f.command)
+                enforcement_commands_total.labels(outcome="retried").inc()
+        for key in list(self.queued):
+            if len(batch) >= self.batch_size or (key not in self.inflight and len(self.inflight) >= self.window):
+                break
+            command = self.queued.pop(key)
+            self.inflight[key] = _InFlight(command, first_sent=now, due=now + self._backoff(1))
+            batch.append(command)
+            enforcement_commands_total.labels(outcome="sent").inc()
+        return batch
+
+    def ack(self, key: tuple, revision: int, success: bool, now: float) -> None:
+        f = self.inflight.get(key)
+        if f is None or revision < f.command.revision:  # duplicate, or for a superseded command
+            return
+        if success:
+            del self.inflight[key]
+            enforcement_commands_total.labels(outcome="acked").inc()
+            enforcement_ack_latency_seconds.observe(now - f.first_sent)
+            self._wakeup.set()  # room in the window
+        else:
+            enforcement_commands_total.labels(outcome="failed").inc()
+            f.due = now + self._backoff(f.attempts)
+
+    def _ready(self) -> bool:
+        return self.closed or self.delta is not None or self.resync or (
+            bool(self.queued) and len(self.inflight) < self.window
+        )
+
+    async def wait(self, now: float) -> None:
+        """Until there is something to send or a resend falls due."""
+        if self._ready():
+            return
+        timeout = max(0.0, min(f.due for f in self.inflight.values()) - now) if self.inflight else None
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def close(self) -> None:
+        self.closed = True
+        self._wakeup.set()
+
+
+class NodeControlServicer:
+    def __init__(self, builder: ConfigBuilder, consumer: ConfigChangeConsumer, **queue_options):
+        self.builder = builder
+        self.queue_options = queue_options
+        self._queues: dict[uuid.UUID, NodeQueue] = {}
+        consumer.add_listener(self._on_delta)
+        enforcement_queue_depth.set_function(lambda: sum(len(q) for q in self._queues.values()))
+
+    async def _on_delta(self, node_id: uuid.UUID, delta: Message) -> None:
+        queue = self._queues.get(node_id)
+        if queue is None:
+            return
+        queue.put_delta(delta)
+        for (sub_id, engine), (action, revision) in self.builder.actions(node_id, delta.from_revision).items():
+            queue.put(pb.EnforcementCommand(subscription_id=sub_id, engine=engine, action=action, revision=revision))
+
+    async def sync(self, node_id: uuid.UUID, since: int):
+        """Command bringing a node at revision ``since`` up to date; None if it already is.
+
+        Raises ``LookupError`` if the node does not exist.
+        """
+        delta = await self.builder.delta(node_id, since)
+        if delta is None:
+            raise LookupError(node_id)
+        if delta.full_resync:
+            full = await self.builder.full(node_id)
+            node_config_syncs_total.labels(kind="full").inc()
+            return pb.EnforcementCommand(revision=full.revision, full_config=full)
+        if delta.revision == since:
+            return None
+        node_config_syncs_total.labels(kind="delta").inc()
+        return pb.EnforcementCommand(revision=delta.revision, config_delta=delta)
+
+    async def _node_id(self, node_id: str, context: Any) -> uuid.UUID:
+        identity = peer_node_id(context)
+        if identity and node_id != identity:
+            await context.abort(grpc.StatusCode.PERMISSION_DENIED, "node_id does not match client certificate")
+        try:
+            return uuid.UUID(node_id)
+        except ValueError:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "invalid node_id")
+
+    async def StreamEnforcements(self, request: Any, context: Any) -> AsyncIterator[Any]:
+        node_id = await self._node_id(request.node_id, context)
+        queue = NodeQueue(**self.queue_options)
+        previous = self._queues.get(node_id)
+        if previous is not None:  # the agent reconnected; the old stream ends
+            previous.close()
+        self._queues[node_id] = queue
+        sent = request.current_revision
+        log.info("node_stream_open", node_id=str(node_id), revision=sent)
+        try:
+            queue.resync = True
+            while not queue.closed:
+                if queue.delta is not None or queue.resync:
+                    delta, queue.delta, queue.resync = queue.delta, None, False
+                    if delta is not None and delta.from_revision == sent:
+                        node_config_syncs_total.labels(kind="delta").inc()
+                        command = pb.EnforcementCommand(revision=delta.revision, config_delta=delta)
+                    else:
+                        try:
+                            command = await self.sync(node_id, sent)
+                        except LookupError:
+                            await context.abort(grpc.StatusCode.NOT_FOUND, "node not found")
+                    if command is not None:
+                        yield command
+                        sent = command.revision
+                for command in queue.take(time.monotonic()):
+                    yield command
+                await queue.wait(time.monotonic())
+        finally:
+            if self._queues.get(node_id) is queue:
+                del self._queues[node_id]
+            log.info("node_stream_closed", node_id=str(node_id), revision=sent, pending=len(queue))
+
+    async def PushFullConfig(self, request: Any, context: Any) -> Any:
+        """Node reports the revision it has applied; the ack says whether that is current."""
+        node_id = await self._node_id(request.node_id, context)
+        snap = await self.builder.snapshot(node_id)
+        if snap is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "node not found")
+        current = request.revision >= snap.revision
+        return pb.ConfigAck(node_id=request.node_id, revision=snap.revision, success=current,
+                            error="" if current else "stale revision")
+
+    async def ReportEnforcementResult(self, request: Any, context: Any) -> Any:
+        node_id = await self._node_id(request.node_id, context)
+        queue = self._queues.get(node_id)
+        if queue is not None:
+            queue.ack((request.subscription_id, request.engine), request.revision, request.success, time.monotonic())
+        if not request.success:
+            log.warning("enforcement_failed", node_id=request.node_id, subscription_id=request.subscription_id,
+                        engine=request.engine, action=request.action, revision=request.revision, error=request.error)
+        return pb.ConfigAck(node_id=request.node_id, revision=request.revision, success=True)
+
+
+async def serve(settings, servicer: NodeControlServicer) -> grpc.aio.Server:  # pragma: no cover - needs a network port
+    from packages.common.vpnpanel_common.proto import node_control_pb2_grpc
+
+    server = grpc.aio.server(options=[("grpc.keepalive_time_ms", 30_000), ("grpc.http2.max_pings_without_data", 0)])
+    node_control_pb2_grpc.add_NodeControlServicer_to_server(servicer, server)
+    creds = server_credentials(settings)
+    if creds is not None:
+        server.add_secure_port(settings.control_grpc_address, creds)
+    else:
+        server.add_insecure_port(settings.control_grpc_address)
+    await server.start()
+    log.info("node_control_grpc_started", address=settings.control_grpc_address, tls=creds is not None)
+    return server
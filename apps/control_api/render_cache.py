@@ -0,0 +1,135 @@
+"""Rendered client configs and WireGuard QR codes, cached per user.
+
+Subscription clients poll ``/users/{id}/configs`` and the QR endpoint far more
+often than anything those are rendered from changes. A render depends only on
+the user's credentials, allowed engines and assigned nodes. ``render_version``
+reads a version key for them in one indexed query: the engine flags, and the
+count and newest ``updated_at`` of the credentials and of the assignments. Its
+hash is both the cache key and the strong ``ETag``. A request whose
+``If-None-Match`` carries it gets a 304 after that single query. Otherwise
+``render_inputs`` loads the inputs themselves and each body is rendered once
+per version, then served from memory.
+
+The key changes with every insert, delete or ORM update of an input, through
+any API worker, so stale output is never served; an out-of-band write must
+bump ``updated_at`` like the ORM does. The endpoints that change the inputs
+(engines, assignments, user deletion) also call ``invalidate``, so superseded
+entries go right away instead of aging out of the LRU.
+"""
+import hashlib
+import json
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from packages.common.vpnpanel_common.db.models import Assignment, Credential, User, UserEngines
+from packages.common.vpnpanel_common.metrics import config_render_cache_total
+
+RENDER_VERSION = 1  # bump when a template changes so clients drop their ETags
+
+
+@dataclass(frozen=True)
+class RenderVersion:
+    user_id: uuid.UUID
+    allow_xray: bool
+    allow_wireguard: bool
+    credentials: tuple  # (count, newest updated_at)
+    assignments: tuple  # (count, newest updated_at)
+
+    def etag(self, kind: str) -> str:
+        payload = json.dumps([RENDER_VERSION, kind, str(self.user_id), self.allow_xray, self.allow_wireguard,
+                              self.credentials, self.assignments], separators=(",", ":"), default=str)
+        return '"' + hashlib.sha256(payload.encode()).hexdigest()[:32] + '"'
+
+
+@dataclass(frozen=True)
+class RenderInputs:
+    user_id: uuid.UUID
+    allow_xray: bool
+    allow_wireguard: bool
+    credentials: tuple  # ((engine, secret json), ...) sorted by engine
+    node_ids: tuple  # assigned nodes, sorted
+
+
+async def render_version(session: AsyncSession, user_id: uuid.UUID) -> RenderVersion | None:
+    """Version key of a user's render inputs in one query; None if the user does not exist."""
+    creds = select(func.count()).where(Credential.user_id == user_id).scalar_subquery()
+    creds_at = select(func.max(Credential.updated_at)).where(Credential.user_id == user_id).scalar_subquery()
+    nodes = select(func.count()).where(Assignment.user_id == user_id).scalar_subquery()
+    nodes_at = select(func.max(Assignment.updated_at)).where(Assignment.user_id == user_id).scalar_subquery()
+    row = (await session.execute(
+        select(UserEngines.allow_xray, UserEngines.allow_wireguard, creds, creds_at, nodes, nodes_at)
+        .select_from(User)
+        .outerjoin(UserEngines, UserEngines.user_id == User.id)
+        .where(User.id == user_id)
+    )).first()
+    if row is None:
+        return None
+    allow_xray, allow_wireguard, n_creds, creds_at, n_nodes, nodes_at = row
+    return RenderVersion(
+        user_id=user_id,
+        allow_xray=True if allow_xray is None else allow_xray,
+        allow_wireguard=True if allow_wireguard is None else allow_wireguard,
+        credentials=(n_creds, creds_at),
+        assignments=(n_nodes, nodes_at),
+    )
+
+
+async def render_inputs(session: AsyncSession, user_id: uuid.UUID) -> RenderInputs:
+    engines = (await session.execute(select(UserEngines).where(UserEngines.user_id == user_id))).scalars().first()
+    creds = (await session.execute(select(Credential.engine, Credential.secret).where(Credential.user_id == user_id))).all()
+    nodes = (await session.execute(select(Assignment.node_id).where(Assignment.user_id == user_id))).scalars().all()
+    return RenderInputs(
+        user_id=user_id,
+        allow_xray=engines.allow_xray if engines else True,
+        allow_wireguard=engines.allow_wireguard if engines else True,
+        credentials=tuple(sorted((getattr(e, "value", e), json.dumps(s, sort_keys=True, default=str)) for e, s in creds)),
+        node_ids=tuple(sorted(nodes, key=str)),
+    )
+
+
+def not_modified(if_none_match: str | None, etag: str) -> bool:
+    """``If-None-Match`` check (weak comparison, as RFC 9110 specifies for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class RenderCache:
+    """LRU of rendered bodies, one slot per (user, kind)."""
+
+    def __init__(self, max_users: int = 10_000):
+        self.max_users = max_users
+        self._users: OrderedDict = OrderedDict()  # user_id -> {kind: (etag, body)}
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    async def get(self, kind: str, user_id: uuid.UUID, etag: str, render: Callable[[], Awaitable[bytes]]) -> bytes:
+        slots = self._users.get(user_id)
+        if slots is None:
+            slots = self._users[user_id] = {}
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        entry = slots.get(kind)
+        if entry is not None and entry[0] == etag:
+            config_render_cache_total.labels(kind, "hit").inc()
+            return entry[1]
+        config_render_cache_total.labels(kind, "miss").inc()
+        body = await render()
+        slots[kind] = (etag, body)
+        return body
+
+    def invalidate(self, user_id: uuid.UUID) -> None:
+        self._users.pop(user_id, None)
+
+
+render_cache = RenderCache()
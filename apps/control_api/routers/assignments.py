@@ -3,7 +3,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from ..db import get_session
 from packages.common.vpnpanel_common.db.models import Assignment, User, Node, AuditLog
+from packages.common.vpnpanel_common.db.outbox import record_config_change
 from .. import schemas
+from ..render_cache import render_cache
 from ..security import require_admin
 from uuid import UUID
 
@@ -24,7 +26,9 @@ async def create_assignment(body: schemas.AssignmentCreate, session: AsyncSessio
     a = Assignment(user_id=body.user_id, node_id=body.node_id)
     session.add(a)
     await log(session, user.id, "assignment.create", "assignment", a.id)
+    await record_config_change(session, user_ids=[a.user_id])
     await session.commit(); await session.refresh(a)
+    render_cache.invalidate(a.user_id)
     return a
 
 @router.get("/", response_model=list[schemas.AssignmentOut])
@@ -41,9 +45,11 @@ async def move_assignment(assignment_id: UUID, body: schemas.AssignmentMove, ses
     nres = await session.execute(select(Node).where(Node.id == body.node_id))
     if not nres.scalars().first():
         raise HTTPException(404, "node not found")
-    a.node_id = body.node_id
+    old_node_id, a.node_id = a.node_id, body.node_id
     await log(session, user.id, "assignment.move", "assignment", a.id)
+    await record_config_change(session, user_ids=[a.user_id], node_ids=[old_node_id])
     await session.commit(); await session.refresh(a)
+    render_cache.invalidate(a.user_id)
     return a
 
 @router.delete("/{assignment_id}", status_code=204)
@@ -53,5 +59,8 @@ async def delete_assignment(assignment_id: UUID, session: AsyncSession = Depends
     if not a:
         raise HTTPException(404, "assignment not found")
     await log(session, user.id, "assignment.delete", "assignment", a.id)
-    await session.delete(a); await session.commit()
+    await session.delete(a)
+    await record_config_change(session, user_ids=[a.user_id], node_ids=[a.node_id])
+    await session.commit()
+    render_cache.invalidate(a.user_id)
     return None
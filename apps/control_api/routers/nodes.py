@@ -1,10 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from google.protobuf.json_format import MessageToDict
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from ..db import get_session
 from packages.common.vpnpanel_common.db.models import Node, AuditLog
 from .. import schemas
+from ..config_builder import get_config_builder
+from ..config_outbox import get_config_consumer
 from ..security import require_admin
+from typing import Optional
 import uuid
 
 router = APIRouter()
@@ -70,6 +74,15 @@ async def update_policy(node_id: uuid.UUID, policy: dict, session: AsyncSession
     await session.commit()
     return {"status": "ok", "policy": node.policy}
 
+@router.get("/{node_id}/config", summary="Node config snapshot or delta")
+async def node_config(node_id: uuid.UUID, since: Optional[int] = Query(None, ge=0, description="Return only changes after this revision"), user=Depends(require_admin)):
+    builder = get_config_builder()
+    await get_config_consumer().poll()  # read-your-writes: don't wait for the next poll
+    msg = await builder.full(node_id) if since is None else await builder.delta(node_id, since)
+    if msg is None:
+        raise HTTPException(404, "not found")
+    return MessageToDict(msg, preserving_proto_field_name=True, always_print_fields_with_no_presence=True)
+
 @router.get("/{node_id}/health", summary="Node health placeholder")
 async def node_health(node_id: uuid.UUID):
     return {"node_id": str(node_id), "status": "healthy"}
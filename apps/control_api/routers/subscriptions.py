@@ -3,11 +3,17 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from ..db import get_session
 from packages.common.vpnpanel_common.db.models import Subscription, Plan, User, AuditLog
+from packages.common.vpnpanel_common.config import get_settings
+from packages.common.vpnpanel_common.events import publish_subscription_expiry
+from packages.common.vpnpanel_common.db.outbox import record_config_change
+from packages.common.vpnpanel_common.db.quota import usage_snapshots
+from packages.common.vpnpanel_common.usage import pending_usage
 from .. import schemas
-from ..security import require_admin
+from ..security import get_current_user, require_admin
 from uuid import UUID
 
 router = APIRouter()
+settings = get_settings()
 
 async def log(session, actor, action, target_type, target_id):
     session.add(AuditLog(action=action, actor_user_id=actor, target_type=target_type, target_id=str(target_id)))
@@ -24,7 +30,9 @@ async def create_subscription(body: schemas.SubscriptionCreate, session: AsyncSe
     sub = Subscription(**body.model_dump())
     session.add(sub)
     await log(session, user.id, "subscription.create", "subscription", sub.id)
+    await record_config_change(session, user_ids=[sub.user_id])
     await session.commit(); await session.refresh(sub)
+    await publish_subscription_expiry(sub.id, sub.expiry_at, sub.active)
     return sub
 
 @router.get("/", response_model=list[schemas.SubscriptionOut])
@@ -32,12 +40,34 @@ async def list_subscriptions(session: AsyncSession = Depends(get_session)):
     res = await session.execute(select(Subscription))
     return res.scalars().all()
 
+@router.post("/usage:batch", response_model=schemas.SubscriptionUsageBatchOut)
+async def usage_batch(body: schemas.SubscriptionUsageBatchIn, session: AsyncSession = Depends(get_session), user=Depends(get_current_user)):
+    ids = list(dict.fromkeys(body.ids))
+    order = {sub_id: i for i, sub_id in enumerate(ids)}
+    rows = sorted(await usage_snapshots(session, ids), key=lambda r: order[r.id])  # one query; effective quota in SQL
+    pending = await pending_usage([r.id for r in rows]) if settings.usage_counters_enabled else {}
+    items = []
+    for r in rows:
+        consumed = r.consumed_bytes + sum(pending.get(r.id, {}).values())
+        items.append(schemas.SubscriptionUsageOut(
+            id=r.id, consumed_bytes=consumed, quota_bytes=r.quota_bytes,
+            remaining_bytes=None if r.quota_bytes is None else max(0, r.quota_bytes - consumed),
+            expiry_at=r.expiry_at, active=r.active,
+        ))
+    found = {r.id for r in rows}
+    return schemas.SubscriptionUsageBatchOut(items=items, missing=[i for i in ids if i not in found])
+
 @router.get("/{subscription_id}", response_model=schemas.SubscriptionOut)
 async def get_subscription(subscription_id: UUID, session: AsyncSession = Depends(get_session)):
     res = await session.execute(select(Subscription).where(Subscription.id == subscription_id))
     s = res.scalars().first()
     if not s: raise HTTPException(404, "not found")
-    return s
+    out = schemas.SubscriptionOut.model_validate(s, from_attributes=True)
+    if settings.usage_counters_enabled:
+        # live value: stored counter + deltas still in the Redis hot counters
+        pending = (await pending_usage([s.id])).get(s.id, {})
+        out.consumed_bytes += sum(pending.values())
+    return out
 
 @router.patch("/{subscription_id}", response_model=schemas.SubscriptionOut)
 async def update_subscription(subscription_id: UUID, body: schemas.SubscriptionUpdate, session: AsyncSession = Depends(get_session), user=Depends(require_admin)):
@@ -47,7 +77,10 @@ async def update_subscription(subscription_id: UUID, body: schemas.SubscriptionU
     data = body.dict(exclude_unset=True)
     for k, v in data.items(): setattr(s, k, v)
     await log(session, user.id, "subscription.update", "subscription", s.id)
+    await record_config_change(session, user_ids=[s.user_id])
     await session.commit(); await session.refresh(s)
+    if data.keys() & {"expiry_at", "active"}:
+        await publish_subscription_expiry(s.id, s.expiry_at, s.active)
     return s
 
 @router.delete("/{subscription_id}", status_code=204)
@@ -56,5 +89,8 @@ async def delete_subscription(subscription_id: UUID, session: AsyncSession = Dep
     s = res.scalars().first()
     if not s: raise HTTPException(404, "not found")
     await log(session, user.id, "subscription.delete", "subscription", s.id)
-    await session.delete(s); await session.commit()
+    await session.delete(s)
+    await record_config_change(session, user_ids=[s.user_id], subscription_ids=[s.id])
+    await session.commit()
+    await publish_subscription_expiry(subscription_id, None, False)
     return None
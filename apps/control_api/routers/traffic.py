@@ -1,35 +1,166 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from ..db import get_session
-from packages.common.vpnpanel_common.db.models import TrafficEvent, TrafficSource, AuditLog
+from packages.common.vpnpanel_common.db.models import Subscription, TrafficSource, AuditLog
+from packages.common.vpnpanel_common.db.ingest import build_event_rows, bulk_insert_traffic_events, RecentKeyFilter
+from packages.common.vpnpanel_common.db.quota import charge_usage, per_subscription
+from packages.common.vpnpanel_common.db import series
+from packages.common.vpnpanel_common.db.sketches import MAX_SKETCH_HOURS, load_sketches, merge_sketches, observe_rows
+from packages.common.vpnpanel_common.sketches import SpaceSaving
+from packages.common.vpnpanel_common.config import get_settings
+from packages.common.vpnpanel_common.metrics import traffic_ingest_duplicates_total
+from packages.common.vpnpanel_common.usage import report_enforcements
 from ..security import get_current_user
 from .. import schemas
 import uuid
-from typing import List, Optional
+from collections import Counter
+from typing import List, Literal, Optional
 
 router = APIRouter()
+settings = get_settings()
+recent_keys = RecentKeyFilter(ttl_seconds=settings.ingest_dedupe_ttl_seconds, max_keys=settings.ingest_dedupe_max_keys)
 
 async def log(session, actor, action, target_type, target_id):
     session.add(AuditLog(action=action, actor_user_id=actor, target_type=target_type, target_id=str(target_id)))
 
+async def _tenant_lookup(session, rows):
+    """Tenant of a row: its subscription's, else its user's active (else most recent) subscription's."""
+    sub_ids = {r["subscription_id"] for r in rows if r["subscription_id"]}
+    user_ids = {r["user_id"] for r in rows if r["user_id"] and not r["subscription_id"]}
+    by_sub, by_user = {}, {}
+    if sub_ids:
+        by_sub = dict((await session.execute(
+            select(Subscription.id, Subscription.tenant_id).where(Subscription.id.in_(sub_ids))
+        )).all())
+    if user_ids:
+        # Ascending, so the active and then newest subscription of each user is the one kept
+        by_user = dict((await session.execute(
+            select(Subscription.user_id, Subscription.tenant_id).where(Subscription.user_id.in_(user_ids))
+            .order_by(Subscription.active, Subscription.created_at)
+        )).all())
+    return lambda r: by_sub.get(r["subscription_id"]) if r["subscription_id"] else by_user.get(r["user_id"])
+
 @router.post("/events", status_code=202, summary="Ingest traffic events")
 async def ingest_events(events: List[schemas.TrafficEventIn], session: AsyncSession = Depends(get_session), user=Depends(get_current_user)):
     now = datetime.now(timezone.utc)
-    objs = []
-    for ev in events:
-        objs.append(TrafficEvent(event_time=now, user_id=ev.user_id, node_id=ev.node_id, bytes_up=ev.bytes_up, bytes_down=ev.bytes_down, source=TrafficSource.collector))
-    session.add_all(objs)
-    await log(session, user.id, "traffic.ingest", "traffic_batch", len(objs))
+    # Plain row dicts + one bulk statement (COPY on asyncpg) instead of one ORM object per sample
+    rows = build_event_rows((ev.model_dump() for ev in events), event_time=now, source=TrafficSource.collector)
+    rows, dropped = recent_keys.filter(rows)
+    usage, landed = Counter(), []
+    ingested = await bulk_insert_traffic_events(session, rows, usage=usage, landed=landed)
+    enforced = await charge_usage(session, per_subscription(usage), now)
+    # Same hourly sketches as the collector's gRPC ingest feeds, for /traffic/top and /traffic/active;
+    # only rows that landed, so a redelivered batch does not count twice
+    sketch_deltas = {}
+    observe_rows(sketch_deltas, landed, await _tenant_lookup(session, landed), top_capacity=settings.sketch_top_capacity)
+    await merge_sketches(session, sketch_deltas)
+    await log(session, user.id, "traffic.ingest", "traffic_batch", ingested)
     await session.commit()
-    return {"ingested": len(objs)}
+    recent_keys.remember(rows)
+    report_enforcements(enforced)
+    traffic_ingest_duplicates_total.labels(stage="memory").inc(dropped)
+    traffic_ingest_duplicates_total.labels(stage="db").inc(len(rows) - ingested)
+    return {"ingested": ingested, "duplicates": len(events) - ingested}
+
+def _hour_floor(ts: Optional[datetime]) -> Optional[datetime]:
+    if ts is None:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
 
 @router.get("/summary", response_model=list[schemas.TrafficSummaryOut])
-async def traffic_summary(user_id: Optional[uuid.UUID] = Query(None), session: AsyncSession = Depends(get_session), user=Depends(get_current_user)):
-    stmt = select(TrafficEvent.user_id, func.sum(TrafficEvent.bytes_up), func.sum(TrafficEvent.bytes_down)).group_by(TrafficEvent.user_id)
-    if user_id:
-        stmt = stmt.where(TrafficEvent.user_id == user_id)
-    rows = (await session.execute(stmt)).all()
-    return [schemas.TrafficSummaryOut(user_id=r[0], total_up=r[1] or 0, total_down=r[2] or 0) for r in rows]
+async def traffic_summary(
+    user_id: Optional[uuid.UUID] = Query(None),
+    tenant_id: Optional[uuid.UUID] = Query(None),
+    node_id: Optional[uuid.UUID] = Query(None),
+    since: Optional[datetime] = Query(None, description="Inclusive, truncated to the hour"),
+    until: Optional[datetime] = Query(None, description="Exclusive, truncated to the hour"),
+    session: AsyncSession = Depends(get_session),
+    user=Depends(get_current_user),
+):
+    # Compacted daily/monthly rollups + hourly rollups + raw tail, see db/series.py
+    totals = await series.traffic_totals(
+        session, _hour_floor(since), _hour_floor(until),
+        series.SeriesFilter(user_id=user_id, tenant_id=tenant_id, node_id=node_id),
+    )
+    return [schemas.TrafficSummaryOut(user_id=uid, total_up=t[0], total_down=t[1]) for uid, t in totals.items()]
+
+@router.get("/series", response_model=schemas.TrafficSeriesOut)
+async def traffic_series(
+    since: datetime = Query(..., description="Inclusive, floored to the bucket"),
+    until: Optional[datetime] = Query(None, description="Exclusive, defaults to now"),
+    bucket: Optional[Literal[tuple(series.SERIES_BUCKETS)]] = Query(None, description="Bucket width; chosen from the range when omitted"),
+    user_id: Optional[uuid.UUID] = Query(None),
+    tenant_id: Optional[uuid.UUID] = Query(None),
+    node_id: Optional[uuid.UUID] = Query(None),
+    session: AsyncSession = Depends(get_session),
+    user=Depends(get_current_user),
+):
+    # Tiers (raw events, hourly or daily rollups) follow the bucket width, see db/series.py
+    try:
+        tier, width, points = await series.traffic_series(
+            session, since, until or datetime.now(timezone.utc),
+            series.SeriesFilter(user_id=user_id, tenant_id=tenant_id, node_id=node_id),
+            bucket_seconds=series.SERIES_BUCKETS[bucket] if bucket else None,
+            raw_since=datetime.now(timezone.utc) - timedelta(days=settings.retention_raw_days),
+        )
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    return schemas.TrafficSeriesOut(
+        tier=tier, bucket_seconds=width,
+        points=[schemas.TrafficSeriesPoint(t=t, bytes_up=up, bytes_down=down) for t, up, down in points],
+    )
+
+async def _sketch_window(session, node_id, tenant_id, since, until, default_hours):
+    """Resolve the sketch scope and hour range, and load the hourly sketches in it."""
+    if (node_id is None) == (tenant_id is None):
+        raise HTTPException(422, "exactly one of node_id or tenant_id is required")
+    scope, scope_id = ("node", node_id) if node_id else ("tenant", tenant_id)
+    until = _hour_floor(until) or _hour_floor(datetime.now(timezone.utc)) + timedelta(hours=1)
+    since = _hour_floor(since) or until - timedelta(hours=default_hours)
+    if not timedelta(0) < until - since <= timedelta(hours=MAX_SKETCH_HOURS):
+        raise HTTPException(422, f"range must be between 1 and {MAX_SKETCH_HOURS} hours")
+    return scope, scope_id, since, until, await load_sketches(session, scope, scope_id, since, until)
+
+@router.get("/top", response_model=schemas.TrafficTopOut, summary="Approximate top users by bandwidth")
+async def traffic_top(
+    node_id: Optional[uuid.UUID] = Query(None),
+    tenant_id: Optional[uuid.UUID] = Query(None),
+    since: Optional[datetime] = Query(None, description="Inclusive, truncated to the hour; defaults to the current hour"),
+    until: Optional[datetime] = Query(None, description="Exclusive, truncated to the hour"),
+    limit: int = Query(20, ge=1, le=settings.sketch_top_capacity),
+    session: AsyncSession = Depends(get_session),
+    user=Depends(get_current_user),
+):
+    # Space-saving summaries persisted per hour by the collector, no scan of traffic_events
+    scope, scope_id, since, until, hours = await _sketch_window(session, node_id, tenant_id, since, until, 1)
+    top = SpaceSaving(settings.sketch_top_capacity)
+    for _, _, hour_top in hours:
+        top.merge(hour_top)
+    return schemas.TrafficTopOut(
+        scope=scope, scope_id=scope_id, since=since, until=until,
+        users=[schemas.TrafficTopUser(user_id=item, bytes=count, error=err) for item, count, err in top.top(limit)],
+    )
 
+@router.get("/active", response_model=schemas.TrafficActiveOut, summary="Approximate distinct active users per hour")
+async def traffic_active(
+    node_id: Optional[uuid.UUID] = Query(None),
+    tenant_id: Optional[uuid.UUID] = Query(None),
+    since: Optional[datetime] = Query(None, description="Inclusive, truncated to the hour; defaults to 24h ago"),
+    until: Optional[datetime] = Query(None, description="Exclusive, truncated to the hour"),
+    session: AsyncSession = Depends(get_session),
+    user=Depends(get_current_user),
+):
+    # HyperLogLog per hour; the range total merges them (distinct users, not a sum)
+    scope, scope_id, since, until, hours = await _sketch_window(session, node_id, tenant_id, since, until, 24)
+    union = None
+    points = []
+    for hour, hll, _ in hours:
+        points.append(schemas.TrafficActivePoint(t=hour, active=hll.count()))
+        union = hll if union is None else union.merge(hll)
+    return schemas.TrafficActiveOut(
+        scope=scope, scope_id=scope_id, distinct=union.count() if union else 0, points=points,
+    )
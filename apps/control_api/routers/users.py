@@ -1,13 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from ..db import get_session
-from packages.common.vpnpanel_common.db.models import User, UserEngines, AuditLog
+from packages.common.vpnpanel_common.db.models import Assignment, User, UserEngines, AuditLog
+from packages.common.vpnpanel_common.db.outbox import record_config_change
+from packages.common.vpnpanel_common.metrics import config_render_cache_total
+from ..render_cache import render_cache, render_inputs, render_version, not_modified
 from ..security import hash_password, get_current_user, require_admin
 from .. import schemas
 import uuid
 import io
+import json
 import base64
 import qrcode
 import qrcode.image.svg
@@ -64,8 +68,11 @@ async def delete_user(user_id: uuid.UUID, session: AsyncSession = Depends(get_se
     u = res.scalars().first()
     if not u:
         raise HTTPException(404, "user not found")
+    node_ids = (await session.execute(select(Assignment.node_id).where(Assignment.user_id == u.id))).scalars().all()
     await log(session, actor.id, "user.delete", "user", u.id)
+    await record_config_change(session, user_ids=[user_id], node_ids=node_ids)
     await session.delete(u); await session.commit()
+    render_cache.invalidate(user_id)
     return None
 
 @router.post("/{user_id}/engines", summary="Update allowed engines")
@@ -81,41 +88,58 @@ async def update_engines(user_id: uuid.UUID, body: schemas.UserEnginesUpdate, se
     ue.allow_xray = "xray" in requested
     ue.allow_wireguard = "wireguard" in requested
     await log(session, actor.id, "user.engines.update", "user", user_id)
+    await record_config_change(session, user_ids=[user_id])
     await session.commit()
+    render_cache.invalidate(user_id)
     return {"user_id": str(user_id), "engines": list(requested)}
 
-@router.get("/{user_id}/configs")
-async def user_configs(user_id: uuid.UUID, session: AsyncSession = Depends(get_session), actor=Depends(get_current_user)):
-    ures = await session.execute(select(User).where(User.id == user_id))
-    user = ures.scalars().first()
-    if not user:
-        raise HTTPException(404, "user not found")
-    eres = await session.execute(select(UserEngines).where(UserEngines.user_id == user_id))
-    engines = eres.scalars().first()
-    allow_xray = engines.allow_xray if engines else True
-    allow_wireguard = engines.allow_wireguard if engines else True
+WIREGUARD_CONF = "[Interface]\nPrivateKey=CHANGEME\nAddress=10.0.0.2/32\n\n[Peer]\nPublicKey=PUBKEY\nEndpoint=example.com:51820\nAllowedIPs=0.0.0.0/0"
+
+def render_configs(user_id: uuid.UUID, allow_xray: bool, allow_wireguard: bool) -> bytes:
     data = {}
     if allow_xray:
-        vmess_payload = {"v": "2", "ps": f"user-{user.id.hex[:6]}", "add": "example.com", "port": "443", "id": str(user.id), "aid": "0", "net": "ws", "type": "none", "host": "example.com", "path": "/ws", "tls": "tls"}
-        import json
+        vmess_payload = {"v": "2", "ps": f"user-{user_id.hex[:6]}", "add": "example.com", "port": "443", "id": str(user_id), "aid": "0", "net": "ws", "type": "none", "host": "example.com", "path": "/ws", "tls": "tls"}
         vmess_b64 = base64.urlsafe_b64encode(json.dumps(vmess_payload).encode()).decode()
         vmess_link = f"vmess://{vmess_b64}"
-        vless_link = f"vless://{user.id}@example.com:443?encryption=none&security=tls&type=ws&host=example.com&path=%2Fws#user-{user.id.hex[:6]}"
-        clash_snippet = f"- name: user-{user.id.hex[:6]}\n  type: vmess\n  server: example.com\n  port: 443\n  uuid: {user.id}\n  alterId: 0\n  cipher: auto\n  tls: true\n  network: ws\n  ws-opts:\n    path: /ws\n    headers:\n      Host: example.com"
+        vless_link = f"vless://{user_id}@example.com:443?encryption=none&security=tls&type=ws&host=example.com&path=%2Fws#user-{user_id.hex[:6]}"
+        clash_snippet = f"- name: user-{user_id.hex[:6]}\n  type: vmess\n  server: example.com\n  port: 443\n  uuid: {user_id}\n  alterId: 0\n  cipher: auto\n  tls: true\n  network: ws\n  ws-opts:\n    path: /ws\n    headers:\n      Host: example.com"
         data["xray"] = {"vmess": vmess_link, "vless": vless_link, "clash": clash_snippet}
     if allow_wireguard:
-        wireguard_conf = f"[Interface]\nPrivateKey=CHANGEME\nAddress=10.0.0.2/32\n\n[Peer]\nPublicKey=PUBKEY\nEndpoint=example.com:51820\nAllowedIPs=0.0.0.0/0"
-        data["wireguard"] = {"config": wireguard_conf}
-    return data
-
-@router.get("/{user_id}/wireguard/qr", summary="WireGuard config QR", responses={200: {"content": {"image/svg+xml": {}}}})
-async def wireguard_qr(user_id: uuid.UUID, session: AsyncSession = Depends(get_session), actor=Depends(get_current_user)):
-    eres = await session.execute(select(UserEngines).where(UserEngines.user_id == user_id))
-    engines = eres.scalars().first()
-    if engines and not engines.allow_wireguard:
-        raise HTTPException(403, "wireguard disabled for user")
-    wireguard_conf = f"[Interface]\nPrivateKey=CHANGEME\nAddress=10.0.0.2/32\n\n[Peer]\nPublicKey=PUBKEY\nEndpoint=example.com:51820\nAllowedIPs=0.0.0.0/0"
+        data["wireguard"] = {"config": WIREGUARD_CONF}
+    return JSONResponse(data).body
+
+def render_wireguard_qr() -> bytes:
     factory = qrcode.image.svg.SvgImage
-    img = qrcode.make(wireguard_conf, image_factory=factory)
-    buf = io.BytesIO(); img.save(buf); buf.seek(0)
-    return StreamingResponse(buf, media_type="image/svg+xml")
+    img = qrcode.make(WIREGUARD_CONF, image_factory=factory)
+    buf = io.BytesIO(); img.save(buf)
+    return buf.getvalue()
+
+async def cached_response(kind: str, etag: str, if_none_match: str | None, render, media_type: str, user_id: uuid.UUID) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if not_modified(if_none_match, etag):
+        config_render_cache_total.labels(kind, "not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    return Response(await render_cache.get(kind, user_id, etag, render), media_type=media_type, headers=headers)
+
+@router.get("/{user_id}/configs")
+async def user_configs(user_id: uuid.UUID, if_none_match: str | None = Header(None), session: AsyncSession = Depends(get_session), actor=Depends(get_current_user)):
+    version = await render_version(session, user_id)
+    if version is None:
+        raise HTTPException(404, "user not found")
+
+    async def render():  # only on a cache miss
+        inputs = await render_inputs(session, user_id)
+        return render_configs(user_id, inputs.allow_xray, inputs.allow_wireguard)
+    return await cached_response("configs", version.etag("configs"), if_none_match, render, "application/json", user_id)
+
+@router.get("/{user_id}/wireguard/qr", summary="WireGuard config QR", responses={200: {"content": {"image/svg+xml": {}}}, 304: {"description": "Not modified"}})
+async def wireguard_qr(user_id: uuid.UUID, if_none_match: str | None = Header(None), session: AsyncSession = Depends(get_session), actor=Depends(get_current_user)):
+    version = await render_version(session, user_id)
+    if version is None:
+        raise HTTPException(404, "user not found")
+    if not version.allow_wireguard:
+        raise HTTPException(403, "wireguard disabled for user")
+
+    async def render():
+        return render_wireguard_qr()
+    return await cached_response("wireguard_qr", version.etag("wireguard_qr"), if_none_match, render, "image/svg+xml", user_id)
@@ -1,6 +1,6 @@
 from datetime import datetime
-from typing import Optional, List
-from pydantic import BaseModel, EmailStr
+from typing import Optional, List, Literal
+from pydantic import BaseModel, EmailStr, Field
 import uuid
 
 # Basic shared models
@@ -112,6 +112,20 @@ class SubscriptionOut(SubscriptionCreate):
     class Config:
         orm_mode = True
 
+MAX_USAGE_BATCH = 5000
+class SubscriptionUsageBatchIn(BaseModel):
+    ids: List[uuid.UUID] = Field(..., min_length=1, max_length=MAX_USAGE_BATCH)
+class SubscriptionUsageOut(BaseModel):
+    id: uuid.UUID
+    consumed_bytes: int
+    quota_bytes: Optional[int] = None  # effective: override, else plan; null = unlimited
+    remaining_bytes: Optional[int] = None
+    expiry_at: Optional[datetime] = None
+    active: bool
+class SubscriptionUsageBatchOut(BaseModel):
+    items: List[SubscriptionUsageOut]
+    missing: List[uuid.UUID]
+
 class AssignmentCreate(BaseModel):
     user_id: uuid.UUID
     node_id: uuid.UUID
@@ -129,6 +143,11 @@ class TrafficEventIn(BaseModel):
     node_id: Optional[uuid.UUID] = None
     bytes_up: int
     bytes_down: int
+    # Dedupe key (optional): redelivered samples with the same key are counted once
+    subscription_id: Optional[uuid.UUID] = None
+    engine: Optional[Literal["xray", "wireguard"]] = None
+    counter_seq: Optional[int] = None
+    period_end_unix: Optional[int] = None
     class Config:
         json_schema_extra = {"example": {"user_id": "00000000-0000-0000-0000-000000000000", "node_id": "00000000-0000-0000-0000-000000000000", "bytes_up": 1234, "bytes_down": 5678}}
 class TrafficSummaryOut(BaseModel):
@@ -136,6 +155,38 @@ class TrafficSummaryOut(BaseModel):
     total_up: int
     total_down: int
 
+class TrafficSeriesPoint(BaseModel):
+    t: datetime
+    bytes_up: int
+    bytes_down: int
+
+class TrafficSeriesOut(BaseModel):
+    tier: Literal["raw", "hourly", "daily"]
+    bucket_seconds: int
+    points: list[TrafficSeriesPoint]
+
+class TrafficTopUser(BaseModel):
+    user_id: uuid.UUID  # subscription id when the sample carried no resolvable user
+    bytes: int
+    error: int  # bytes may be overestimated by at most this much
+
+class TrafficTopOut(BaseModel):
+    scope: Literal["node", "tenant"]
+    scope_id: uuid.UUID
+    since: datetime
+    until: datetime
+    users: list[TrafficTopUser]
+
+class TrafficActivePoint(BaseModel):
+    t: datetime
+    active: int
+
+class TrafficActiveOut(BaseModel):
+    scope: Literal["node", "tenant"]
+    scope_id: uuid.UUID
+    distinct: int  # distinct users over the whole range
+    points: list[TrafficActivePoint]
+
 class AuditLogOut(BaseModel):
     id: int
     created_at: datetime
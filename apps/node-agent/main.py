@@ -1,23 +1,87 @@
 import asyncio
+import os
+
+import grpc
+from prometheus_client import start_http_server
+
+from apps.node_agent.config_stream import ConfigStream
+from apps.node_agent.schedule import PhaseSchedule
+from apps.node_agent.spool import SampleSpool
+from apps.node_agent.traffic import TrafficShipper
+from apps.node_agent.wireguard import WireGuardDriver
+from apps.node_agent.xray_stats import XraySampler, XrayStatsClient
+from apps.node_agent.xray_users import XrayHandlerClient, XrayUserDriver
 from packages.common.vpnpanel_common.config import get_settings
+from packages.common.vpnpanel_common.grpc_tls import channel_credentials
 from packages.common.vpnpanel_common.logging import configure_logging, get_logger
+from packages.common.vpnpanel_common.metrics import registry
+from packages.common.vpnpanel_common.proto import node_control_pb2_grpc
 
 settings = get_settings()
 configure_logging(service_name="node-agent", level=settings.log_level)
 log = get_logger("node-agent")
 
-async def heartbeat_loop():  # pragma: no cover
+async def sample_loop(sampler: XraySampler, shipper: TrafficShipper, schedule: PhaseSchedule):  # pragma: no cover
+    while True:
+        if shipper.preferred_phase is not None:
+            schedule.set_phase(shipper.preferred_phase)
+        await schedule.wait()
+        try:
+            samples = await sampler.sample()
+            shipper.submit(samples)
+            log.info("node_agent_heartbeat", xray_samples=len(samples), xray_users=len(sampler.table),
+                     connected=shipper.connected, spooled=len(shipper.spool))
+        except grpc.aio.AioRpcError as e:
+            log.warning("xray_stats_failed", code=e.code().name, details=e.details())
+
+async def flush_loop(spool: SampleSpool, interval: float):  # pragma: no cover
     while True:
-        log.info("node_agent_heartbeat")
-        await asyncio.sleep(settings.sample_interval_seconds)
+        await asyncio.sleep(interval)
+        spool.flush()
+
+def open_channel(target: str) -> grpc.aio.Channel:  # pragma: no cover
+    creds = channel_credentials(settings)
+    if creds is None:
+        return grpc.aio.insecure_channel(target)
+    return grpc.aio.secure_channel(target, creds)
 
 async def main():  # pragma: no cover
     log.info("node_agent_start")
-    await heartbeat_loop()
+    if settings.node_agent_metrics_port:
+        start_http_server(settings.node_agent_metrics_port, registry=registry)
+    os.makedirs(os.path.dirname(settings.node_spool_path) or ".", exist_ok=True)
+    node_id = settings.node_id or ""
+    spool = SampleSpool(settings.node_spool_path, node_id, capacity=settings.node_spool_capacity,
+                        flush_interval=settings.node_spool_flush_seconds)
+    channel = open_channel(settings.collector_grpc_target)
+    shipper = TrafficShipper(node_control_pb2_grpc.TrafficIngestStub(channel), spool,
+                             replay_batch=settings.node_spool_replay_batch)
+    client = XrayStatsClient(settings.xray_api_address)
+    handler = XrayHandlerClient(settings.xray_api_address)
+    drivers = {"xray": XrayUserDriver(handler)}
+    if settings.wireguard_interface:
+        drivers["wireguard"] = WireGuardDriver(settings.wireguard_interface)  # pyroute2, else the wg CLI
+    control_channel = open_channel(settings.control_plane_grpc_address)
+    config = ConfigStream(node_control_pb2_grpc.NodeControlStub(control_channel), node_id, drivers,
+                          resync_interval=settings.node_config_resync_seconds)
+    shipper.start()
+    config.start()
+    flusher = asyncio.create_task(flush_loop(spool, settings.node_spool_flush_seconds))
+    try:
+        schedule = PhaseSchedule(node_id, settings.sample_interval_seconds, jitter=settings.sample_jitter_seconds)
+        await sample_loop(XraySampler(client, node_id), shipper, schedule)
+    finally:
+        flusher.cancel()
+        await config.stop()
+        await shipper.stop()  # unacked samples go to the spool
+        await client.close()
+        await handler.close()
+        await control_channel.close()
+        await channel.close()
+        spool.close()
 
 if __name__ == "__main__":  # pragma: no cover
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         log.info("node_agent_stop")
-
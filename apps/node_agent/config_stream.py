@@ -0,0 +1,181 @@
+"""Applies the control plane's config and enforcement commands via ``NodeControl.StreamEnforcements``.
+
+The ``NodeHello`` carries the revision applied last, so after a reconnect the
+first message is only the gap (a ``NodeConfigDelta``, or a
+``FullNodeConfigPush`` when the control plane cannot reconstruct it). Every
+config command goes to every engine driver (``load`` / ``update``; each one
+picks out its own engine's entries).
+
+Enforcement commands arrive after the delta that changed the subscription's
+status, so the drivers already hold it; a suspend or revoke still removes the
+subscription from its engine's driver in case the delta was merged away.
+Resume needs nothing beyond that delta. Each command is reported with
+``ReportEnforcementResult`` once its engine has synced, and the control plane
+resends it until the report says it succeeded.
+
+Commands are applied in batches: whatever arrived while the previous batch
+was syncing is applied together and each touched driver syncs once. Drivers
+also sync every ``resync_interval`` seconds, which repairs drift such as an
+Xray restart or a peer removed by hand. Nothing is synced before the first
+config has been applied: an empty desired state would remove every client.
+"""
+import asyncio
+from typing import Any, Protocol
+
+import grpc
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+log = get_logger("node_agent.config_stream")
+
+REMOVING = ("suspend", "revoke")
+_END = object()  # the stream ended cleanly
+
+
+class Driver(Protocol):
+    def load(self, full) -> None: ...
+
+    def update(self, delta) -> None: ...
+
+    def sync(self) -> Any: ...  # WireGuardDriver syncs synchronously, XrayUserDriver is async
+
+
+class ConfigStream:
+    def __init__(self, stub: Any, node_id: str, drivers: dict[str, Driver], *, resync_interval: float = 60.0,
+                 retry_base: float = 1.0, retry_max: float = 30.0):
+        self.stub = stub  # node_control_pb2_grpc.NodeControlStub
+        self.node_id = node_id
+        self.drivers = drivers  # engine -> driver
+        self.resync_interval = resync_interval
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.revision = 0  # config revision applied last
+        self.loaded = False  # whether any config has been applied
+        self._task: asyncio.Task | None = None
+
+    def _apply(self, command) -> set[str]:
+        """Engines whose desired state the command may have changed."""
+        kind = command.WhichOneof("config")
+        if kind is not None:
+            for driver in self.drivers.values():
+                if kind == "full_config":
+                    driver.load(command.full_config)
+                else:
+                    driver.update(command.config_delta)
+            self.revision = command.revision
+            self.loaded = True
+            return set(self.drivers)
+        driver = self.drivers.get(command.engine)
+        if driver is None:
+            return set()
+        if command.action in REMOVING:
+            key = pb.SubscriptionKey(subscription_id=command.subscription_id, engine=command.engine)
+            driver.update(pb.NodeConfigDelta(removed=[key]))
+        return {command.engine}
+
+    async def _sync(self, engines) -> dict[str, str]:
+        """Sync the engines' drivers; engine -> error for those that did not fully apply."""
+        errors = {}
+        for engine in sorted(engines):
+            driver = self.drivers[engine]
+            try:
+                if asyncio.iscoroutinefunction(driver.sync):
+                    result = await driver.sync()
+                else:
+                    result = await asyncio.to_thread(driver.sync)
+            except Exception as e:  # netlink / wg errors; the next sync diffs against a fresh dump
+                log.warning("node_config_sync_failed", engine=engine, error=repr(e))
+                errors[engine] = repr(e)
+                continue
+            if getattr(result, "failed", 0):
+                errors[engine] = f"{result.failed} calls failed"
+        return errors
+
+    async def _handle(self, batch: list) -> None:
+        engines: set[str] = set()
+        for command in batch:
+            engines |= self._apply(command)
+        errors = await self._sync(engines) if self.loaded else {}
+        for command in batch:
+            if not command.action:
+                continue
+            if command.engine not in self.drivers:
+                error = f"engine {command.engine!r} is not managed on this node"
+            elif not self.loaded:
+                error = "no config applied yet"
+            else:
+                error = errors.get(command.engine, "")
+            try:
+                await self.stub.ReportEnforcementResult(pb.EnforcementResult(
+                    subscription_id=command.subscription_id, engine=command.engine, action=command.action,
+                    success=not error, error=error, node_id=self.node_id, revision=command.revision))
+            except grpc.aio.AioRpcError as e:  # the control plane resends the command
+                log.warning("enforcement_report_failed", code=e.code().name, subscription_id=command.subscription_id)
+
+    async def _read(self, call, queue: asyncio.Queue) -> None:
+        try:
+            async for command in call:
+                queue.put_nowait(command)
+            queue.put_nowait(_END)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    async def _stream(self) -> int:
+        """One stream until it ends; returns how many commands it delivered."""
+        queue: asyncio.Queue = asyncio.Queue()
+        call = self.stub.StreamEnforcements(pb.NodeHello(node_id=self.node_id, current_revision=self.revision))
+        reader = asyncio.create_task(self._read(call, queue))
+        received = 0
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.resync_interval)
+                except asyncio.TimeoutError:
+                    if self.loaded:
+                        await self._sync(self.drivers)
+                    continue
+                batch, end = [], None
+                while True:
+                    if item is _END or isinstance(item, Exception):
+                        end = item
+                        break
+                    batch.append(item)
+                    if queue.empty():
+                        break
+                    item = queue.get_nowait()
+                received += len(batch)
+                if batch:
+                    await self._handle(batch)
+                if isinstance(end, Exception):
+                    raise end
+                if end is _END:
+                    return received
+        finally:
+            reader.cancel()
+            call.cancel()
+
+    async def run(self) -> None:
+        delay = self.retry_base
+        while True:
+            try:
+                if await self._stream():
+                    delay = self.retry_base
+                log.info("config_stream_closed", revision=self.revision)
+            except grpc.aio.AioRpcError as e:
+                log.warning("config_stream_down", code=e.code().name, revision=self.revision, retry_in=delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,54 @@
+"""Phase-aligned sampling schedule for the node agent.
+
+Samples are taken at ``phase + k * interval`` on the wall clock, not every
+``interval`` after the previous sample. The sampling time and sleep overshoot
+therefore never accumulate into drift, and a late wakeup skips the ticks it
+missed instead of sampling in a burst. The phase defaults to the node's hashed
+phase (``vpnpanel_common.sampling.node_phase``). The collector's preferred
+phase replaces it once a ``TrafficIngestAck`` advertises one. After a phase
+change the next tick is at least half an interval after the previous one.
+
+Each wakeup is displaced by a random jitter of at most ``jitter`` seconds
+(capped at 5% of the interval), so nodes that share a phase do not all hit
+the collector in the same millisecond.
+"""
+import asyncio
+import math
+import random
+import time
+from typing import Callable
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.sampling import node_phase
+
+log = get_logger("node_agent.schedule")
+
+
+class PhaseSchedule:
+    def __init__(self, node_id: str, interval: float, *, jitter: float = 2.0,
+                 clock: Callable[[], float] = time.time, rng: random.Random | None = None):
+        self.interval = interval
+        self.phase = node_phase(node_id, interval)
+        self.jitter = max(0.0, min(jitter, 0.05 * interval))
+        self.clock = clock
+        self.rng = rng or random.Random(node_id)
+        self.last: float | None = None  # nominal time of the last tick
+
+    def set_phase(self, phase: float) -> None:
+        phase %= self.interval
+        if abs(phase - self.phase) > 1e-3:
+            log.info("sample_phase_changed", old=round(self.phase, 3), new=round(phase, 3))
+            self.phase = phase
+
+    def next_tick(self, now: float) -> float:
+        """Nominal time of the next sample after ``now``."""
+        earliest = now if self.last is None else max(now, self.last + self.interval / 2)
+        return (math.floor((earliest - self.phase) / self.interval) + 1) * self.interval + self.phase
+
+    async def wait(self) -> float:
+        """Sleep until the next (jittered) tick; returns its nominal time."""
+        tick = self.next_tick(self.clock())
+        self.last = tick
+        target = tick + self.rng.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(0.0, target - self.clock()))
+        return tick
@@ -0,0 +1,163 @@
+"""Disk-backed spool of traffic samples for control plane outages.
+
+A fixed-size file, memory-mapped as a ring of fixed-width records behind a
+small header. ``head`` and ``tail`` in the header are absolute record numbers
+(the oldest unconfirmed sample and the next free slot), so the spool survives
+agent restarts and the file never grows. Appends write the records first and
+the header last; a crash in between only loses the records just written.
+
+Writes land in the page cache, so an agent crash or restart loses nothing.
+They are forced to disk (``msync``) at most every ``flush_interval`` seconds:
+by an append once the interval has passed, and by ``flush``, which the agent
+calls on a timer so the last append does not wait for the next one. A power
+loss or kernel crash therefore loses the samples spooled in the last
+``flush_interval`` seconds. If it strikes during an ``msync`` the header can
+reach the disk before the records it covers; those slots then replay whatever
+they held before (zeroed or old records, which the collector's dedupe key
+absorbs).
+
+When the ring is full the oldest records are overwritten, and
+``node_spool_dropped_total`` counts them. Past 80% full the agent logs a
+warning once per crossing and ``node_spool_high_watermark`` reads 1.
+
+Records hold what a ``TrafficSample`` needs except the node id, which is the
+agent's own. Subscription ids are stored as 16 raw UUID bytes; samples for
+anything else are not spooled, because the collector would reject them anyway.
+"""
+import mmap
+import os
+import struct
+import time
+import uuid
+from typing import Callable, Iterable
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import (
+    node_spool_dropped_total,
+    node_spool_fill_ratio,
+    node_spool_high_watermark,
+)
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+log = get_logger("node_agent.spool")
+
+MAGIC = b"VPSPOOL1"
+HEADER = struct.Struct("<8sIIQQ")  # magic, record size, capacity, head, tail
+HEADER_SIZE = 64
+# subscription uuid, engine, interval_seconds, bytes_up, bytes_down, counter_seq, period_end_unix
+RECORD = struct.Struct("<16sB3xIQQQq")
+ENGINES = ("xray", "wireguard")
+
+
+def shippable(sample) -> bool:
+    """Whether the collector takes ``sample``: a UUID subscription id and a known engine."""
+    try:
+        uuid.UUID(sample.subscription_id)
+    except ValueError:
+        return False
+    return sample.engine in ENGINES
+
+
+class SampleSpool:
+    def __init__(self, path: str, node_id: str, *, capacity: int = 500_000, high_watermark: float = 0.8,
+                 flush_interval: float = 1.0, monotonic: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.node_id = node_id
+        self.capacity = capacity
+        self.high_watermark = high_watermark
+        self.flush_interval = flush_interval
+        self.monotonic = monotonic
+        self._dirty = False  # appended since the last msync
+        self._flushed = monotonic()
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, record_size, cap, self.head, self.tail = HEADER.unpack_from(self._mm, 0)
+        if (magic, record_size, cap) != (MAGIC, RECORD.size, capacity) or not 0 <= self.tail - self.head <= capacity:
+            if magic != b"\0" * 8:
+                log.warning("spool_reset", path=path, reason="format or capacity changed")
+            self.head = self.tail = 0
+            self._write_header()
+        self._above = False
+        self._gauges()
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def _write_header(self) -> None:
+        HEADER.pack_into(self._mm, 0, MAGIC, RECORD.size, self.capacity, self.head, self.tail)
+
+    def _gauges(self) -> None:
+        fill = len(self) / self.capacity
+        node_spool_fill_ratio.set(fill)
+        above = fill >= self.high_watermark
+        node_spool_high_watermark.set(1 if above else 0)
+        if above and not self._above:
+            log.warning("spool_high_watermark", records=len(self), capacity=self.capacity, fill=round(fill, 3))
+        self._above = above
+
+    def append(self, samples: Iterable) -> int:
+        """Spool ``TrafficSample``s; returns how many older records were overwritten to make room."""
+        mm, cap, tail = self._mm, self.capacity, self.tail
+        written = 0
+        for s in samples:
+            try:
+                sub = uuid.UUID(s.subscription_id).bytes
+                engine = ENGINES.index(s.engine)
+            except ValueError:
+                log.warning("spool_sample_skipped", subscription_id=s.subscription_id, engine=s.engine)
+                continue
+            RECORD.pack_into(mm, HEADER_SIZE + (tail % cap) * RECORD.size, sub, engine, s.interval_seconds,
+                             s.bytes_up, s.bytes_down, s.counter_seq, s.period_end_unix)
+            tail += 1
+            written += 1
+        if not written:
+            return 0
+        dropped = max(0, tail - self.head - cap)
+        self.head += dropped
+        self.tail = tail
+        self._write_header()
+        self._dirty = True
+        if self.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+        if dropped:
+            node_spool_dropped_total.inc(dropped)
+            log.warning("spool_overwrote_oldest", dropped=dropped)
+        self._gauges()
+        return dropped
+
+    def read(self, start: int, limit: int) -> list:
+        """Up to ``limit`` samples from absolute record ``start`` (clamped to ``head``) on; does not consume."""
+        mm, cap, node_id = self._mm, self.capacity, self.node_id
+        samples = []
+        for n in range(max(start, self.head), min(self.tail, max(start, self.head) + limit)):
+            sub, engine, interval, up, down, seq, end = RECORD.unpack_from(mm, HEADER_SIZE + (n % cap) * RECORD.size)
+            samples.append(pb.TrafficSample(
+                node_id=node_id, subscription_id=str(uuid.UUID(bytes=sub)), engine=ENGINES[engine], bytes_up=up,
+                bytes_down=down, interval_seconds=interval, counter_seq=seq, period_end_unix=end,
+            ))
+        return samples
+
+    def consume_to(self, position: int) -> None:
+        """Drop records before absolute ``position`` (confirmed by the collector)."""
+        position = min(position, self.tail)
+        if position > self.head:
+            self.head = position
+            self._write_header()
+            self._gauges()
+
+    def flush(self) -> None:
+        """Force appended records to disk (no-op if there are none)."""
+        if self._dirty:
+            self._mm.flush()
+            self._dirty = False
+        self._flushed = self.monotonic()
+
+    def close(self) -> None:
+        self._mm.flush()
+        self._mm.close()
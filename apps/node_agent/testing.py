@@ -0,0 +1,278 @@
+"""In-memory stand-ins for the node agent's kernel and daemon interfaces (tests, benchmarks)."""
+import asyncio
+import time
+import uuid
+from typing import Callable
+
+import grpc
+
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+from packages.common.vpnpanel_common.proto import node_control_pb2_grpc
+from packages.common.vpnpanel_common.proto import xray_handler_pb2 as xh
+from packages.common.vpnpanel_common.proto import xray_handler_pb2_grpc
+from packages.common.vpnpanel_common.proto import xray_stats_pb2 as xs
+from packages.common.vpnpanel_common.proto import xray_stats_pb2_grpc
+
+from .wireguard import PeerChange, PeerState
+
+
+class FakeNetlink:
+    """``WireGuardNetlink`` double with the kernel's ``WG_CMD_SET_DEVICE`` semantics.
+
+    An allowed IP belongs to at most one peer: giving it to another peer moves
+    it. ``dumps`` and ``messages`` (peers per set message) record the traffic.
+    """
+
+    def __init__(self, peers=()):
+        self.peers: dict[str, PeerState] = {}
+        self._owner: dict[str, str] = {}  # allowed IP -> public key
+        self.dumps = 0
+        self.messages: list[int] = []
+        for p in peers:
+            self.set_peers("", [PeerChange(p.public_key, allowed_ips=tuple(p.allowed_ips),
+                                           persistent_keepalive=p.persistent_keepalive)])
+        self.messages.clear()
+
+    def get_peers(self, interface: str) -> list[PeerState]:
+        self.dumps += 1
+        return [PeerState(p.public_key, set(p.allowed_ips), p.persistent_keepalive, p.rx_bytes, p.tx_bytes,
+                          p.last_handshake) for p in self.peers.values()]
+
+    def set_peers(self, interface: str, changes: list[PeerChange]) -> None:
+        self.messages.append(len(changes))
+        for c in changes:
+            if c.remove:
+                state = self.peers.pop(c.public_key, None)
+                for ip in state.allowed_ips if state else ():
+                    del self._owner[ip]
+                continue
+            state = self.peers.setdefault(c.public_key, PeerState(c.public_key))
+            for ip in state.allowed_ips:
+                del self._owner[ip]
+            for ip in c.allowed_ips:
+                previous = self._owner.get(ip)
+                if previous is not None and previous != c.public_key:
+                    self.peers[previous].allowed_ips.discard(ip)
+                self._owner[ip] = c.public_key
+            state.allowed_ips = set(c.allowed_ips)
+            state.persistent_keepalive = c.persistent_keepalive
+
+    def traffic(self, public_key: str, rx: int, tx: int, handshake: float) -> None:
+        state = self.peers[public_key]
+        state.rx_bytes += rx
+        state.tx_bytes += tx
+        state.last_handshake = handshake
+
+
+class FakeXrayStats(xray_stats_pb2_grpc.StatsServiceServicer):
+    """Xray ``StatsService`` on a local port, with user counters the test drives.
+
+    ``restart`` drops every counter and moves the start time, like restarting
+    Xray. ``queries`` counts ``QueryStats`` calls.
+    """
+
+    def __init__(self, *, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.counters: dict[str, int] = {}
+        self.started = clock()
+        self.queries = 0
+        self._server = None
+
+    def traffic(self, email: str, up: int, down: int) -> None:
+        for direction, n in (("uplink", up), ("downlink", down)):
+            name = f"user>>>{email}>>>traffic>>>{direction}"
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def remove(self, email: str) -> None:
+        for direction in ("uplink", "downlink"):
+            self.counters.pop(f"user>>>{email}>>>traffic>>>{direction}", None)
+
+    def restart(self) -> None:
+        self.counters.clear()
+        self.started = self.clock()
+
+    async def GetStats(self, request, context):
+        if request.name not in self.counters:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"{request.name} not found")
+        stat = xs.Stat(name=request.name, value=self.counters[request.name])
+        if request.reset:
+            self.counters[request.name] = 0
+        return xs.GetStatsResponse(stat=stat)
+
+    async def QueryStats(self, request, context):
+        self.queries += 1
+        names = [n for n in self.counters if request.pattern in n]
+        res = xs.QueryStatsResponse(stat=[xs.Stat(name=n, value=self.counters[n]) for n in names])
+        if request.reset:
+            for n in names:
+                self.counters[n] = 0
+        return res
+
+    async def GetSysStats(self, request, context):
+        return xs.SysStatsResponse(Uptime=int(self.clock() - self.started))
+
+    async def start(self) -> str:
+        """Serve on an ephemeral localhost port; returns its address."""
+        self._server = grpc.aio.server()
+        xray_stats_pb2_grpc.add_StatsServiceServicer_to_server(self, self._server)
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        await self._server.start()
+        return f"127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            await self._server.stop(None)
+
+
+class FakeCollector(node_control_pb2_grpc.TrafficIngestServicer):
+    """``TrafficIngest`` on a local port that keeps every sample and acks each one.
+
+    Like the real collector, it aborts the stream on a subscription id that is
+    not a UUID. ``stop`` / ``start`` again (same port) simulate a collector outage.
+    """
+
+    def __init__(self):
+        self.samples: list = []
+        self.streams = 0
+        self.port = 0
+        self._server = None
+
+    async def StreamTraffic(self, request_iterator, context):
+        self.streams += 1
+        async for sample in request_iterator:
+            try:
+                uuid.UUID(sample.subscription_id)
+            except ValueError:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"badly formed subscription id {sample.subscription_id!r}")
+            self.samples.append(sample)
+            yield pb.TrafficIngestAck(accepted=True, message="persisted", persisted=1)
+
+    async def start(self) -> str:
+        self._server = grpc.aio.server()
+        node_control_pb2_grpc.add_TrafficIngestServicer_to_server(self, self._server)
+        self.port = self._server.add_insecure_port(f"127.0.0.1:{self.port}")
+        await self._server.start()
+        return f"127.0.0.1:{self.port}"
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            await self._server.stop(None)
+            self._server = None
+
+
+class FakeNodeControl(node_control_pb2_grpc.NodeControlServicer):
+    """``NodeControl`` on a local port sending the commands the test queues with ``send``.
+
+    ``hellos`` and ``results`` record the agent's ``NodeHello``s and
+    ``EnforcementResult``s. ``stop`` / ``start`` again (same port) simulate an outage.
+    """
+
+    def __init__(self):
+        self.hellos: list = []
+        self.results: list = []
+        self.port = 0
+        self._commands: asyncio.Queue = asyncio.Queue()
+        self._server = None
+
+    def send(self, command: pb.EnforcementCommand) -> None:
+        self._commands.put_nowait(command)
+
+    async def StreamEnforcements(self, request, context):
+        self.hellos.append(request)
+        while True:
+            yield await self._commands.get()
+
+    async def ReportEnforcementResult(self, request, context):
+        self.results.append(request)
+        return pb.ConfigAck(node_id=request.node_id, revision=request.revision, success=True)
+
+    async def start(self) -> str:
+        self._server = grpc.aio.server()
+        node_control_pb2_grpc.add_NodeControlServicer_to_server(self, self._server)
+        self.port = self._server.add_insecure_port(f"127.0.0.1:{self.port}")
+        await self._server.start()
+        return f"127.0.0.1:{self.port}"
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            await self._server.stop(None)
+            self._server = None
+
+
+class FakeXrayHandler(xray_handler_pb2_grpc.HandlerServiceServicer):
+    """Xray ``HandlerService`` on a local port, holding each inbound's clients.
+
+    Errors carry Xray's own messages ("handler not found", "User x already
+    exists.", "User x not found."). ``alters`` counts ``AlterInbound`` calls
+    and ``max_in_flight`` is the most that were running at once; ``latency``
+    delays each one. ``list_users=False`` behaves like a core without
+    ``GetInboundUsers``. A ``FakeXrayStats`` passed as ``stats`` is served on
+    the same port, like Xray's single API listener; ``restart`` then drops
+    every client and moves its start time.
+    """
+
+    def __init__(self, tags=(), *, latency: float = 0.0, list_users: bool = True,
+                 stats: FakeXrayStats | None = None):
+        self.inbounds: dict[str, dict[str, xh.User]] = {tag: {} for tag in tags}
+        self.latency = latency
+        self.list_users = list_users
+        self.stats = stats
+        self.alters = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._server = None
+
+    async def AlterInbound(self, request, context):
+        self.alters += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            users = self.inbounds.get(request.tag)
+            if users is None:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {request.tag}")
+            if request.operation.type.endswith(".AddUserOperation"):
+                user = xh.AddUserOperation.FromString(request.operation.value).user
+                if user.email in users:
+                    await context.abort(grpc.StatusCode.UNKNOWN, f"User {user.email} already exists.")
+                users[user.email] = user
+            elif request.operation.type.endswith(".RemoveUserOperation"):
+                email = xh.RemoveUserOperation.FromString(request.operation.value).email
+                if users.pop(email, None) is None:
+                    await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+            else:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"unknown operation {request.operation.type}")
+            return xh.AlterInboundResponse()
+        finally:
+            self.in_flight -= 1
+
+    def restart(self) -> None:
+        for users in self.inbounds.values():
+            users.clear()
+        if self.stats is not None:
+            self.stats.restart()
+
+    async def GetInboundUsers(self, request, context):
+        if not self.list_users:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, "Method not implemented!")
+        users = self.inbounds.get(request.tag)
+        if users is None:
+            await context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {request.tag}")
+        if request.email:
+            return xh.GetInboundUserResponse(users=[users[request.email]] if request.email in users else [])
+        return xh.GetInboundUserResponse(users=list(users.values()))
+
+    async def start(self) -> str:
+        """Serve on an ephemeral localhost port; returns its address."""
+        self._server = grpc.aio.server()
+        xray_handler_pb2_grpc.add_HandlerServiceServicer_to_server(self, self._server)
+        if self.stats is not None:
+            xray_stats_pb2_grpc.add_StatsServiceServicer_to_server(self.stats, self._server)
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        await self._server.start()
+        return f"127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            await self._server.stop(None)
@@ -0,0 +1,149 @@
+"""Ships traffic samples to the collector over ``TrafficIngest.StreamTraffic``.
+
+While the stream is up, samples go straight onto it and are held in memory
+until the collector acks them (``TrafficIngestAck.persisted`` counts samples
+in the order they were sent). While it is down, they go to the
+``SampleSpool``, and so do the live samples still unacked when a stream breaks.
+
+After reconnecting, the spool is replayed first, ``replay_batch`` records per
+read with at most two batches unacked. Records are dropped from the spool only
+once acked, so a crash during replay resends them, and the collector's dedupe
+key absorbs the duplicates. Samples submitted while the replay is still
+running are appended to the spool, which keeps them in order behind it.
+
+Samples the collector would reject (a subscription id that is not a UUID,
+e.g. an Xray client the agent does not manage, or an unknown engine) are
+dropped in ``submit``: the collector aborts the whole stream on one of them.
+
+The collector acks a stream's samples in the order they were sent, even when
+it coalesces them, so ``persisted`` counts are a prefix of what is in flight:
+first the replayed spool records, then ``_live``.
+
+The last ``preferred_phase_ms`` the collector advertised is kept in
+``preferred_phase`` (seconds) for the sampling schedule.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Iterable
+
+import grpc
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import node_spool_replayed_total
+
+from .spool import SampleSpool, shippable
+
+log = get_logger("node_agent.traffic")
+
+
+class TrafficShipper:
+    def __init__(self, stub: Any, spool: SampleSpool, *, replay_batch: int = 5000, retry_base: float = 1.0,
+                 retry_max: float = 30.0):
+        self.stub = stub  # node_control_pb2_grpc.TrafficIngestStub
+        self.spool = spool
+        self.replay_batch = replay_batch
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._queue: asyncio.Queue | None = None  # requests of the open stream; None while down
+        self._live: deque = deque()  # sent on the open stream after the spool, unacked
+        self._sent_to = 0  # absolute spool record numbers sent / acked on the open stream
+        self._acked_to = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.preferred_phase: float | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._queue is not None
+
+    def submit(self, samples: Iterable) -> None:
+        samples = list(samples)
+        valid = [s for s in samples if shippable(s)]
+        if len(valid) < len(samples):
+            bad = next(s for s in samples if not shippable(s))
+            log.warning("traffic_samples_skipped", count=len(samples) - len(valid),
+                        subscription_id=bad.subscription_id, engine=bad.engine)
+            samples = valid
+        if self._queue is None or self._sent_to < self.spool.tail:
+            self.spool.append(samples)  # down, or the replay is not through yet
+            self._wakeup.set()
+            return
+        for s in samples:
+            self._queue.put_nowait(s)
+            self._live.append(s)
+
+    async def _requests(self, queue: asyncio.Queue):
+        while True:
+            yield await queue.get()
+
+    async def _replay(self, queue: asyncio.Queue) -> None:
+        while True:
+            self._sent_to = max(self._sent_to, self.spool.head)  # the ring may have overwritten unsent records
+            if self._sent_to < self.spool.tail and self._sent_to - self._acked_to < 2 * self.replay_batch:
+                batch = self.spool.read(self._sent_to, self.replay_batch)
+                for s in batch:
+                    queue.put_nowait(s)
+                self._sent_to += len(batch)
+                node_spool_replayed_total.inc(len(batch))
+                continue
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def _ack(self, persisted: int) -> None:
+        spooled = min(persisted, self._sent_to - self._acked_to)
+        if spooled:
+            self._acked_to += spooled
+            self.spool.consume_to(self._acked_to)
+        for _ in range(min(persisted - spooled, len(self._live))):
+            self._live.popleft()
+        self._wakeup.set()
+
+    async def _stream(self) -> int:
+        """One stream until it ends; returns how many acks it received."""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._sent_to = self._acked_to = self.spool.head
+        call = self.stub.StreamTraffic(self._requests(queue))
+        self._queue = queue
+        replay = asyncio.create_task(self._replay(queue))
+        if len(self.spool):
+            log.info("spool_replay_started", records=len(self.spool))
+        acks = 0
+        try:
+            async for ack in call:
+                acks += 1
+                self._ack(ack.persisted)
+                if ack.HasField("preferred_phase_ms"):
+                    self.preferred_phase = ack.preferred_phase_ms / 1000
+        finally:
+            replay.cancel()
+            call.cancel()
+            self._queue = None
+            if self._live:
+                self.spool.append(self._live)
+                self._live.clear()
+        return acks
+
+    async def run(self) -> None:
+        delay = self.retry_base
+        while True:
+            try:
+                if await self._stream():
+                    delay = self.retry_base
+                log.info("traffic_stream_closed", spooled=len(self.spool))
+            except grpc.aio.AioRpcError as e:
+                log.warning("traffic_stream_down", code=e.code().name, spooled=len(self.spool), retry_in=delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,160 @@
+"""Xray traffic sampler for the node agent.
+
+Once per interval the sampler reads every user counter with a single
+``QueryStats(pattern="user>>>", reset=false)`` call, plus ``GetSysStats`` for
+Xray's uptime. The agent never resets counters: with cumulative counters, a
+round whose samples are lost is covered by the next delta instead of vanishing.
+
+Deltas are taken against the previous round kept in a ``CounterTable``: two
+``array('q')`` columns (uplink, downlink) indexed by a slot per user, so 10k+
+users cost a few hundred KB and no per-user objects. A user whose counters went
+down was re-added (or Xray restarted) and counts from zero. Xray's start time
+(now - uptime) moving forward means it restarted, and then every counter counts
+from zero, including those that already grew past their old value. "now" is
+the monotonic clock there, so an NTP step of the wall clock is not taken for
+a restart; wall time only dates the samples.
+
+The first round after the agent starts is only a baseline, because its counters
+include traffic reported before the restart; users appearing in later rounds
+count from zero. Non-zero deltas become ``TrafficSample``s. A round's samples
+share one ``counter_seq``, which never decreases: it is at least the wall
+clock second, so it also keeps growing across agent restarts, and the
+collector's dedupe key stays unique.
+"""
+import time
+from array import array
+from typing import Callable, Iterable, Mapping
+
+import grpc
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+from packages.common.vpnpanel_common.proto import xray_stats_pb2 as xs
+from packages.common.vpnpanel_common.proto import xray_stats_pb2_grpc
+
+log = get_logger("node_agent.xray_stats")
+
+USER_PATTERN = "user>>>"
+RESTART_TOLERANCE_SECONDS = 2.0  # uptime has whole-second resolution
+
+
+def user_counters(stats: Iterable) -> dict[str, tuple[int, int]]:
+    """``user>>>{email}>>>traffic>>>uplink|downlink`` stats -> {email: (uplink, downlink)}."""
+    counters: dict[str, list[int]] = {}
+    for stat in stats:
+        parts = stat.name.split(">>>")
+        if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+            continue
+        pair = counters.setdefault(parts[1], [0, 0])
+        if parts[3] == "uplink":
+            pair[0] = stat.value
+        elif parts[3] == "downlink":
+            pair[1] = stat.value
+    return {email: (up, down) for email, (up, down) in counters.items()}
+
+
+class CounterTable:
+    """Last seen cumulative counters per user, array-backed."""
+
+    def __init__(self):
+        self.slots: dict[str, int] = {}
+        self.up = array("q")
+        self.down = array("q")
+        self._free: list[int] = []
+        self.resets = 0
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def _slot(self, email: str) -> int:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self.up)
+            self.up.append(0)
+            self.down.append(0)
+        self.slots[email] = slot
+        return slot
+
+    def advance(self, counters: Mapping[str, tuple[int, int]], *, baseline: bool = False,
+                restarted: bool = False) -> list[tuple[str, int, int]]:
+        """Store this round's counters; returns (email, uplink delta, downlink delta) for users with traffic.
+
+        ``baseline``: users not seen before count from their current value, not
+        from zero. ``restarted``: every user counts from zero.
+        """
+        up, down, slots = self.up, self.down, self.slots
+        deltas = []
+        for email, (u, d) in counters.items():
+            slot = slots.get(email)
+            if slot is None:
+                slot = self._slot(email)
+                prev_u, prev_d = (u, d) if baseline else (0, 0)
+            elif restarted:
+                prev_u = prev_d = 0
+            else:
+                prev_u, prev_d = up[slot], down[slot]
+                if u < prev_u or d < prev_d:  # counter reset: the user was re-added
+                    self.resets += 1
+                    prev_u = prev_d = 0
+            up[slot], down[slot] = u, d
+            if u != prev_u or d != prev_d:
+                deltas.append((email, u - prev_u, d - prev_d))
+        if len(slots) > len(counters):  # users removed from Xray
+            for email in slots.keys() - counters.keys():
+                self._free.append(slots.pop(email))
+        return deltas
+
+
+class XrayStatsClient:
+    """Xray ``StatsService`` over its local API listener (``127.0.0.1:port`` or ``unix:/path``)."""
+
+    def __init__(self, address: str, *, timeout: float = 10.0):
+        self.channel = grpc.aio.insecure_channel(address)
+        self.stub = xray_stats_pb2_grpc.StatsServiceStub(self.channel)
+        self.timeout = timeout
+
+    async def query(self) -> tuple[int, list]:
+        """(uptime seconds, every user traffic stat)."""
+        sys_stats = await self.stub.GetSysStats(xs.SysStatsRequest(), timeout=self.timeout)
+        res = await self.stub.QueryStats(xs.QueryStatsRequest(pattern=USER_PATTERN, reset=False), timeout=self.timeout)
+        return sys_stats.Uptime, list(res.stat)
+
+    async def close(self) -> None:
+        await self.channel.close()
+
+
+class XraySampler:
+    def __init__(self, client: XrayStatsClient, node_id: str, *, clock: Callable[[], float] = time.time,
+                 monotonic: Callable[[], float] = time.monotonic):
+        self.client = client
+        self.node_id = node_id
+        self.clock = clock
+        self.monotonic = monotonic
+        self.table = CounterTable()
+        self.counter_seq = 0
+        self._started: float | None = None  # Xray start time (monotonic clock) seen last round
+        self._last: float | None = None  # monotonic time of the last round
+
+    async def sample(self) -> list:
+        """One round: query Xray, return ``TrafficSample``s for the users with traffic since the last round."""
+        uptime, stats = await self.client.query()
+        now, mono = self.clock(), self.monotonic()
+        started = mono - uptime
+        restarted = self._started is not None and started > self._started + RESTART_TOLERANCE_SECONDS
+        if restarted:
+            log.warning("xray_restart_detected", uptime=uptime)
+        baseline = self._last is None
+        deltas = self.table.advance(user_counters(stats), baseline=baseline, restarted=restarted)
+        interval = 0 if baseline else max(0, round(mono - self._last))
+        self._started, self._last = started, mono
+        if not deltas:
+            return []
+        self.counter_seq = max(self.counter_seq + 1, int(now))
+        # Xray client emails are the subscription ids (SubscriptionEngineConfig.username)
+        return [
+            pb.TrafficSample(node_id=self.node_id, subscription_id=email, engine="xray", bytes_up=up,
+                             bytes_down=down, interval_seconds=interval, counter_seq=self.counter_seq,
+                             period_end_unix=int(now))
+            for email, up, down in deltas
+        ]
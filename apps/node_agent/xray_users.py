@@ -0,0 +1,303 @@
+"""Xray client sync for the node agent via ``HandlerService.AlterInbound``.
+
+The driver holds the desired state from the control plane: the node's inbounds
+(tag -> protocol) and its active Xray subscriptions, from a
+``FullNodeConfigPush`` or a ``NodeConfigDelta``. Every active subscription is
+a client of every inbound, and its Xray email is the subscription id (the key
+the stats sampler reports under). Suspended, exhausted and removed
+subscriptions have no client: removing it is how the node enforces them.
+
+``sync`` diffs per inbound tag. Both sides are ``{email: 64-bit digest of
+(protocol, secret, flow)}``, so a change set is two dict passes, and 20k users
+per tag cost a couple of MB. Removals are sent first (including the old
+version of changed users), then additions. Each user is one ``AlterInbound``
+call, with at most ``max_in_flight`` outstanding. A user whose call failed
+keeps its previous digest, so the next sync retries it.
+
+Clients added through the API live only in Xray's memory, so an Xray restart
+drops them all. Each sync first reads Xray's uptime (``GetSysStats``), as the
+stats sampler does. If Xray's start time on the monotonic clock moved forward,
+the applied state is discarded and every client is added again. Without the
+stats service, cores that can list users are re-listed on every sync.
+
+After an agent restart, what Xray already has is unknown. ``refresh`` asks
+``GetInboundUsers`` where the core supports it. Otherwise an add answered with
+"already exists" becomes remove + add. A subscription the control plane
+reports as suspended, exhausted or removed gets a remove on every unlisted
+inbound even if this agent never added it ("not found" counts as done), so a
+client left over from before the restart cannot keep access. A client whose
+subscription the control plane no longer mentions at all cannot be found on
+such cores; it is removed when Xray restarts. The inbounds themselves come
+from Xray's config file; the driver only manages their clients.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+import grpc
+
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.proto import xray_handler_pb2 as xh
+from packages.common.vpnpanel_common.proto import xray_handler_pb2_grpc
+from packages.common.vpnpanel_common.proto import xray_stats_pb2 as xs
+from packages.common.vpnpanel_common.proto import xray_stats_pb2_grpc
+
+from .xray_stats import RESTART_TOLERANCE_SECONDS
+
+log = get_logger("node_agent.xray_users")
+
+ACCOUNT_TYPES = {
+    "vless": ("xray.proxy.vless.Account", xh.VlessAccount),
+    "vmess": ("xray.proxy.vmess.Account", xh.VmessAccount),
+    "trojan": ("xray.proxy.trojan.Account", xh.TrojanAccount),
+}
+UNKNOWN = 0  # digest of a client that may exist in Xray with unknown settings
+ADD_USER = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER = "xray.app.proxyman.command.RemoveUserOperation"
+
+
+def account(protocol: str, secret: str, flow: str = "") -> xh.TypedMessage:
+    type_name, cls = ACCOUNT_TYPES[protocol]
+    if protocol == "vless":
+        msg = cls(id=secret, flow=flow, encryption="none")
+    elif protocol == "vmess":
+        msg = cls(id=secret)
+    else:
+        msg = cls(password=secret)
+    return xh.TypedMessage(type=type_name, value=msg.SerializeToString())
+
+
+def digest(protocol: str, secret: str, flow: str = "") -> int:
+    return int.from_bytes(hashlib.blake2b(f"{protocol}\0{secret}\0{flow}".encode(), digest_size=8).digest(), "big")
+
+
+def _account_digest(typed: xh.TypedMessage) -> int:
+    """Digest of an account as ``GetInboundUsers`` returns it (``UNKNOWN`` if the type is not one we manage)."""
+    for protocol, (type_name, cls) in ACCOUNT_TYPES.items():
+        if typed.type == type_name:
+            msg = cls.FromString(typed.value)
+            if protocol == "trojan":
+                return digest(protocol, msg.password)
+            return digest(protocol, msg.id, msg.flow if protocol == "vless" else "")
+    return UNKNOWN
+
+
+class XrayHandlerClient:
+    """Xray ``HandlerService`` (and its uptime) over the local API listener (``127.0.0.1:port`` or ``unix:/path``)."""
+
+    def __init__(self, address: str, *, timeout: float = 10.0):
+        self.channel = grpc.aio.insecure_channel(address)
+        self.stub = xray_handler_pb2_grpc.HandlerServiceStub(self.channel)
+        self.stats = xray_stats_pb2_grpc.StatsServiceStub(self.channel)
+        self.timeout = timeout
+
+    async def uptime(self) -> int | None:
+        """Xray's uptime in seconds, or None if its stats service is not enabled."""
+        try:
+            res = await self.stats.GetSysStats(xs.SysStatsRequest(), timeout=self.timeout)
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                return None
+            raise
+        return res.Uptime
+
+    async def _alter(self, tag: str, type_name: str, operation) -> None:
+        op = xh.TypedMessage(type=type_name, value=operation.SerializeToString())
+        await self.stub.AlterInbound(xh.AlterInboundRequest(tag=tag, operation=op), timeout=self.timeout)
+
+    async def add_user(self, tag: str, email: str, account: xh.TypedMessage) -> None:
+        await self._alter(tag, ADD_USER, xh.AddUserOperation(user=xh.User(email=email, account=account)))
+
+    async def remove_user(self, tag: str, email: str) -> None:
+        await self._alter(tag, REMOVE_USER, xh.RemoveUserOperation(email=email))
+
+    async def users(self, tag: str) -> list | None:
+        """Clients of an inbound, or None if the core cannot list them."""
+        try:
+            res = await self.stub.GetInboundUsers(xh.GetInboundUserRequest(tag=tag), timeout=self.timeout)
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                return None
+            raise
+        return list(res.users)
+
+    async def close(self) -> None:
+        await self.channel.close()
+
+
+@dataclass
+class SyncResult:
+    added: int = 0
+    removed: int = 0
+    failed: int = 0
+    calls: int = 0
+    seconds: float = 0.0
+
+
+class XrayUserDriver:
+    def __init__(self, client: XrayHandlerClient, *, max_in_flight: int = 64,
+                 monotonic: Callable[[], float] = time.monotonic):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.monotonic = monotonic
+        self.inbounds: dict[str, tuple[str, str]] = {}  # tag -> (protocol, vless flow)
+        self.users: dict[str, str] = {}  # email (subscription id) -> secret, active subscriptions only
+        self.applied: dict[str, dict[str, int]] = {}  # tag -> {email: digest} as Xray has it
+        self._listed: set[str] = set()  # tags whose applied map came from GetInboundUsers
+        self.can_list: bool | None = None  # whether the core has GetInboundUsers; None until asked
+        self._started: float | None = None  # Xray start time (monotonic clock) seen last sync
+
+    def set_inbounds(self, inbounds: Iterable) -> None:
+        self.inbounds = {}
+        for inbound in inbounds:
+            if inbound.protocol not in ACCOUNT_TYPES:
+                log.warning("xray_inbound_unsupported", tag=inbound.tag, protocol=inbound.protocol)
+                continue
+            settings = json.loads(inbound.settings_json) if inbound.settings_json else {}
+            self.inbounds[inbound.tag] = (inbound.protocol, str(settings.get("flow", "")))
+
+    def load(self, full) -> None:
+        """Desired state from a ``FullNodeConfigPush`` (replaces the current one)."""
+        self.set_inbounds(full.xray_inbounds)
+        self.users = {}
+        self.update_users(full.subscriptions, ())
+
+    def update(self, delta) -> None:
+        """Apply a ``NodeConfigDelta`` to the desired state."""
+        if delta.inbounds_changed:
+            self.set_inbounds(delta.xray_inbounds)
+        self.update_users(delta.upserts, delta.removed)
+
+    def update_users(self, upserts: Iterable, removed: Iterable) -> None:
+        for key in removed:
+            if key.engine == "xray":
+                self._revoke(key.subscription_id)
+        for entry in upserts:
+            if entry.engine != "xray":
+                continue
+            if entry.status == "active" and entry.secret:
+                self.users[entry.subscription_id] = entry.secret
+            else:
+                self._revoke(entry.subscription_id)
+
+    def _revoke(self, email: str) -> None:
+        self.users.pop(email, None)
+        if self.can_list:
+            return
+        # Xray may hold a client this agent does not know about (added before it
+        # restarted): have plan() remove it wherever the state was not listed
+        for tag in self.inbounds.keys() - self._listed:
+            self.applied.setdefault(tag, {}).setdefault(email, UNKNOWN)
+
+    async def _check_restart(self) -> None:
+        """Forget the applied state if Xray restarted since the last sync (its API clients are gone)."""
+        try:
+            uptime = await self.client.uptime()
+        except grpc.aio.AioRpcError as e:
+            log.warning("xray_uptime_failed", code=e.code().name)
+            uptime = None
+        if uptime is None:  # cannot tell: re-list where the core can
+            self._listed.clear()
+            return
+        started = self.monotonic() - uptime
+        if self._started is not None and started > self._started + RESTART_TOLERANCE_SECONDS:
+            log.warning("xray_restart_detected", uptime=uptime, clients=sum(map(len, self.applied.values())))
+            self.applied.clear()
+            self._listed.clear()
+        self._started = started
+
+    async def refresh(self) -> None:
+        """Learn the clients Xray has on inbounds not listed yet (no-op on cores without ``GetInboundUsers``)."""
+        for tag in self.inbounds.keys() - self._listed:
+            try:
+                users = await self.client.users(tag)
+            except grpc.aio.AioRpcError as e:  # e.g. the inbound is not in Xray's config (yet)
+                log.warning("xray_inbound_users_failed", tag=tag, details=e.details())
+                continue
+            if users is None:
+                self.can_list = False
+                return
+            self.can_list = True
+            self.applied[tag] = {u.email: _account_digest(u.account) for u in users}
+            self._listed.add(tag)
+
+    def plan(self) -> tuple[list, list]:
+        """(removals, additions) as ``(tag, email)`` pairs."""
+        removals, additions = [], []
+        for tag in self.inbounds.keys() | self.applied.keys():
+            have = self.applied.get(tag, {})
+            desired = {}
+            if tag in self.inbounds:
+                protocol, flow = self.inbounds[tag]
+                desired = {email: digest(protocol, secret, flow) for email, secret in self.users.items()}
+            removals.extend((tag, email) for email, d in have.items() if desired.get(email) != d)
+            additions.extend((tag, email) for email, d in desired.items() if have.get(email) != d)
+        return removals, additions
+
+    async def _each(self, ops: list, call) -> None:
+        pending = iter(ops)
+
+        async def worker() -> None:
+            for op in pending:
+                await call(*op)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.max_in_flight, len(ops)))))
+
+    async def sync(self) -> SyncResult:
+        started = time.perf_counter()
+        await self._check_restart()
+        await self.refresh()
+        removals, additions = self.plan()
+        result = SyncResult()
+        errors: list[str] = []
+
+        def failed(e: grpc.aio.AioRpcError) -> None:
+            result.failed += 1
+            if len(errors) < 3:
+                errors.append(e.details() or e.code().name)
+
+        async def remove(tag: str, email: str) -> None:
+            result.calls += 1
+            try:
+                await self.client.remove_user(tag, email)
+            except grpc.aio.AioRpcError as e:
+                details = e.details() or ""
+                # gone already, or the inbound was dropped from Xray along with its clients
+                if "not found" not in details:
+                    return failed(e)
+            self.applied[tag].pop(email, None)
+            result.removed += 1
+
+        async def add(tag: str, email: str) -> None:
+            protocol, flow = self.inbounds[tag]
+            secret = self.users[email]
+            result.calls += 1
+            try:
+                await self.client.add_user(tag, email, account(protocol, secret, flow))
+            except grpc.aio.AioRpcError as e:
+                if "already exists" not in (e.details() or ""):
+                    return failed(e)
+                try:  # left over from before an agent restart, possibly with another secret
+                    result.calls += 2
+                    await self.client.remove_user(tag, email)
+                    await self.client.add_user(tag, email, account(protocol, secret, flow))
+                except grpc.aio.AioRpcError as e:
+                    return failed(e)
+            self.applied.setdefault(tag, {})[email] = digest(protocol, secret, flow)
+            result.added += 1
+
+        await self._each(removals, remove)
+        await self._each(additions, add)
+        for tag in list(self.applied):
+            if tag not in self.inbounds and not self.applied[tag]:
+                del self.applied[tag]
+                self._listed.discard(tag)
+        result.seconds = time.perf_counter() - started
+        if removals or additions:
+            log_fn = log.warning if result.failed else log.info
+            log_fn("xray_users_synced", added=result.added, removed=result.removed, failed=result.failed,
+                   calls=result.calls, seconds=round(result.seconds, 3), errors=errors or None)
+        return result
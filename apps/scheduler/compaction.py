@@ -0,0 +1,149 @@
+"""Compaction of closed hourly rollup days into ``traffic_rollups_daily`` and ``_monthly``.
+
+A day is closed once it ended ``grace_hours`` ago and no event from it is still
+waiting above the hourly rollup watermark. Closed days are compacted in
+ascending order; a watermark row (``rollup_watermarks.name = 'traffic_daily'``,
+``last_id = date.toordinal()``) records the last one. Daily rows are rebuilt
+from the hourly rows of the day and monthly rows from the daily rows of the
+month, keyed like the hourly tier by (user, node), both with replace semantics,
+so reruns are idempotent. Hourly partitions are only dropped at or below that
+watermark (see ``partitions.py``). Events arriving later for a compacted day
+are added to its daily and monthly rows by the hourly rollup instead.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from packages.common.vpnpanel_common.db.buckets import month_bucket
+from packages.common.vpnpanel_common.db.series import tenant_of
+from packages.common.vpnpanel_common.db.models import (
+    DAILY_ROLLUP_WATERMARK,
+    HOURLY_ROLLUP_WATERMARK,
+    TrafficEvent,
+    TrafficRollupDaily,
+    TrafficRollupHourly,
+    TrafficRollupMonthly,
+)
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import traffic_compaction_days_total
+
+from .rollups import _set_watermark, get_watermark
+
+log = get_logger("scheduler.compaction")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    """First day of the month ``months`` away from ``day``'s month."""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+async def _closed_through(session: AsyncSession, now: datetime, grace_hours: int) -> date:
+    closed = (now - timedelta(hours=grace_hours)).date() - timedelta(days=1)
+    hourly_wm = await get_watermark(session, HOURLY_ROLLUP_WATERMARK)
+    oldest_pending = (await session.execute(
+        select(func.min(TrafficEvent.event_time)).where(TrafficEvent.id > hourly_wm)
+    )).scalar()
+    if oldest_pending is not None:
+        if oldest_pending.tzinfo is None:
+            oldest_pending = oldest_pending.replace(tzinfo=timezone.utc)
+        closed = min(closed, oldest_pending.astimezone(timezone.utc).date() - timedelta(days=1))
+    return closed
+
+
+def _replace_upsert(dialect_name: str, table, keys: list[str], grouped):
+    source = select(
+        *(grouped.c[k] for k in keys), tenant_of(grouped.c.user_id),
+        grouped.c.bytes_up, grouped.c.bytes_down, literal(datetime.now(timezone.utc), table.c.created_at.type),
+    ).where(literal(True))  # SQLite needs a WHERE to parse INSERT ... SELECT ... ON CONFLICT
+    dialect_insert = pg_insert if dialect_name == "postgresql" else sqlite_insert
+    stmt = dialect_insert(table).from_select([*keys, "tenant_id", "bytes_up", "bytes_down", "created_at"], source)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            "bytes_up": stmt.excluded.bytes_up,
+            "bytes_down": stmt.excluded.bytes_down,
+            "tenant_id": func.coalesce(stmt.excluded.tenant_id, table.c.tenant_id),
+        },
+    )
+
+
+def _daily_upsert(dialect_name: str, first: date, last: date):
+    h = TrafficRollupHourly
+    grouped = (
+        select(h.day, h.user_id, h.node_id, func.sum(h.bytes_up).label("bytes_up"), func.sum(h.bytes_down).label("bytes_down"))
+        .where(h.day >= first, h.day <= last)
+        .group_by(h.day, h.user_id, h.node_id)
+        .subquery("g")
+    )
+    return _replace_upsert(dialect_name, TrafficRollupDaily.__table__, ["day", "user_id", "node_id"], grouped)
+
+
+def _monthly_upsert(dialect_name: str, first: date, last: date):
+    d = TrafficRollupDaily
+    month = month_bucket(d.day, dialect_name).label("month")
+    grouped = (
+        select(month, d.user_id, d.node_id, func.sum(d.bytes_up).label("bytes_up"), func.sum(d.bytes_down).label("bytes_down"))
+        .where(d.day >= month_start(first), d.day < add_months(last, 1))
+        .group_by(month, d.user_id, d.node_id)
+        .subquery("g")
+    )
+    return _replace_upsert(dialect_name, TrafficRollupMonthly.__table__, ["month", "user_id", "node_id"], grouped)
+
+
+async def compact_rollups(
+    session_factory: async_sessionmaker,
+    *,
+    grace_hours: int = 6,
+    chunk_days: int = 7,
+    daily_retention_months: int | None = None,
+    now: datetime | None = None,
+) -> int:
+    """Compact every closed, not yet compacted day; returns the number of days compacted."""
+    now = now or datetime.now(timezone.utc)
+    compacted = 0
+    while True:
+        async with session_factory() as session:
+            dialect_name = (await session.connection()).dialect.name
+            wm = await get_watermark(session, DAILY_ROLLUP_WATERMARK, for_update=True)
+            if wm:
+                first = date.fromordinal(wm) + timedelta(days=1)
+            else:
+                first = (await session.execute(select(func.min(TrafficRollupHourly.day)))).scalar()
+            closed = await _closed_through(session, now, grace_hours)
+            if first is None or first > closed:
+                await session.commit()
+                break
+            last = min(closed, first + timedelta(days=chunk_days - 1))
+            await session.execute(_daily_upsert(dialect_name, first, last))
+            await session.execute(_monthly_upsert(dialect_name, first, last))
+            await _set_watermark(session, DAILY_ROLLUP_WATERMARK, last.toordinal())
+            await session.commit()
+        days = (last - first).days + 1
+        compacted += days
+        traffic_compaction_days_total.inc(days)
+        log.info("traffic_compaction_chunk", first_day=first.isoformat(), last_day=last.isoformat())
+    if daily_retention_months is not None:
+        await prune_daily(session_factory, add_months(now.date(), -daily_retention_months))
+    return compacted
+
+
+async def prune_daily(session_factory: async_sessionmaker, before: date) -> int:
+    """Delete daily rows before ``before`` (a month start); their months stay in the monthly tier."""
+    async with session_factory() as session:
+        wm = await get_watermark(session, DAILY_ROLLUP_WATERMARK)
+        if not wm or date.fromordinal(wm) < before:
+            await session.commit()
+            return 0  # never prune days whose month is not compacted yet
+        res = await session.execute(delete(TrafficRollupDaily).where(TrafficRollupDaily.day < before))
+        await session.commit()
+    if res.rowcount:
+        log.info("traffic_daily_pruned", before=before.isoformat(), rows=res.rowcount)
+    return res.rowcount
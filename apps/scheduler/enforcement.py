@@ -0,0 +1,73 @@
+"""Set-based quota and expiry enforcement.
+
+One pass deactivates every active subscription that is expired
+(``expiry_at <= now``) or exhausted. A subscription is exhausted when
+``consumed_bytes >= coalesce(quota_bytes_override, plan.quota_bytes)``; a null
+quota means unlimited. Each batch is one ``UPDATE ... WHERE id IN (SELECT ...
+LIMIT n) RETURNING`` statement, so the database does the join and the filter,
+and Python only sees the rows that actually flipped. On PostgreSQL the
+candidate rows are locked with ``SKIP LOCKED``, so concurrent passes and API
+writes do not block each other.
+
+The collector already flags quota overruns as it ingests; this pass is the
+reconcile for expiries and anything a flush missed.
+"""
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from packages.common.vpnpanel_common.db.models import Plan, Subscription
+from packages.common.vpnpanel_common.db.quota import REASON_EXPIRED, REASON_QUOTA, deactivate, record_deactivations, violations
+from packages.common.vpnpanel_common.usage import report_enforcements
+
+
+def _batch_update(dialect_name: str, now: datetime, batch_size: int):
+    s = Subscription
+    expired, exhausted = violations(now)
+    candidates = (
+        select(s.id)
+        .outerjoin(Plan, Plan.id == s.plan_id)
+        .where(s.active.is_(True), or_(expired, exhausted))
+        .order_by(s.id)
+        .limit(batch_size)
+    )
+    if dialect_name == "postgresql":
+        candidates = candidates.with_for_update(of=s, skip_locked=True)
+    return deactivate(candidates, now)
+
+
+def _report(counts: dict) -> dict:
+    report_enforcements(counts)
+    return counts
+
+
+async def enforce_subscriptions(session_factory: async_sessionmaker, *, batch_size: int = 5000, now: datetime | None = None) -> dict:
+    """Deactivate every expired or exhausted subscription; returns counts per reason."""
+    now = now or datetime.now(timezone.utc)
+    counts = {REASON_EXPIRED: 0, REASON_QUOTA: 0}
+    while True:
+        async with session_factory() as session:
+            dialect_name = (await session.connection()).dialect.name
+            flipped = (await session.execute(_batch_update(dialect_name, now, batch_size))).all()
+            await record_deactivations(session, flipped, now, counts)
+            await session.commit()
+        if len(flipped) < batch_size:
+            break
+    return _report(counts)
+
+
+async def expire_subscriptions(session_factory: async_sessionmaker, ids: list[uuid.UUID], *, now: datetime | None = None) -> dict:
+    """Deactivate the given subscriptions if they are still active and expired at ``now``."""
+    now = now or datetime.now(timezone.utc)
+    counts = {REASON_EXPIRED: 0, REASON_QUOTA: 0}
+    s = Subscription
+    expired, _ = violations(now)
+    async with session_factory() as session:
+        flipped = (await session.execute(
+            deactivate(select(s.id).where(s.id.in_(ids), s.active.is_(True), expired), now)
+        )).all()
+        await record_deactivations(session, flipped, now, counts)
+        await session.commit()
+    return _report(counts)
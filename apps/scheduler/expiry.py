@@ -0,0 +1,137 @@
+"""Exact-second subscription expiry from an in-memory deadline heap.
+
+The timer holds every active subscription expiring within ``window_seconds``
+in a min-heap and sleeps until the earliest deadline, so an expiry fires at its
+second rather than on the next scheduler tick. Only the latest deadline per
+subscription counts (stale heap entries are skipped when popped).
+
+The heap is (re)loaded from the database at startup and every reload interval,
+and is kept current between reloads by expiry changes the control API
+publishes on Redis. Anything missed (Redis down, a deadline beyond the window)
+is still caught by the set-based enforcement pass.
+"""
+import asyncio
+import heapq
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from packages.common.vpnpanel_common.db.models import Subscription
+from packages.common.vpnpanel_common.events import SUBSCRIPTION_EXPIRY_CHANNEL
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.redis_client import get_redis
+
+from .enforcement import expire_subscriptions
+
+log = get_logger("scheduler.expiry")
+
+
+def _aware(ts: datetime) -> datetime:
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+class ExpiryTimer:
+    def __init__(self, session_factory: async_sessionmaker, *, window_seconds: int = 86400):
+        self.session_factory = session_factory
+        self.window_seconds = window_seconds
+        self._heap: list[tuple[float, uuid.UUID]] = []
+        self._deadline: dict[uuid.UUID, float] = {}
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self._deadline)
+
+    def schedule(self, subscription_id: uuid.UUID, expiry_at: datetime | None) -> None:
+        """Set, move or (with ``None``) cancel the deadline of a subscription."""
+        if expiry_at is None:
+            self._deadline.pop(subscription_id, None)
+            return
+        at = _aware(expiry_at).timestamp()
+        if at > datetime.now(timezone.utc).timestamp() + self.window_seconds:
+            self._deadline.pop(subscription_id, None)  # picked up by a later reload
+            return
+        self._deadline[subscription_id] = at
+        heapq.heappush(self._heap, (at, subscription_id))
+        if self._heap[0][1] == subscription_id:
+            self._wake.set()
+
+    def pop_due(self, now: float) -> list[uuid.UUID]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, sub_id = heapq.heappop(self._heap)
+            if self._deadline.get(sub_id) == at:
+                del self._deadline[sub_id]
+                due.append(sub_id)
+        return due
+
+    def next_deadline(self) -> float | None:
+        while self._heap and self._deadline.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)  # drop stale entries
+        return self._heap[0][0] if self._heap else None
+
+    async def load(self) -> int:
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=self.window_seconds)
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                select(Subscription.id, Subscription.expiry_at).where(
+                    Subscription.active.is_(True), Subscription.expiry_at.is_not(None), Subscription.expiry_at <= horizon,
+                )
+            )).all()
+        self._heap, self._deadline = [], {}
+        for sub_id, expiry_at in rows:
+            self.schedule(sub_id, expiry_at)
+        self._wake.set()
+        return len(rows)
+
+    async def run(self) -> None:
+        while True:
+            due = self.pop_due(datetime.now(timezone.utc).timestamp())
+            if due:
+                try:
+                    await expire_subscriptions(self.session_factory, due)
+                except Exception:  # noqa: BLE001 - the enforcement pass reconciles
+                    log.exception("expiry_fire_failed", subscriptions=len(due))
+                continue
+            nxt = self.next_deadline()
+            timeout = None if nxt is None else max(0.0, nxt - datetime.now(timezone.utc).timestamp())
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def handle_message(self, data: bytes | str) -> None:
+        msg = json.loads(data)
+        expiry_at = datetime.fromisoformat(msg["expiry_at"]) if msg.get("expiry_at") and msg.get("active", True) else None
+        self.schedule(uuid.UUID(msg["id"]), expiry_at)
+
+    async def listen(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                pubsub = get_redis().pubsub()
+                await pubsub.subscribe(SUBSCRIPTION_EXPIRY_CHANNEL)
+                delay = 1.0
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.handle_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001 - keep retrying; reloads cover the gap
+                log.warning("expiry_listen_failed", error=str(e), retry_in=delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self.run()), asyncio.create_task(self.listen())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
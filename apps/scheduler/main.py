@@ -2,7 +2,16 @@ from fastapi import FastAPI
 from packages.common.vpnpanel_common.config import get_settings
 from packages.common.vpnpanel_common.logging import configure_logging, get_logger
 from packages.common.vpnpanel_common.metrics import metrics_app, service_info
+from packages.common.vpnpanel_common.db.session import get_sessionmaker
+from packages.common.vpnpanel_common.db.sketches import prune_sketches
 import asyncio
+import time
+
+from .compaction import compact_rollups
+from .enforcement import enforce_subscriptions
+from .expiry import ExpiryTimer
+from .partitions import PartitionedTable, maintain_partitions
+from .rollups import rollup_hourly
 
 settings = get_settings()
 configure_logging(service_name="scheduler", level=settings.log_level)
@@ -11,20 +20,59 @@ log = get_logger("scheduler")
 app = FastAPI(title="Scheduler", version="0.1.0")
 app.mount("/metrics", metrics_app)
 service_info.labels(service="scheduler", version="0.1.0").set(1)
+state: dict = {}
 
 @app.get("/health")
 async def health():
     return {"status": "ok", "service": "scheduler"}
 
+def jobs():
+    """(name, every_seconds, coroutine factory) run from the periodic loop."""
+    sm = get_sessionmaker()
+    partitioned = [
+        PartitionedTable("traffic_events", "event_time", timestamp_bounds=True, retention_days=settings.retention_raw_days, require_rolled_up=True),
+        PartitionedTable("traffic_rollups_hourly", "day", timestamp_bounds=False, retention_days=settings.retention_hourly_days, require_compacted=True),
+    ]
+    timer = state["expiry_timer"]
+    return [
+        ("expiry_timer_reload", settings.expiry_reload_interval_seconds, timer.load),
+        ("quota_enforcement", settings.quota_enforce_interval_seconds,
+         lambda: enforce_subscriptions(sm, batch_size=settings.quota_enforce_batch_size)),
+        ("traffic_rollup_hourly", settings.traffic_rollup_interval_seconds,
+         lambda: rollup_hourly(sm, chunk_ids=settings.rollup_chunk_ids, settle_seconds=settings.rollup_settle_seconds)),
+        ("traffic_rollup_compaction", settings.rollup_compaction_interval_seconds,
+         lambda: compact_rollups(sm, grace_hours=settings.rollup_compaction_grace_hours, daily_retention_months=settings.retention_rollup_months)),
+        ("partition_maintenance", settings.partition_maintenance_interval_seconds,
+         lambda: maintain_partitions(sm, partitioned, days_ahead=settings.partition_days_ahead)),
+        ("traffic_sketch_retention", settings.partition_maintenance_interval_seconds,
+         lambda: prune_sketches(sm, retention_days=settings.retention_hourly_days)),
+    ]
+
 async def periodic_tasks():  # pragma: no cover
     interval = settings.scheduler_interval_seconds
+    last_run: dict[str, float] = {}
     while True:
         log.info("scheduler_tick", interval=interval)
-        # TODO: quota enforcement, rollups, partition maintenance
+        for name, every, run in jobs():
+            now = time.monotonic()
+            if name in last_run and now - last_run[name] < every:
+                continue
+            last_run[name] = now
+            try:
+                result = await run()
+                log.info("scheduler_job_done", job=name, result=result, seconds=round(time.monotonic() - now, 3))
+            except Exception:  # noqa: BLE001 - one failing job must not stop the loop
+                log.exception("scheduler_job_failed", job=name)
         await asyncio.sleep(interval)
 
 @app.on_event("startup")
 async def startup():
     log.info("scheduler_startup")
+    state["expiry_timer"] = ExpiryTimer(get_sessionmaker(), window_seconds=settings.expiry_window_seconds)
+    state["expiry_timer"].start()
     asyncio.create_task(periodic_tasks())
 
+@app.on_event("shutdown")
+async def shutdown():
+    if "expiry_timer" in state:
+        await state["expiry_timer"].stop()
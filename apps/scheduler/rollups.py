@@ -0,0 +1,161 @@
+"""Incremental hourly rollup of ``traffic_events`` into ``traffic_rollups_hourly``.
+
+A watermark row (``rollup_watermarks.name = 'traffic_hourly'``) records the last
+``traffic_events.id`` folded in. Each pass aggregates only ``id`` ranges above
+it, grouped by (hour, user, node), and upserts with ``ON CONFLICT DO UPDATE``
+adding bytes. Late-arriving events simply land in their (older) hour bucket.
+Events without a user or node are kept under ``NO_ID`` rather than dropped, so
+per-node and overall totals still add up once raw partitions are gone.
+
+Late events from days already compacted (see ``compaction.py``) are added to
+the daily and monthly rows the same way, in the same transaction: those days
+are not compacted again, and their hourly partitions may already be dropped.
+
+The upsert and the watermark advance commit in one transaction per chunk, so a
+crashed or repeated run never double counts. Rows newer than ``settle_seconds``
+are left for the next pass: ids are allocated at insert time, and a short
+settle window keeps slow in-flight ingest transactions from being skipped.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import func, literal, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from packages.common.vpnpanel_common.db.buckets import day_bucket, hour_bucket, month_bucket
+from packages.common.vpnpanel_common.db.series import tenant_of
+from packages.common.vpnpanel_common.db.models import (
+    DAILY_ROLLUP_WATERMARK,
+    HOURLY_ROLLUP_WATERMARK,
+    NO_ID,
+    RollupWatermark,
+    TrafficEvent,
+    TrafficRollupDaily,
+    TrafficRollupHourly,
+    TrafficRollupMonthly,
+)
+from packages.common.vpnpanel_common.logging import get_logger
+from packages.common.vpnpanel_common.metrics import traffic_rollup_events_total, traffic_rollup_watermark
+
+log = get_logger("scheduler.rollups")
+
+
+async def get_watermark(session: AsyncSession, name: str, *, for_update: bool = False) -> int:
+    stmt = select(RollupWatermark).where(RollupWatermark.name == name)
+    if for_update:
+        stmt = stmt.with_for_update()
+    wm = (await session.execute(stmt)).scalars().first()
+    if wm is None:
+        wm = RollupWatermark(name=name, last_id=0)
+        session.add(wm)
+        await session.flush()
+    return wm.last_id
+
+
+async def _set_watermark(session: AsyncSession, name: str, last_id: int) -> None:
+    wm = (await session.execute(select(RollupWatermark).where(RollupWatermark.name == name))).scalars().one()
+    wm.last_id = last_id
+    wm.updated_at = datetime.now(timezone.utc)
+
+
+async def _settled_upper_id(session: AsyncSession, after_id: int, settle_seconds: float) -> int | None:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settle_seconds)
+    return (await session.execute(
+        select(func.max(TrafficEvent.id)).where(TrafficEvent.id > after_id, TrafficEvent.created_at <= cutoff)
+    )).scalar()
+
+
+def _additive_upsert(dialect_name: str, table, periods: dict, lo: int, hi: int, *conds):
+    """Add the bytes of events in ids (lo, hi] to ``table``, keyed by ``periods`` (column -> bucket) + user + node."""
+    e = TrafficEvent
+    buckets = [bucket.label(name) for name, bucket in periods.items()]
+    user_id = func.coalesce(e.user_id, literal(NO_ID, e.user_id.type)).label("user_id")
+    node_id = func.coalesce(e.node_id, literal(NO_ID, e.node_id.type)).label("node_id")
+    grouped = (
+        select(
+            *buckets,
+            user_id,
+            node_id,
+            func.sum(e.bytes_up).label("bytes_up"),
+            func.sum(e.bytes_down).label("bytes_down"),
+        )
+        .where(e.id > lo, e.id <= hi, *conds)
+        .group_by(*buckets, user_id, node_id)
+        .subquery("g")
+    )
+    keys = [*periods, "user_id", "node_id"]
+    source = select(
+        *(grouped.c[k] for k in keys), tenant_of(grouped.c.user_id),
+        grouped.c.bytes_up, grouped.c.bytes_down, literal(datetime.now(timezone.utc), table.c.created_at.type),
+    ).where(literal(True))  # SQLite needs a WHERE to parse INSERT ... SELECT ... ON CONFLICT
+    dialect_insert = pg_insert if dialect_name == "postgresql" else sqlite_insert
+    stmt = dialect_insert(table).from_select([*keys, "tenant_id", "bytes_up", "bytes_down", "created_at"], source)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            "bytes_up": table.c.bytes_up + stmt.excluded.bytes_up,
+            "bytes_down": table.c.bytes_down + stmt.excluded.bytes_down,
+            "tenant_id": func.coalesce(stmt.excluded.tenant_id, table.c.tenant_id),
+        },
+    )
+
+
+def _rollup_upsert(dialect_name: str, lo: int, hi: int):
+    e = TrafficEvent
+    periods = {"hour_start": hour_bucket(e.event_time, dialect_name), "day": day_bucket(e.event_time, dialect_name)}
+    return _additive_upsert(dialect_name, TrafficRollupHourly.__table__, periods, lo, hi)
+
+
+def _late_upserts(dialect_name: str, lo: int, hi: int, compacted: date) -> list:
+    """Add events in ids (lo, hi] from days compacted through ``compacted`` to the daily and monthly tiers."""
+    day = day_bucket(TrafficEvent.event_time, dialect_name)
+    late = day <= compacted
+    return [
+        _additive_upsert(dialect_name, TrafficRollupDaily.__table__, {"day": day}, lo, hi, late),
+        _additive_upsert(dialect_name, TrafficRollupMonthly.__table__, {"month": month_bucket(day, dialect_name)}, lo, hi, late),
+    ]
+
+
+async def _ensure_partitions(session: AsyncSession, lo: int, hi: int) -> None:
+    """Create daily rollup partitions for every day touched by ids (lo, hi] (late events included)."""
+    first, last = (await session.execute(
+        select(func.min(TrafficEvent.event_time), func.max(TrafficEvent.event_time)).where(TrafficEvent.id > lo, TrafficEvent.id <= hi)
+    )).one()
+    if first is None:
+        return
+    await session.execute(
+        text("SELECT ensure_traffic_rollups_hourly_partitions(CAST(:start AS date), CAST(:end AS date))"),
+        {"start": first.astimezone(timezone.utc).date(), "end": last.astimezone(timezone.utc).date() + timedelta(days=1)},
+    )
+
+
+async def rollup_hourly(session_factory: async_sessionmaker, *, chunk_ids: int = 200_000, settle_seconds: float = 60.0) -> int:
+    """Fold all settled new traffic events into hourly rollups; returns events covered."""
+    covered = 0
+    while True:
+        async with session_factory() as session:
+            dialect_name = (await session.connection()).dialect.name
+            lo = await get_watermark(session, HOURLY_ROLLUP_WATERMARK, for_update=True)
+            upper = await _settled_upper_id(session, lo, settle_seconds)
+            if upper is None:
+                await session.commit()
+                break
+            hi = min(upper, lo + chunk_ids)
+            if dialect_name == "postgresql":
+                await _ensure_partitions(session, lo, hi)
+            await session.execute(_rollup_upsert(dialect_name, lo, hi))
+            # Locked like compaction does, so a day is either compacted before this chunk or sees it
+            compacted = await get_watermark(session, DAILY_ROLLUP_WATERMARK, for_update=True)
+            if compacted:
+                for stmt in _late_upserts(dialect_name, lo, hi, date.fromordinal(compacted)):
+                    await session.execute(stmt)
+            await _set_watermark(session, HOURLY_ROLLUP_WATERMARK, hi)
+            await session.commit()
+        covered += hi - lo
+        traffic_rollup_events_total.inc(hi - lo)
+        traffic_rollup_watermark.set(hi)
+        log.info("traffic_rollup_chunk", from_id=lo, to_id=hi)
+        if hi >= upper:
+            break
+    return covered
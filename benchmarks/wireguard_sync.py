@@ -0,0 +1,62 @@
+"""Time WireGuard peer reconciliation at N peers.
+
+Usage:
+    python -m benchmarks.wireguard_sync --peers 10000 --churn 0.05 --batch 500
+    sudo python -m benchmarks.wireguard_sync --interface wg-bench   # a real, otherwise unused interface
+
+Defaults to the in-memory ``FakeNetlink`` (driver overhead only: dump, diff,
+batching). With ``--interface`` the peers are written to that kernel interface
+through pyroute2 and removed again at the end. Times the initial sync of N
+peers, a sync after ``--churn`` of them were replaced, a no-op sync and one
+counter dump.
+"""
+import argparse
+import base64
+import time
+
+from apps.node_agent.testing import FakeNetlink
+from apps.node_agent.wireguard import WireGuardDriver, WireGuardNetlink
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+
+def entry(i: int) -> pb.SubscriptionEngineConfig:
+    e = pb.SubscriptionEngineConfig(subscription_id=f"sub-{i}", engine="wireguard", status="active",
+                                    public_key=base64.b64encode(i.to_bytes(32, "big")).decode())
+    e.meta["address"] = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}/32"
+    return e
+
+
+def timed(label: str, driver: WireGuardDriver) -> None:
+    result = driver.sync()
+    print(f"{label}: +{result.added} ~{result.updated} -{result.removed} peers "
+          f"in {result.messages} messages, {result.seconds * 1000:.1f} ms")
+
+
+def main(n: int, churn: float, batch: int, interface: str | None) -> None:
+    netlink = WireGuardNetlink() if interface else FakeNetlink()
+    driver = WireGuardDriver(interface or "wg-bench", netlink=netlink, batch_size=batch)
+    driver.load_peers(entry(i) for i in range(n))
+    timed(f"initial sync of {n} peers", driver)
+
+    replaced = int(n * churn)
+    driver.update_peers([entry(n + i) for i in range(replaced)],
+                        [pb.SubscriptionKey(subscription_id=f"sub-{i}", engine="wireguard") for i in range(replaced)])
+    timed(f"sync after replacing {replaced}", driver)
+    timed("no-op sync", driver)
+
+    start = time.perf_counter()
+    peers = driver.dump()
+    print(f"dump of {len(peers)} peers with counters: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    driver.load_peers(())
+    driver.sync()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=10_000)
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--interface", default=None)
+    args = parser.parse_args()
+    main(args.peers, args.churn, args.batch, args.interface)
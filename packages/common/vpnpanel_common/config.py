@@ -21,8 +21,68 @@ class Settings(BaseSettings):
     prometheus_multiproc_dir: Optional[str] = Field(None, alias="PROMETHEUS_MULTIPROC_DIR")
     # Node / Ingest
     sample_interval_seconds: int = Field(60, alias="SAMPLE_INTERVAL_SECONDS")
+    # Nodes sample at a per-node phase of the interval, +/- up to this jitter (capped at 5% of the interval)
+    sample_jitter_seconds: float = Field(2.0, alias="SAMPLE_JITTER_SECONDS")
+    node_id: Optional[str] = Field(None, alias="NODE_ID")
+    xray_api_address: str = Field("127.0.0.1:10085", alias="XRAY_API_ADDRESS")  # Xray StatsService/HandlerService
+    collector_grpc_target: str = Field("collector:50051", alias="COLLECTOR_GRPC_TARGET")  # TrafficIngest, as dialled by nodes
+    control_plane_grpc_address: str = Field("control-api:8001", alias="CONTROL_PLANE_GRPC_ADDRESS")  # NodeControl, as dialled by nodes
+    wireguard_interface: str = Field("wg0", alias="WIREGUARD_INTERFACE")  # empty: the node runs no WireGuard
+    node_config_resync_seconds: float = Field(60.0, alias="NODE_CONFIG_RESYNC_SECONDS")  # periodic drift repair
+    # Node agent sample spool while the collector is unreachable (fixed-size file, 56 bytes per sample)
+    node_spool_path: str = Field("/var/lib/node-agent/samples.spool", alias="NODE_SPOOL_PATH")
+    node_spool_capacity: int = Field(500_000, alias="NODE_SPOOL_CAPACITY")
+    node_spool_replay_batch: int = Field(5000, alias="NODE_SPOOL_REPLAY_BATCH")
+    # Spooled samples reach the disk at least this often; a power loss can lose the last interval's worth
+    node_spool_flush_seconds: float = Field(1.0, alias="NODE_SPOOL_FLUSH_SECONDS")
+    node_agent_metrics_port: int = Field(9101, alias="NODE_AGENT_METRICS_PORT")  # 0 disables
+    ingest_dedupe_ttl_seconds: int = Field(600, alias="INGEST_DEDUPE_TTL_SECONDS")
+    ingest_dedupe_max_keys: int = Field(500_000, alias="INGEST_DEDUPE_MAX_KEYS")
+    # Collector (TrafficIngest gRPC)
+    collector_grpc_address: str = Field("0.0.0.0:50051", alias="COLLECTOR_GRPC_ADDRESS")
+    ingest_queue_max: int = Field(100_000, alias="INGEST_QUEUE_MAX")
+    ingest_batch_max_rows: int = Field(5000, alias="INGEST_BATCH_MAX_ROWS")
+    ingest_flush_interval_seconds: float = Field(1.0, alias="INGEST_FLUSH_INTERVAL_SECONDS")
+    # Advertise evenly spread sampling phases to nodes on TrafficIngestAck
+    ingest_phase_spreading: bool = Field(True, alias="INGEST_PHASE_SPREADING")
+    # Pre-aggregation window per (subscription, node, engine); 0 disables coalescing
+    ingest_coalesce_window_seconds: int = Field(0, alias="INGEST_COALESCE_WINDOW_SECONDS")
+    ingest_coalesce_grace_seconds: float = Field(5.0, alias="INGEST_COALESCE_GRACE_SECONDS")
+    sketch_flush_interval_seconds: float = Field(60.0, alias="SKETCH_FLUSH_INTERVAL_SECONDS")
+    sketch_top_capacity: int = Field(64, alias="SKETCH_TOP_CAPACITY")
+    # Live usage in Redis hot counters, folded into consumed_bytes every flush interval
+    usage_counters_enabled: bool = Field(True, alias="USAGE_COUNTERS_ENABLED")
+    usage_flush_interval_seconds: float = Field(5.0, alias="USAGE_FLUSH_INTERVAL_SECONDS")
+    # NodeControl gRPC served by the control API (node agents connect to CONTROL_PLANE_GRPC_ADDRESS)
+    control_grpc_address: str = Field("0.0.0.0:8001", alias="CONTROL_GRPC_ADDRESS")
+    # Per-node enforcement fan-out: unacked commands in flight, commands per send batch, ack retry backoff
+    enforcement_window: int = Field(1000, alias="ENFORCEMENT_WINDOW")
+    enforcement_batch_size: int = Field(200, alias="ENFORCEMENT_BATCH_SIZE")
+    enforcement_retry_base_seconds: float = Field(2.0, alias="ENFORCEMENT_RETRY_BASE_SECONDS")
+    enforcement_retry_max_seconds: float = Field(60.0, alias="ENFORCEMENT_RETRY_MAX_SECONDS")
+    # Node config outbox: poll interval of the control API consumer (NOTIFY wakes it early on PostgreSQL)
+    config_outbox_poll_seconds: float = Field(1.0, alias="CONFIG_OUTBOX_POLL_SECONDS")
+    config_outbox_retention_seconds: int = Field(86400, alias="CONFIG_OUTBOX_RETENTION_SECONDS")
+    # mTLS for node-facing gRPC (insecure port when unset)
+    grpc_tls_cert_path: Optional[str] = Field(None, alias="GRPC_TLS_CERT_PATH")
+    grpc_tls_key_path: Optional[str] = Field(None, alias="GRPC_TLS_KEY_PATH")
+    internal_ca_cert_path: Optional[str] = Field(None, alias="INTERNAL_CA_CERT_PATH")
     # Scheduler
     scheduler_interval_seconds: int = Field(60, alias="SCHEDULER_INTERVAL_SECONDS")
+    traffic_rollup_interval_seconds: int = Field(300, alias="TRAFFIC_ROLLUP_INTERVAL_SECONDS")
+    rollup_chunk_ids: int = Field(200_000, alias="ROLLUP_CHUNK_IDS")
+    rollup_settle_seconds: int = Field(60, alias="ROLLUP_SETTLE_SECONDS")
+    quota_enforce_interval_seconds: int = Field(300, alias="QUOTA_ENFORCE_INTERVAL_SECONDS")
+    quota_enforce_batch_size: int = Field(5000, alias="QUOTA_ENFORCE_BATCH_SIZE")
+    expiry_window_seconds: int = Field(86400, alias="EXPIRY_WINDOW_SECONDS")
+    expiry_reload_interval_seconds: int = Field(3600, alias="EXPIRY_RELOAD_INTERVAL_SECONDS")
+    partition_maintenance_interval_seconds: int = Field(3600, alias="PARTITION_MAINTENANCE_INTERVAL_SECONDS")
+    partition_days_ahead: int = Field(7, alias="PARTITION_DAYS_AHEAD")
+    retention_raw_days: int = Field(60, alias="RETENTION_RAW_DAYS")
+    retention_hourly_days: int = Field(90, alias="RETENTION_HOURLY_DAYS")
+    retention_rollup_months: int = Field(18, alias="RETENTION_ROLLUP_MONTHS")  # daily tier; monthly is kept
+    rollup_compaction_interval_seconds: int = Field(3600, alias="ROLLUP_COMPACTION_INTERVAL_SECONDS")
+    rollup_compaction_grace_hours: int = Field(6, alias="ROLLUP_COMPACTION_GRACE_HOURS")
 
     class Config:
         case_sensitive = False
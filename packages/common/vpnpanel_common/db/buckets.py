@@ -0,0 +1,36 @@
+"""Dialect-aware UTC time-bucket expressions for aggregation queries.
+
+PostgreSQL truncates in UTC regardless of the session ``TimeZone``; SQLite (dev
+and tests) stores naive UTC strings, so ``strftime`` yields comparable keys in
+the same text format SQLAlchemy writes.
+"""
+from sqlalchemy import BigInteger, Date, cast, func
+from sqlalchemy.sql.elements import ColumnElement
+
+
+def hour_bucket(col: ColumnElement, dialect_name: str) -> ColumnElement:
+    if dialect_name == "postgresql":
+        return func.timezone("UTC", func.date_trunc("hour", func.timezone("UTC", col)))
+    return func.strftime("%Y-%m-%d %H:00:00.000000", col)
+
+
+def day_bucket(col: ColumnElement, dialect_name: str) -> ColumnElement:
+    if dialect_name == "postgresql":
+        return cast(func.timezone("UTC", col), Date)
+    return func.date(col)
+
+
+def month_bucket(col: ColumnElement, dialect_name: str) -> ColumnElement:
+    """First day of the month of a ``Date`` column."""
+    if dialect_name == "postgresql":
+        return cast(func.date_trunc("month", col), Date)
+    return func.date(col, "start of month")
+
+
+def epoch_bucket(col: ColumnElement, width_seconds: int, dialect_name: str) -> ColumnElement:
+    """Start of the ``width_seconds`` bucket holding ``col``, as unix seconds (epoch-aligned, so UTC)."""
+    if dialect_name == "postgresql":
+        epoch = cast(func.floor(func.extract("epoch", col)), BigInteger)
+    else:
+        epoch = cast(func.strftime("%s", col), BigInteger)
+    return (epoch // width_seconds) * width_seconds
@@ -0,0 +1,214 @@
+"""Bulk write path for the append-only ``traffic_events`` table.
+
+The ORM path (one ``TrafficEvent`` object per sample + ``session.add_all``) pays
+identity-map bookkeeping and one INSERT round-trip per row. At node sampling
+rates that dominates ingest cost, so batches are written here as plain rows:
+
+- Keyless rows (no ``counter_seq``) on PostgreSQL + asyncpg: binary ``COPY`` via
+  ``copy_records_to_table``.
+- Keyed node samples: multi-row ``INSERT ... ON CONFLICT DO NOTHING`` against
+  ``uq_traffic_event_dedupe`` so at-least-once redelivery never double counts.
+- Any other dialect (SQLite in dev/tests): a single Core ``insert()`` executed
+  with a parameter list (executemany / multi-row VALUES).
+
+Pass a ``usage`` counter to have the bytes of the rows actually inserted (so
+never of skipped duplicates) added to it per ``(subscription_id, engine)``,
+and/or a ``landed`` list to have those rows appended to it; keyed inserts then
+use ``RETURNING`` to learn which rows landed.
+
+All variants run on the session's own connection, so they join the caller's
+transaction and are committed (or rolled back) together with e.g. audit rows.
+"""
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Hashable, Iterable, Mapping, Sequence
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import EngineType, TrafficEvent, TrafficSource
+
+TRAFFIC_EVENT_COLUMNS = (
+    "event_time", "user_id", "node_id", "subscription_id", "engine", "counter_seq",
+    "bytes_up", "bytes_down", "source", "created_at",
+)
+DEDUPE_KEY_COLUMNS = ("node_id", "subscription_id", "engine", "event_time", "counter_seq")
+# PostgreSQL caps bind parameters per statement at 32767
+DEDUPE_BATCH_ROWS = 32767 // len(TRAFFIC_EVENT_COLUMNS)
+
+
+def build_event_rows(samples: Iterable[Mapping[str, Any]], *, event_time: datetime | None = None, source: TrafficSource = TrafficSource.collector) -> list[dict]:
+    """Normalise incoming samples into ``traffic_events`` row dicts (no ORM objects).
+
+    Node samples carry ``period_end_unix``; it becomes ``event_time`` so the dedupe
+    key is stable across redeliveries.
+    """
+    now = datetime.now(timezone.utc)
+    event_time = event_time or now
+    rows = []
+    for s in samples:
+        period_end = s.get("period_end_unix")
+        engine = s.get("engine")
+        rows.append({
+            "event_time": datetime.fromtimestamp(period_end, timezone.utc) if period_end else (s.get("event_time") or event_time),
+            "user_id": s.get("user_id"),
+            "node_id": s.get("node_id"),
+            "subscription_id": s.get("subscription_id"),
+            "engine": EngineType(engine) if engine else None,
+            "counter_seq": s.get("counter_seq"),
+            "bytes_up": int(s.get("bytes_up") or 0),
+            "bytes_down": int(s.get("bytes_down") or 0),
+            "source": s.get("source") or source,
+            "created_at": now,
+        })
+    return rows
+
+
+def dedupe_key(row: Mapping[str, Any]) -> tuple | None:
+    """Return the at-least-once dedupe key of a row, or None for keyless rows."""
+    if row.get("counter_seq") is None:
+        return None
+    return tuple(row.get(c) for c in DEDUPE_KEY_COLUMNS)
+
+
+class RecentKeyFilter:
+    """Short-lived in-memory set of recently persisted dedupe keys.
+
+    Sits in front of the database so most redeliveries (agent retries after a lost
+    ack) are dropped without a round-trip. Keys are only remembered after the
+    batch commits; the unique constraint remains the source of truth.
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_keys: int = 500_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._keys: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _evict(self, now: float) -> None:
+        keys = self._keys
+        while keys:
+            key, expires = next(iter(keys.items()))
+            if expires > now and len(keys) <= self.max_keys:
+                break
+            keys.popitem(last=False)
+
+    def seen(self, key: Hashable, now: float | None = None) -> bool:
+        expires = self._keys.get(key)
+        return expires is not None and expires > (now if now is not None else time.monotonic())
+
+    def filter(self, rows: Sequence[Mapping[str, Any]]) -> tuple[list[Mapping[str, Any]], int]:
+        """Split off rows whose key was recently persisted; returns (fresh_rows, dropped)."""
+        now = time.monotonic()
+        self._evict(now)
+        fresh, batch_keys, dropped = [], set(), 0
+        for row in rows:
+            key = dedupe_key(row)
+            if key is not None:
+                if key in batch_keys or self.seen(key, now):
+                    dropped += 1
+                    continue
+                batch_keys.add(key)
+            fresh.append(row)
+        return fresh, dropped
+
+    def remember(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        expires = time.monotonic() + self.ttl_seconds
+        for row in rows:
+            key = dedupe_key(row)
+            if key is not None:
+                self._keys[key] = expires
+                self._keys.move_to_end(key)
+        self._evict(time.monotonic())
+
+
+async def _copy_rows(session: AsyncSession, rows: Sequence[Mapping[str, Any]]) -> None:
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    records = [
+        tuple(r[c].value if isinstance(r[c], (TrafficSource, EngineType)) else r[c] for c in TRAFFIC_EVENT_COLUMNS)
+        for r in rows
+    ]
+    await raw.driver_connection.copy_records_to_table(
+        TrafficEvent.__tablename__, records=records, columns=list(TRAFFIC_EVENT_COLUMNS)
+    )
+
+
+def _stored_key(row: Mapping[str, Any]) -> tuple:
+    """``dedupe_key`` with ``event_time`` in UTC; SQLite returns it naive."""
+    t = row["event_time"]
+    t = t.replace(tzinfo=timezone.utc) if t.tzinfo is None else t.astimezone(timezone.utc)
+    return tuple(t if c == "event_time" else row[c] for c in DEDUPE_KEY_COLUMNS)
+
+
+def _add_usage(usage: Counter, rows: Iterable[Mapping[str, Any]]) -> None:
+    for r in rows:
+        if r.get("subscription_id") is not None:
+            usage[r["subscription_id"], r.get("engine")] += (r.get("bytes_up") or 0) + (r.get("bytes_down") or 0)
+
+
+async def _insert_ignore_duplicates(session: AsyncSession, rows: Sequence[Mapping[str, Any]], landed: list | None = None) -> int:
+    conn = await session.connection()
+    dialect_insert = pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+    t = TrafficEvent.__table__
+    inserted = 0
+    for i in range(0, len(rows), DEDUPE_BATCH_ROWS):
+        chunk = rows[i:i + DEDUPE_BATCH_ROWS]
+        stmt = (
+            dialect_insert(t)
+            .values([{c: r.get(c) for c in TRAFFIC_EVENT_COLUMNS} for r in chunk])
+            .on_conflict_do_nothing(index_elements=list(DEDUPE_KEY_COLUMNS))
+        )
+        if landed is None:
+            inserted += (await session.execute(stmt)).rowcount
+            continue
+        # Map the returned keys back to the caller's rows, which keep their aware timestamps and resolved ids
+        by_key = {_stored_key(r): r for r in chunk}
+        returned = (await session.execute(stmt.returning(*(t.c[c] for c in DEDUPE_KEY_COLUMNS)))).mappings().all()
+        landed.extend(by_key[_stored_key(r)] for r in returned)
+        inserted += len(returned)
+    return inserted
+
+
+async def bulk_insert_traffic_events(
+    session: AsyncSession, rows: Sequence[Mapping[str, Any]], *, usage: Counter | None = None, landed: list | None = None,
+) -> int:
+    """Write ``rows`` to ``traffic_events``; returns the number of rows actually inserted.
+
+    Rows carrying a dedupe key are inserted with ``ON CONFLICT DO NOTHING``, so the
+    return value, ``usage`` and ``landed`` (if given) exclude duplicates already
+    stored. Keyless rows cannot be duplicates and all land, including through
+    ``COPY``. Does not commit; the caller owns the transaction.
+    """
+    if not rows:
+        return 0
+    keyed = [r for r in rows if dedupe_key(r) is not None]
+    plain = [r for r in rows if dedupe_key(r) is None] if keyed else rows
+    track = landed is not None or usage is not None
+    inserted_rows: list = []
+    inserted = 0
+    conn = await session.connection()
+    if plain:
+        if conn.dialect.name == "postgresql" and conn.dialect.driver == "asyncpg":
+            await _copy_rows(session, plain)
+        else:
+            await session.execute(insert(TrafficEvent.__table__), [dict(r) for r in plain])
+        inserted += len(plain)
+        inserted_rows += plain
+    if keyed:
+        if conn.dialect.name in ("postgresql", "sqlite"):
+            inserted += await _insert_ignore_duplicates(session, keyed, inserted_rows if track else None)
+        else:  # pragma: no cover - no upsert dialect available; rely on the filter only
+            await session.execute(insert(TrafficEvent.__table__), [dict(r) for r in keyed])
+            inserted += len(keyed)
+            inserted_rows += keyed
+    if usage is not None:
+        _add_usage(usage, inserted_rows)
+    if landed is not None:
+        landed.extend(inserted_rows)
+    return inserted
@@ -13,6 +13,7 @@ from sqlalchemy import (
     UniqueConstraint,
     Index,
     JSON,
+    LargeBinary,
     Text,
     Date,
 )
@@ -20,6 +21,9 @@ from sqlalchemy.dialects.postgresql import UUID  # remove JSONB usage
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from .base import Base
 
+# BIGINT PRIMARY KEY is not a rowid alias on SQLite (no autoincrement); use INTEGER there
+BigIntPK = BigInteger().with_variant(Integer, "sqlite")
+
 # Enums
 class EngineType(str, enum.Enum):
     xray = "xray"
@@ -94,6 +98,7 @@ class Node(Base):
     capacity_mbps: Mapped[int | None] = mapped_column(Integer)
     is_enabled: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
     policy: Mapped[dict | None] = mapped_column(JSON)  # added for policy overrides
+    config_revision: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)  # FullNodeConfigPush.revision
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
@@ -140,7 +145,7 @@ class Subscription(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
-Index("uq_subscription_user_active_true", Subscription.user_id, unique=True, postgresql_where=Subscription.active)
+Index("uq_subscription_user_active_true", Subscription.user_id, unique=True, postgresql_where=Subscription.active, sqlite_where=Subscription.active)
 
 # Credentials & Engine settings
 class Credential(Base):
@@ -212,23 +217,48 @@ class Assignment(Base):
     node_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("nodes.id", ondelete="CASCADE"), nullable=False, index=True)
     policy: Mapped[dict | None] = mapped_column(JSON)  # overrides (speed caps, route sets, etc.)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("user_id", "node_id", name="uq_assignment_user_node"),
     )
 
-# Traffic events (append-only)
+# Node config outbox: appended in the same transaction as the write it describes
+class ConfigChange(Base):
+    __tablename__ = "config_changes"
+    id: Mapped[int] = mapped_column(BigIntPK, primary_key=True, autoincrement=True)
+    node_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("nodes.id", ondelete="CASCADE"), nullable=False)
+    revision: Mapped[int] = mapped_column(BigInteger, nullable=False)  # Node.config_revision after this change
+    user_ids: Mapped[list] = mapped_column(JSON, nullable=False, default=list)  # users whose entries to re-read
+    subscription_ids: Mapped[list] = mapped_column(JSON, nullable=False, default=list)  # their subscriptions, incl. deleted ones
+    inbounds: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)  # re-read the node's Xray inbounds
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("node_id", "revision", name="uq_config_change_node_revision"),
+    )
+
+# Traffic events (append-only). On PostgreSQL the table is RANGE partitioned by day on
+# event_time via migration 20261017_03 (PK (id, event_time)); the ORM keys rows by id alone.
 class TrafficEvent(Base):
     __tablename__ = "traffic_events"
-    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
-    event_time: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+    id: Mapped[int] = mapped_column(BigIntPK, primary_key=True, autoincrement=True)
+    event_time: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)  # period end for node samples
     user_id: Mapped[uuid.UUID | None] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), index=True)
     node_id: Mapped[uuid.UUID | None] = mapped_column(ForeignKey("nodes.id", ondelete="SET NULL"), index=True)
+    subscription_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True))
+    engine: Mapped[EngineType | None] = mapped_column(Enum(EngineType, name="engine_type"))
+    counter_seq: Mapped[int | None] = mapped_column(BigInteger)  # monotonic per (node, subscription, engine)
     bytes_up: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
     bytes_down: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
     source: Mapped[TrafficSource] = mapped_column(Enum(TrafficSource, name="traffic_source"), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True)
 
+    __table_args__ = (
+        # At-least-once delivery guard; rows without a counter_seq (legacy HTTP ingest) never conflict (NULLs are distinct)
+        UniqueConstraint("node_id", "subscription_id", "engine", "event_time", "counter_seq", name="uq_traffic_event_dedupe"),
+    )
+
 Index("ix_traffic_events_user_time", TrafficEvent.user_id, TrafficEvent.event_time)
 Index("ix_traffic_events_node_time", TrafficEvent.node_id, TrafficEvent.event_time)
 
@@ -238,18 +268,68 @@ class TrafficRollupHourly(Base):
     __table_args__ = {"postgresql_partition_by": "RANGE (day)"}
 
     hour_start: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
-    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)  # partition key part, not nullable
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)  # NO_ID for events without a user
     tenant_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), index=True)
-    node_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), index=True)
-    day: Mapped[date] = mapped_column(Date, nullable=False, index=True)  # UTC date bucket
+    node_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, index=True)  # NO_ID for events without a node
+    day: Mapped[date] = mapped_column(Date, primary_key=True, index=True)  # UTC date bucket; PK must include the partition key
     bytes_up: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
     bytes_down: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
 
+# Coarser tiers compacted from closed days of hourly rollups (see apps/scheduler/compaction.py)
+class TrafficRollupDaily(Base):
+    __tablename__ = "traffic_rollups_daily"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)  # UTC date
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    node_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    tenant_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), index=True)
+    bytes_up: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    bytes_down: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+Index("ix_traffic_rollups_daily_user_day", TrafficRollupDaily.user_id, TrafficRollupDaily.day)
+Index("ix_traffic_rollups_daily_node_day", TrafficRollupDaily.node_id, TrafficRollupDaily.day)
+
+class TrafficRollupMonthly(Base):
+    __tablename__ = "traffic_rollups_monthly"
+    month: Mapped[date] = mapped_column(Date, primary_key=True)  # first day of the UTC month
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    node_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    tenant_id: Mapped[uuid.UUID | None] = mapped_column(UUID(as_uuid=True), index=True)
+    bytes_up: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    bytes_down: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+Index("ix_traffic_rollups_monthly_user_month", TrafficRollupMonthly.user_id, TrafficRollupMonthly.month)
+Index("ix_traffic_rollups_monthly_node_month", TrafficRollupMonthly.node_id, TrafficRollupMonthly.month)
+
+# Per-hour streaming sketches (HyperLogLog of active users, space-saving top users by bytes)
+class TrafficSketchHourly(Base):
+    __tablename__ = "traffic_sketches_hourly"
+    scope: Mapped[str] = mapped_column(String(16), primary_key=True)  # "node" | "tenant"
+    scope_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True)
+    hour_start: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True, index=True)
+    active_users: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    top_users: Mapped[dict] = mapped_column(JSON, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+# Incremental job progress (e.g. last traffic_events.id folded into hourly rollups)
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+    name: Mapped[str] = mapped_column(String(60), primary_key=True)
+    last_id: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+HOURLY_ROLLUP_WATERMARK = "traffic_hourly"
+DAILY_ROLLUP_WATERMARK = "traffic_daily"  # last_id = date.toordinal() of the last compacted day
+
+# Rollup key stand-in for an event without a user or node (primary key columns cannot be NULL)
+NO_ID = uuid.UUID(int=(1 << 128) - 1)  # the RFC 9562 max UUID; never generated
+
 # Audit logs
 class AuditLog(Base):
     __tablename__ = "audit_logs"
-    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    id: Mapped[int] = mapped_column(BigIntPK, primary_key=True, autoincrement=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True)
     actor_user_id: Mapped[uuid.UUID | None] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), index=True)
     tenant_id: Mapped[uuid.UUID | None] = mapped_column(ForeignKey("tenants.id", ondelete="SET NULL"), index=True)
@@ -0,0 +1,81 @@
+"""Transactional outbox of node config changes.
+
+A write that changes what some node should be serving calls
+``record_config_change`` before committing: it bumps ``Node.config_revision``
+of every affected node and appends one ``ConfigChange`` row per node naming the
+users (or the inbounds) to re-read and those users' subscriptions, all in the
+caller's transaction. The row commits or rolls back with the write itself, so
+consumers never have to rescan assignments or subscriptions to find out what
+changed, and a node's changes are numbered without gaps.
+
+The retained rows double as a change log: the only entries a node at an older
+revision can hold stale are those of the subscriptions named by later rows.
+
+On PostgreSQL the transaction also sends ``NOTIFY vpnpanel_config_changes`` so
+consumers wake as soon as it commits instead of on their next poll.
+"""
+import uuid
+from collections import defaultdict
+from typing import Iterable
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Assignment, ConfigChange, Node, Subscription
+
+CONFIG_CHANGES_CHANNEL = "vpnpanel_config_changes"
+
+
+async def record_config_change(
+    session: AsyncSession,
+    *,
+    user_ids: Iterable[uuid.UUID] = (),
+    node_ids: Iterable[uuid.UUID] = (),
+    subscription_ids: Iterable[uuid.UUID] = (),
+    inbounds: bool = False,
+) -> dict[uuid.UUID, int]:
+    """Append a change on every node ``user_ids`` are assigned to, plus ``node_ids``.
+
+    Each node's row names only the users (and their subscriptions) it serves.
+
+    ``node_ids`` names nodes that are affected but no longer found through
+    ``Assignment`` (the node a user just left, or whose inbounds changed), and
+    ``subscription_ids`` subscriptions no longer found through their user (one
+    just deleted). Returns the new revision per node. Does not commit; the
+    caller owns the transaction.
+    """
+    user_ids, extra_subs = set(user_ids), set(subscription_ids)
+    by_node: dict = defaultdict(set)  # node -> users named in its row
+    subs_by_user: dict = defaultdict(set)
+    if user_ids:
+        assigned = await session.execute(
+            select(Assignment.node_id, Assignment.user_id).where(Assignment.user_id.in_(user_ids))
+        )
+        for node_id, user_id in assigned.all():
+            by_node[node_id].add(user_id)
+        owned = await session.execute(select(Subscription.user_id, Subscription.id).where(Subscription.user_id.in_(user_ids)))
+        for user_id, sub_id in owned.all():
+            subs_by_user[user_id].add(sub_id)
+    for node_id in node_ids:
+        by_node[node_id] |= user_ids
+    if not by_node:
+        return {}
+    res = await session.execute(
+        update(Node).where(Node.id.in_(sorted(by_node))).values(config_revision=Node.config_revision + 1)
+        .returning(Node.id, Node.config_revision).execution_options(synchronize_session=False)
+    )
+    revisions = dict(res.all())
+    if revisions:
+        rows = []
+        for node_id, revision in sorted(revisions.items()):
+            users = by_node[node_id]
+            subs = extra_subs.union(*(subs_by_user[u] for u in users))
+            rows.append({
+                "node_id": node_id, "revision": revision, "inbounds": inbounds,
+                "user_ids": sorted(str(u) for u in users), "subscription_ids": sorted(str(s) for s in subs),
+            })
+        await session.execute(insert(ConfigChange.__table__), rows)
+        conn = await session.connection()
+        if conn.dialect.name == "postgresql":  # delivered on commit, dropped on rollback
+            await session.execute(select(func.pg_notify(CONFIG_CHANGES_CHANNEL, "")))
+    return revisions
@@ -0,0 +1,162 @@
+"""Subscription usage counters and quota/expiry deactivation statements.
+
+``consumed_bytes`` is maintained incrementally: every ingest flush adds the
+bytes it actually inserted with one aggregated ``UPDATE`` (``UPDATE ... FROM
+(VALUES ...)`` on PostgreSQL), and the subscriptions it touched are checked
+against their quota in the same transaction. The scheduler reuses the same
+deactivation statement for its set-based reconcile pass. Every deactivation is
+also appended to the node config outbox in the same transaction, so the nodes
+serving those users are told.
+
+A subscription is expired when ``expiry_at <= now`` and exhausted when
+``consumed_bytes >= coalesce(quota_bytes_override, plan.quota_bytes)``; a null
+quota means unlimited.
+"""
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Mapping
+
+from sqlalchemy import BigInteger, and_, any_, bindparam, case, column, func, insert, literal, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import AuditLog, Plan, Subscription
+from .outbox import record_config_change
+
+REASON_EXPIRED = "expired"
+REASON_QUOTA = "quota"
+
+
+def effective_quota():
+    """Per-subscription quota in bytes (null = unlimited); needs ``Plan`` outer-joined."""
+    return func.coalesce(Subscription.quota_bytes_override, Plan.quota_bytes)
+
+
+def violations(now: datetime):
+    """(expired, exhausted) predicates; ``exhausted`` needs ``Plan`` outer-joined."""
+    s = Subscription
+    expired = and_(s.expiry_at.is_not(None), s.expiry_at <= now)
+    quota = effective_quota()
+    exhausted = and_(quota.is_not(None), s.consumed_bytes >= quota)
+    return expired, exhausted
+
+
+def deactivate(candidates, now: datetime):
+    """``UPDATE`` deactivating the ids selected by ``candidates``, returning (id, tenant_id, reason, user_id)."""
+    s = Subscription
+    expired, _ = violations(now)
+    reason = case((expired, literal(REASON_EXPIRED)), else_=literal(REASON_QUOTA))
+    return (
+        update(s)
+        .where(s.id.in_(candidates.scalar_subquery()))
+        .values(active=False, updated_at=now)
+        .returning(s.id, s.tenant_id, reason.label("reason"), s.user_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def record_deactivations(session: AsyncSession, flipped, now: datetime, counts: dict) -> None:
+    """Write one audit row and one config outbox change per flipped subscription; tally ``counts`` by reason."""
+    if flipped:
+        await session.execute(insert(AuditLog.__table__), [
+            {"action": f"subscription.{r.reason}", "target_type": "subscription", "target_id": str(r.id),
+             "tenant_id": r.tenant_id, "created_at": now}
+            for r in flipped
+        ])
+        await record_config_change(session, user_ids={r.user_id for r in flipped})
+    for r in flipped:
+        counts[r.reason] += 1
+
+
+async def add_consumed_bytes(session: AsyncSession, usage: Mapping[uuid.UUID, int]) -> None:
+    """Add ``usage`` (subscription id -> bytes) to ``consumed_bytes`` in one statement.
+
+    Does not commit; the caller owns the transaction.
+    """
+    usage = {sub_id: n for sub_id, n in usage.items() if n}
+    if not usage:
+        return
+    s = Subscription.__table__
+    conn = await session.connection()
+    if conn.dialect.name == "postgresql":
+        v = values(column("id", s.c.id.type), column("bytes", BigInteger()), name="v").data(sorted(usage.items()))
+        await session.execute(
+            update(s).where(s.c.id == v.c.id).values(consumed_bytes=s.c.consumed_bytes + v.c.bytes)
+        )
+    else:  # SQLite has no aliased VALUES list in FROM: one executemany UPDATE
+        await session.execute(
+            update(s).where(s.c.id == bindparam("sub_id")).values(consumed_bytes=s.c.consumed_bytes + bindparam("delta")),
+            [{"sub_id": sub_id, "delta": n} for sub_id, n in sorted(usage.items())],
+        )
+
+
+async def deactivate_exhausted(session: AsyncSession, ids, now: datetime, counts: dict) -> None:
+    """Deactivate the active subscriptions among ``ids`` that are now over quota."""
+    if not ids:
+        return
+    s = Subscription
+    _, exhausted = violations(now)
+    candidates = (
+        select(s.id)
+        .outerjoin(Plan, Plan.id == s.plan_id)
+        .where(s.id.in_(list(ids)), s.active.is_(True), exhausted)
+    )
+    flipped = (await session.execute(deactivate(candidates, now))).all()
+    await record_deactivations(session, flipped, now, counts)
+
+
+async def deactivate_over_quota(session: AsyncSession, pending: Mapping[uuid.UUID, int], now: datetime, counts: dict) -> None:
+    """Deactivate the active subscriptions whose ``consumed_bytes`` plus ``pending`` (unflushed bytes) reach their quota."""
+    if not pending:
+        return
+    over = [
+        r.id for r in await usage_snapshots(session, pending)
+        if r.active and r.quota_bytes is not None and r.consumed_bytes + pending[r.id] >= r.quota_bytes
+    ]
+    if not over:
+        return
+    s = Subscription
+    flipped = (await session.execute(deactivate(select(s.id).where(s.id.in_(over), s.active.is_(True)), now))).all()
+    await record_deactivations(session, flipped, now, counts)
+
+
+def per_subscription(usage: Mapping[tuple[uuid.UUID, object], int]) -> Counter:
+    """Sum ``(subscription_id, engine) -> bytes`` over engines."""
+    totals: Counter = Counter()
+    for (sub_id, _), n in usage.items():
+        totals[sub_id] += n
+    return totals
+
+
+async def charge_usage(session: AsyncSession, usage: Mapping[uuid.UUID, int], now: datetime) -> Counter:
+    """Add ``usage`` to ``consumed_bytes`` and deactivate what it pushed over quota; returns counts per reason.
+
+    Past-expiry subscriptions are counted (and audited) as expired even when it
+    is the usage that flips them.
+    """
+    counts: Counter = Counter()
+    await add_consumed_bytes(session, usage)
+    await deactivate_exhausted(session, usage.keys(), now, counts)
+    return counts
+
+
+async def usage_snapshots(session: AsyncSession, ids) -> list:
+    """(id, consumed_bytes, quota_bytes, expiry_at, active) for ``ids`` in one joined query.
+
+    On PostgreSQL the ids travel as one array parameter (``= ANY(:ids)``), which
+    plans and binds much faster than thousands of ``IN`` placeholders.
+    """
+    s = Subscription
+    ids = list(ids)
+    conn = await session.connection()
+    if conn.dialect.name == "postgresql":
+        match = s.id == any_(bindparam("ids", ids, type_=ARRAY(s.id.type)))
+    else:
+        match = s.id.in_(ids)
+    res = await session.execute(
+        select(s.id, s.consumed_bytes, effective_quota().label("quota_bytes"), s.expiry_at, s.active)
+        .outerjoin(Plan, Plan.id == s.plan_id)
+        .where(match)
+    )
+    return res.all()
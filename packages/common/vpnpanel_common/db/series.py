@@ -0,0 +1,253 @@
+"""Tiered traffic reads: bucketed series and per-user totals.
+
+Traffic is stored in four tiers: raw ``traffic_events``, hourly rollups, and
+daily/monthly rollups compacted from closed days. A read is split by
+``plan_tiers`` into time segments, each answered from the coarsest tier that
+is complete for it and fine enough for the requested bucket. Raw events above
+the hourly rollup watermark are always added as the tail.
+
+Series buckets are computed in SQL and capped at ``MAX_SERIES_POINTS``. A
+request therefore reads a bounded number of rows per series whatever the range.
+Sub-hour buckets can only be answered from raw events, so they are refused
+for ranges reaching back past raw retention rather than zero-filled there.
+Rollups are keyed by user and node, so user, tenant and node filters all read
+the same tiers. Rollup rows are stamped with ``tenant_of`` their user, and the
+raw tail filters on the same expression, so a tenant's totals do not move when
+events cross the watermark.
+"""
+import uuid
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .buckets import epoch_bucket
+from .models import (
+    DAILY_ROLLUP_WATERMARK,
+    HOURLY_ROLLUP_WATERMARK,
+    NO_ID,
+    RollupWatermark,
+    Subscription,
+    TrafficEvent,
+    TrafficRollupDaily,
+    TrafficRollupHourly,
+    TrafficRollupMonthly,
+)
+
+SERIES_BUCKETS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600, "6h": 21600, "1d": 86400}
+MAX_SERIES_POINTS = 2000
+AUTO_SERIES_POINTS = 400  # target density when no bucket is requested
+
+# Open-ended reads are clamped to these so every segment has concrete bounds
+MIN_TIME = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_TIME = datetime(9999, 1, 1, tzinfo=timezone.utc)
+
+ROLLUP_TIERS = {
+    "hourly": (TrafficRollupHourly, "hour_start"),
+    "daily": (TrafficRollupDaily, "day"),
+    "monthly": (TrafficRollupMonthly, "month"),
+}
+
+
+@dataclass
+class SeriesFilter:
+    user_id: uuid.UUID | None = None
+    tenant_id: uuid.UUID | None = None
+    node_id: uuid.UUID | None = None
+
+
+def tenant_of(user_id_col):
+    """Tenant of a user's active (else most recent) subscription, as a scalar subquery."""
+    return (
+        select(Subscription.tenant_id)
+        .where(Subscription.user_id == user_id_col)
+        .order_by(Subscription.active.desc(), Subscription.created_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def choose_bucket(span_seconds: float, min_width: int = 0) -> int:
+    """Smallest standard bucket of at least ``min_width`` that keeps the series within ``AUTO_SERIES_POINTS``."""
+    for width in sorted(w for w in SERIES_BUCKETS.values() if w >= min_width):
+        if span_seconds / width <= AUTO_SERIES_POINTS:
+            return width
+    return max(SERIES_BUCKETS.values())
+
+
+def _utc(epoch: int) -> datetime:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc)
+
+
+def _aware(ts: datetime) -> datetime:
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+
+
+def _midnight(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def _month_floor(ts: datetime) -> datetime:
+    return ts.replace(day=1)
+
+
+def _month_ceil(ts: datetime) -> datetime:
+    if ts.day == 1:
+        return ts
+    return (ts.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def plan_tiers(
+    since: datetime, until: datetime, compacted_through: date | None, *, daily: bool = True, monthly: bool = True,
+) -> list[tuple[str, datetime, datetime]]:
+    """Split hour-aligned ``[since, until)`` into ``(tier, lo, hi)`` rollup segments.
+
+    Whole days up to ``compacted_through`` go to the daily tier and whole months
+    inside them to the monthly tier; partial days at either end stay hourly.
+    """
+    if not daily or compacted_through is None:
+        return [("hourly", since, until)]
+    day_lo = _midnight(since.date()) if since == _midnight(since.date()) else _midnight(since.date() + timedelta(days=1))
+    day_hi = min(_midnight(until.date()), _midnight(compacted_through + timedelta(days=1)))
+    if day_lo >= day_hi:
+        return [("hourly", since, until)]
+    plan = [("hourly", since, day_lo), ("hourly", day_hi, until)]
+    month_lo, month_hi = _month_ceil(day_lo), _month_floor(day_hi)
+    if monthly and month_lo < month_hi:
+        plan += [("daily", day_lo, month_lo), ("monthly", month_lo, month_hi), ("daily", month_hi, day_hi)]
+    else:
+        plan.append(("daily", day_lo, day_hi))
+    return [(tier, lo, hi) for tier, lo, hi in plan if lo < hi]
+
+
+async def _watermarks(session: AsyncSession) -> tuple[int, date | None]:
+    rows = dict((await session.execute(
+        select(RollupWatermark.name, RollupWatermark.last_id)
+        .where(RollupWatermark.name.in_([HOURLY_ROLLUP_WATERMARK, DAILY_ROLLUP_WATERMARK]))
+    )).all())
+    daily = rows.get(DAILY_ROLLUP_WATERMARK)
+    return rows.get(HOURLY_ROLLUP_WATERMARK) or 0, date.fromordinal(daily) if daily else None
+
+
+def _raw_select(key, lo: datetime, hi: datetime, flt: SeriesFilter, *conds):
+    e = TrafficEvent
+    k = key(e, e.event_time).label("k")
+    stmt = (
+        select(k, func.sum(e.bytes_up), func.sum(e.bytes_down))
+        .where(e.event_time >= lo, e.event_time < hi, *conds)
+        .group_by(k)
+    )
+    if flt.user_id:
+        stmt = stmt.where(e.user_id == flt.user_id)
+    if flt.tenant_id:
+        stmt = stmt.where(tenant_of(e.user_id) == flt.tenant_id)
+    if flt.node_id:
+        stmt = stmt.where(e.node_id == flt.node_id)
+    return stmt
+
+
+def _rollup_select(tier: str, key, lo: datetime, hi: datetime, flt: SeriesFilter):
+    table, column = ROLLUP_TIERS[tier]
+    col = getattr(table, column)
+    k = key(table, col).label("k")
+    bounds = (lo, hi) if tier == "hourly" else (lo.date(), hi.date())
+    stmt = (
+        select(k, func.sum(table.bytes_up), func.sum(table.bytes_down))
+        .where(col >= bounds[0], col < bounds[1])
+        .group_by(k)
+    )
+    if flt.user_id:
+        stmt = stmt.where(table.user_id == flt.user_id)
+    if flt.tenant_id:
+        stmt = stmt.where(table.tenant_id == flt.tenant_id)
+    if flt.node_id:
+        stmt = stmt.where(table.node_id == flt.node_id)
+    return stmt
+
+
+async def _tiered_sums(
+    session: AsyncSession, key, since: datetime, until: datetime, flt: SeriesFilter, *, daily: bool, monthly: bool,
+) -> tuple[list[str], dict]:
+    """Sum bytes per ``key(table, time_column)`` across tiers; returns the tiers read and the sums."""
+    sums: dict = {}
+
+    def add(rows):
+        for k, up, down in rows:
+            s = sums.setdefault(k, [0, 0])
+            s[0] += up or 0
+            s[1] += down or 0
+
+    hourly_wm, compacted = await _watermarks(session)
+    tiers = []
+    if hourly_wm:
+        for tier, lo, hi in plan_tiers(since, until, compacted, daily=daily, monthly=monthly):
+            tiers.append(tier)
+            add((await session.execute(_rollup_select(tier, key, lo, hi, flt))).all())
+    # Tail: events not yet folded into hourly rollups (ids above the watermark)
+    add((await session.execute(_raw_select(key, since, until, flt, TrafficEvent.id > hourly_wm))).all())
+    return tiers or ["raw"], sums
+
+
+async def traffic_totals(
+    session: AsyncSession, since: datetime | None, until: datetime | None, flt: SeriesFilter,
+) -> dict[uuid.UUID | None, list[int]]:
+    """Per-user ``[bytes_up, bytes_down]`` over hour-aligned ``[since, until)`` (open ends allowed).
+
+    Traffic without a user is reported under ``None``, from raw events and rollups alike.
+    """
+    since = _aware(since) if since else MIN_TIME
+    until = _aware(until) if until else MAX_TIME
+    _, sums = await _tiered_sums(session, lambda table, col: table.user_id, since, until, flt, daily=True, monthly=True)
+    unattributed = sums.pop(NO_ID, None)
+    if unattributed:
+        s = sums.setdefault(None, [0, 0])
+        s[0] += unattributed[0]
+        s[1] += unattributed[1]
+    return sums
+
+
+async def traffic_series(
+    session: AsyncSession,
+    since: datetime,
+    until: datetime,
+    flt: SeriesFilter,
+    bucket_seconds: int | None = None,
+    *,
+    raw_since: datetime | None = None,
+) -> tuple[str, int, list[tuple[datetime, int, int]]]:
+    """Return ``(tier, bucket_seconds, [(bucket_start, up, down), ...])`` with empty buckets zero-filled.
+
+    ``tier`` is the coarsest tier read. ``raw_since`` is the oldest time raw
+    events are still kept for; a range starting before it gets hourly or wider
+    buckets when none is requested. Raises ``ValueError`` for an empty range,
+    one needing more than ``MAX_SERIES_POINTS`` buckets, or a sub-hour bucket
+    before ``raw_since``.
+    """
+    lo, hi = int(_aware(since).timestamp()), int(_aware(until).timestamp())
+    if hi <= lo:
+        raise ValueError("until must be after since")
+    past_raw = raw_since is not None and lo < _aware(raw_since).timestamp()
+    if bucket_seconds and bucket_seconds % 3600 and past_raw:
+        raise ValueError(f"buckets under an hour only reach back to {_aware(raw_since).isoformat()} (raw retention); use 1h or wider")
+    width = bucket_seconds or choose_bucket(hi - lo, min_width=3600 if past_raw else 0)
+    first = lo // width * width
+    last = -(-hi // width) * width  # exclusive, ceil to the bucket boundary
+    if (last - first) // width > MAX_SERIES_POINTS:
+        raise ValueError(f"range needs more than {MAX_SERIES_POINTS} buckets of {width}s; use a wider bucket")
+    dialect_name = (await session.connection()).dialect.name
+
+    def key(table, col):
+        return epoch_bucket(col, width, dialect_name)
+
+    if width % 3600:
+        rows = (await session.execute(_raw_select(key, _utc(first), _utc(last), flt))).all()
+        tiers, sums = ["raw"], {k: [up or 0, down or 0] for k, up, down in rows}
+    else:
+        tiers, sums = await _tiered_sums(
+            session, key, _utc(first), _utc(last), flt, daily=width % 86400 == 0, monthly=False,
+        )
+    tier = next((t for t in ("monthly", "daily", "hourly", "raw") if t in tiers), "raw")
+    sums = {int(k): v for k, v in sums.items()}
+    points = [(_utc(b), *sums.get(b, (0, 0))) for b in range(first, last, width)]
+    return tier, width, points
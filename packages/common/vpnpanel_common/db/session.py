@@ -0,0 +1,20 @@
+"""Async engine / session factory for background services (collector, scheduler).
+
+The control API keeps its own engine in ``apps/control_api/db.py``; services that
+only need a connection pool for batch writers share this helper.
+"""
+from functools import lru_cache
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from ..config import get_settings
+
+
+def get_database_url() -> str:
+    return get_settings().database_url or "sqlite+aiosqlite:///./vpnpanel.db"
+
+
+@lru_cache
+def get_sessionmaker() -> async_sessionmaker:
+    engine = create_async_engine(get_database_url(), future=True, pool_pre_ping=True)
+    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
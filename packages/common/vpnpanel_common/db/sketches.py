@@ -0,0 +1,97 @@
+"""Persistence for per-hour traffic sketches (``traffic_sketches_hourly``).
+
+Writers merge their in-memory deltas into the stored row under a row lock, so
+any number of collectors can contribute to the same (scope, id, hour). Both
+ingest paths (the collector's gRPC stream and the control API's HTTP batch)
+build their deltas with ``observe_rows``. Readers merge the rows of a bounded
+hour range, which keeps every query O(hours).
+"""
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Mapping
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..sketches import HyperLogLog, SpaceSaving
+from .models import TrafficSketchHourly
+
+SketchKey = tuple[str, uuid.UUID, datetime]  # (scope, scope_id, hour_start)
+MAX_SKETCH_HOURS = 24 * 31
+HLL_PRECISION = 12  # stored sketches only merge with sketches of the same precision
+
+
+def observe_rows(
+    deltas: dict[SketchKey, tuple[HyperLogLog, SpaceSaving]],
+    rows: Iterable[Mapping[str, Any]],
+    tenant_of: Callable[[Mapping[str, Any]], uuid.UUID | None],
+    *,
+    top_capacity: int,
+    hll_precision: int = HLL_PRECISION,
+) -> None:
+    """Add each row's user and bytes to the (node, hour) and (tenant, hour) sketches in ``deltas``."""
+    for r in rows:
+        who = r.get("user_id") or r.get("subscription_id")
+        if who is None:
+            continue
+        hour = r["event_time"].astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        weight = int(r.get("bytes_up") or 0) + int(r.get("bytes_down") or 0)
+        for scope, scope_id in (("node", r.get("node_id")), ("tenant", tenant_of(r))):
+            if scope_id is None:
+                continue
+            pair = deltas.get((scope, scope_id, hour))
+            if pair is None:
+                pair = deltas[(scope, scope_id, hour)] = (HyperLogLog(hll_precision), SpaceSaving(top_capacity))
+            pair[0].add(str(who))
+            pair[1].add(str(who), weight)
+
+
+async def merge_sketches(session: AsyncSession, deltas: dict[SketchKey, tuple[HyperLogLog, SpaceSaving]]) -> None:
+    """Fold ``deltas`` into the stored rows; the caller commits."""
+    if not deltas:
+        return
+    dialect_name = (await session.connection()).dialect.name
+    dialect_insert = pg_insert if dialect_name == "postgresql" else sqlite_insert
+    for (scope, scope_id, hour), (hll, top) in sorted(deltas.items(), key=lambda kv: (kv[0][0], str(kv[0][1]), kv[0][2])):
+        res = await session.execute(
+            dialect_insert(TrafficSketchHourly.__table__)
+            .values(scope=scope, scope_id=scope_id, hour_start=hour, active_users=hll.to_bytes(), top_users=top.to_dict())
+            .on_conflict_do_nothing()
+        )
+        if res.rowcount:
+            continue
+        row = (await session.execute(
+            select(TrafficSketchHourly).where(
+                TrafficSketchHourly.scope == scope,
+                TrafficSketchHourly.scope_id == scope_id,
+                TrafficSketchHourly.hour_start == hour,
+            ).with_for_update()
+        )).scalars().one()
+        row.active_users = HyperLogLog.from_bytes(row.active_users).merge(hll).to_bytes()
+        row.top_users = SpaceSaving.from_dict(row.top_users).merge(top).to_dict()
+
+
+async def load_sketches(
+    session: AsyncSession, scope: str, scope_id: uuid.UUID, since: datetime, until: datetime,
+) -> list[tuple[datetime, HyperLogLog, SpaceSaving]]:
+    rows = (await session.execute(
+        select(TrafficSketchHourly).where(
+            TrafficSketchHourly.scope == scope,
+            TrafficSketchHourly.scope_id == scope_id,
+            TrafficSketchHourly.hour_start >= since,
+            TrafficSketchHourly.hour_start < until,
+        ).order_by(TrafficSketchHourly.hour_start)
+    )).scalars().all()
+    return [(r.hour_start, HyperLogLog.from_bytes(r.active_users), SpaceSaving.from_dict(r.top_users)) for r in rows]
+
+
+async def prune_sketches(session_factory: async_sessionmaker, *, retention_days: int, now: datetime | None = None) -> int:
+    now = now or datetime.now(timezone.utc)
+    async with session_factory() as session:
+        res = await session.execute(
+            delete(TrafficSketchHourly).where(TrafficSketchHourly.hour_start < now - timedelta(days=retention_days))
+        )
+        await session.commit()
+    return res.rowcount
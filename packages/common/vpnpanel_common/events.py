@@ -0,0 +1,34 @@
+"""Best-effort cross-service notifications over Redis pub/sub.
+
+Publishers never fail the caller: if Redis is down the message is dropped and
+logged, and consumers fall back to their periodic database reconcile.
+"""
+import asyncio
+import json
+import uuid
+from datetime import datetime
+
+from .logging import get_logger
+from .redis_client import get_redis
+
+log = get_logger("events")
+
+SUBSCRIPTION_EXPIRY_CHANNEL = "vpnpanel:subscription_expiry"
+PUBLISH_TIMEOUT_SECONDS = 1.0
+
+
+async def publish(channel: str, payload: dict) -> bool:
+    try:
+        await asyncio.wait_for(get_redis().publish(channel, json.dumps(payload)), PUBLISH_TIMEOUT_SECONDS)
+        return True
+    except Exception as e:  # noqa: BLE001 - notification only; consumers reconcile from the DB
+        log.warning("event_publish_failed", channel=channel, error=str(e))
+        return False
+
+
+async def publish_subscription_expiry(subscription_id: uuid.UUID, expiry_at: datetime | None, active: bool) -> bool:
+    return await publish(SUBSCRIPTION_EXPIRY_CHANNEL, {
+        "id": str(subscription_id),
+        "expiry_at": expiry_at.isoformat() if expiry_at else None,
+        "active": active,
+    })
@@ -0,0 +1,50 @@
+"""mTLS helpers shared by the node-facing gRPC servers (collector, control API) and the node agent.
+
+Nodes present a client certificate issued by the internal CA whose SAN is their
+node_id; the servers trust that instead of per-request credentials.
+"""
+from typing import Any
+
+import grpc
+
+
+def peer_node_id(context: Any) -> str | None:
+    """Node id from the client certificate SAN, if the channel is mTLS."""
+    try:
+        sans = context.auth_context().get("x509_subject_alternative_name") or []
+    except Exception:  # noqa: BLE001 - insecure channel / test double
+        return None
+    return sans[0].decode() if sans else None
+
+
+def server_credentials(settings) -> grpc.ServerCredentials | None:
+    """Server credentials from ``GRPC_TLS_*``; client certs are required when ``INTERNAL_CA_CERT_PATH`` is set."""
+    if not (settings.grpc_tls_cert_path and settings.grpc_tls_key_path):
+        return None
+    with open(settings.grpc_tls_key_path, "rb") as f:
+        key = f.read()
+    with open(settings.grpc_tls_cert_path, "rb") as f:
+        cert = f.read()
+    ca = None
+    if settings.internal_ca_cert_path:
+        with open(settings.internal_ca_cert_path, "rb") as f:
+            ca = f.read()
+    return grpc.ssl_server_credentials([(key, cert)], root_certificates=ca, require_client_auth=ca is not None)
+
+
+def channel_credentials(settings) -> grpc.ChannelCredentials | None:
+    """Node agent side: verify the server against ``INTERNAL_CA_CERT_PATH`` and present ``GRPC_TLS_*``.
+
+    None (insecure channel) when no CA is configured.
+    """
+    if not settings.internal_ca_cert_path:
+        return None
+    with open(settings.internal_ca_cert_path, "rb") as f:
+        ca = f.read()
+    key = cert = None
+    if settings.grpc_tls_cert_path and settings.grpc_tls_key_path:
+        with open(settings.grpc_tls_key_path, "rb") as f:
+            key = f.read()
+        with open(settings.grpc_tls_cert_path, "rb") as f:
+            cert = f.read()
+    return grpc.ssl_channel_credentials(root_certificates=ca, private_key=key, certificate_chain=cert)
@@ -13,6 +13,74 @@ http_request_duration_seconds = Histogram(
     "http_request_duration_seconds", "HTTP request latency", ["method", "path"], registry=registry
 )
 service_info = Gauge("service_info", "Static service info", ["service", "version"], registry=registry)
+traffic_ingest_duplicates_total = Counter(
+    "traffic_ingest_duplicates_total", "Redelivered traffic samples dropped by dedupe", ["stage"], registry=registry
+)
+traffic_ingest_bytes_total = Counter(
+    "traffic_ingest_bytes_total", "Traffic bytes persisted by the collector", ["engine", "dir"], registry=registry
+)
+traffic_ingest_rejected_total = Counter(
+    "traffic_ingest_rejected_total", "Samples dead-lettered because their rows could not be written", registry=registry
+)
+traffic_ingest_lag_seconds = Gauge(
+    "traffic_ingest_lag_seconds", "Age of the oldest sample in the last flushed batch", registry=registry
+)
+traffic_ingest_queue_depth = Gauge(
+    "traffic_ingest_queue_depth", "Samples buffered in the collector write-behind queue", registry=registry
+)
+traffic_rollup_events_total = Counter(
+    "traffic_rollup_events_total", "traffic_events id span folded into hourly rollups", registry=registry
+)
+traffic_rollup_watermark = Gauge(
+    "traffic_rollup_watermark", "Last traffic_events.id folded into hourly rollups", registry=registry
+)
+traffic_compaction_days_total = Counter(
+    "traffic_compaction_days_total", "Closed days of hourly rollups compacted into daily/monthly rollups", registry=registry
+)
+usage_counter_fallbacks_total = Counter(
+    "usage_counter_fallbacks_total", "Usage increments written to the database because Redis was unavailable", registry=registry
+)
+quota_enforcements_total = Counter(
+    "quota_enforcements_total", "Subscriptions deactivated for expiry or quota", ["reason"], registry=registry
+)
+node_config_syncs_total = Counter(
+    "node_config_syncs_total", "Config updates sent to node agents over StreamEnforcements", ["kind"], registry=registry
+)
+enforcement_queue_depth = Gauge(
+    "enforcement_queue_depth", "Enforcement commands queued or awaiting an ack across connected nodes", registry=registry
+)
+enforcement_commands_total = Counter(
+    "enforcement_commands_total", "Enforcement commands by outcome (sent, coalesced, retried, acked, failed)", ["outcome"], registry=registry
+)
+enforcement_ack_latency_seconds = Histogram(
+    "enforcement_ack_latency_seconds", "First send to successful EnforcementResult", registry=registry,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+config_render_cache_total = Counter(
+    "config_render_cache_total", "Client config / QR requests by cache outcome (hit, miss, not_modified)", ["kind", "result"],
+    registry=registry,
+)
+node_spool_fill_ratio = Gauge(
+    "node_spool_fill_ratio", "Share of the node agent's sample spool holding unconfirmed samples", registry=registry
+)
+node_spool_high_watermark = Gauge(
+    "node_spool_high_watermark", "1 while the node agent's sample spool is at least 80% full", registry=registry
+)
+node_spool_dropped_total = Counter(
+    "node_spool_dropped_total", "Oldest spooled samples overwritten because the spool was full", registry=registry
+)
+node_spool_replayed_total = Counter(
+    "node_spool_replayed_total", "Spooled samples sent to the collector after reconnecting", registry=registry
+)
+partitions_created_total = Counter(
+    "partitions_created_total", "Partitions created by scheduler maintenance", ["table"], registry=registry
+)
+partitions_dropped_total = Counter(
+    "partitions_dropped_total", "Expired partitions detached and dropped by scheduler maintenance", ["table"], registry=registry
+)
+partition_default_rows = Gauge(
+    "partition_default_rows", "Rows left in a table's DEFAULT partition after maintenance", ["table"], registry=registry
+)
 
 async def metrics(request):  # type: ignore
     return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
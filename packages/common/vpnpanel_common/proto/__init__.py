@@ -0,0 +1,8 @@
+# Generated gRPC stubs (make generate-proto). grpc_tools emits flat imports
+# (`import node_control_pb2`) in the *_grpc module, so expose this directory.
+import os
+import sys
+
+_here = os.path.dirname(__file__)
+if _here not in sys.path:
+    sys.path.append(_here)
@@ -0,0 +1,23 @@
+"""Shared asyncio Redis client.
+
+``REDIS_URL=fakeredis://`` swaps in an in-process fakeredis server, so services
+and tests can run without a Redis instance (state is per process).
+"""
+from functools import lru_cache
+
+from .config import get_settings
+
+FAKE_REDIS_SCHEME = "fakeredis://"
+
+
+@lru_cache
+def get_redis():
+    url = get_settings().redis_url
+    if url.startswith(FAKE_REDIS_SCHEME):
+        from fakeredis import FakeAsyncRedis
+
+        return FakeAsyncRedis()
+    import redis.asyncio as redis
+
+    # no socket_timeout: it would also cut blocking pub/sub reads; callers bound their own waits
+    return redis.from_url(url, socket_connect_timeout=1)
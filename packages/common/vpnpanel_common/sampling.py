@@ -0,0 +1,14 @@
+"""Sampling phase shared by node agents and the collector.
+
+Every node samples once per ``SAMPLE_INTERVAL_SECONDS``, at a fixed offset
+(its phase) into each interval of the wall clock. The default phase is derived
+from the node id, so a fleet restarted at once still spreads its pushes over
+the whole interval. The collector can advertise a better one on its acks.
+"""
+import hashlib
+
+
+def node_phase(node_id: str, interval: float) -> float:
+    """Deterministic offset in [0, interval) for ``node_id``, uniform over node ids."""
+    digest = hashlib.sha256(node_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 * interval
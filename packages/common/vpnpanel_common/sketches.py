@@ -0,0 +1,104 @@
+"""Mergeable streaming sketches for traffic analytics.
+
+``HyperLogLog`` estimates distinct counts (active users) in ``2**p`` bytes with
+~``1.04 / sqrt(2**p)`` relative error. ``SpaceSaving`` keeps the heaviest
+``capacity`` items of a weighted stream (bandwidth per user). Every reported
+count overestimates the true count by at most its ``error``. Both merge, so
+per-collector, per-hour sketches can be combined at write time and read time.
+"""
+import hashlib
+import math
+
+
+def _hash64(item: str) -> int:
+    return int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    def __init__(self, p: int = 12, registers: bytes | None = None):
+        if not 4 <= p <= 16:
+            raise ValueError("p must be between 4 and 16")
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("register count does not match p")
+
+    def add(self, item: str) -> None:
+        h = _hash64(item)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.p != self.p:
+            raise ValueError("cannot merge sketches with different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.p]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        return cls(p=data[0], registers=data[1:])
+
+
+class SpaceSaving:
+    def __init__(self, capacity: int = 64, counters: dict[str, list[int]] | None = None):
+        self.capacity = capacity
+        self.counters: dict[str, list[int]] = {k: list(v) for k, v in (counters or {}).items()}  # item -> [count, error]
+
+    def __len__(self) -> int:
+        return len(self.counters)
+
+    def _floor(self) -> int:
+        """Upper bound on the count of any item not tracked (0 until the summary is full)."""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(c for c, _ in self.counters.values())
+
+    def add(self, item: str, weight: int = 1) -> None:
+        entry = self.counters.get(item)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + weight, floor]
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        floor_a, floor_b = self._floor(), other._floor()
+        merged = {}
+        for item in self.counters.keys() | other.counters.keys():
+            a = self.counters.get(item, [floor_a, floor_a])
+            b = other.counters.get(item, [floor_b, floor_b])
+            merged[item] = [a[0] + b[0], a[1] + b[1]]
+        keep = sorted(merged, key=lambda k: merged[k][0], reverse=True)[: self.capacity]
+        self.counters = {k: merged[k] for k in keep}
+        return self
+
+    def top(self, n: int) -> list[tuple[str, int, int]]:
+        """``(item, count, error)`` for the ``n`` heaviest items, heaviest first."""
+        ranked = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)[:n]
+        return [(item, c, e) for item, (c, e) in ranked]
+
+    def to_dict(self) -> dict:
+        return {"capacity": self.capacity, "counters": self.counters}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SpaceSaving":
+        return cls(capacity=data["capacity"], counters=data["counters"])
@@ -0,0 +1,201 @@
+"""Live per-subscription usage kept as Redis hot counters.
+
+The collector ``HINCRBY``s the bytes of every inserted sample into
+``vpnpanel:usage:<subscription id>`` (one field per engine) and marks the
+subscription dirty. A periodic flush atomically takes the pending hashes of the
+dirty subscriptions, adds them to ``Subscription.consumed_bytes`` with one
+aggregated ``UPDATE`` and deactivates whatever is now over quota. Readers get
+the live value as ``consumed_bytes`` plus the pending delta, with no aggregate
+over traffic.
+
+Quota is not left to the flush: ``charge_and_commit`` counts a batch before
+its ingest transaction commits, and deactivates in that transaction every
+subscription whose ``consumed_bytes`` plus pending delta reaches its quota.
+If Redis is unreachable the batch is charged to ``consumed_bytes`` in that
+transaction instead, so the rows and their usage commit (or fail) together.
+A commit that fails after the increment takes it back out of Redis. A flush
+whose database write fails puts the taken deltas back.
+"""
+import asyncio
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Iterable, Mapping
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .db.quota import charge_usage, deactivate_over_quota, per_subscription
+from .logging import get_logger
+from .metrics import quota_enforcements_total, usage_counter_fallbacks_total
+from .redis_client import get_redis
+
+log = get_logger("usage")
+
+USAGE_KEY_PREFIX = "vpnpanel:usage:"
+DIRTY_KEY = "vpnpanel:usage:dirty"
+UNKNOWN_ENGINE = "unknown"
+
+
+def usage_key(subscription_id: uuid.UUID | str) -> str:
+    return f"{USAGE_KEY_PREFIX}{subscription_id}"
+
+
+def _engine_field(engine) -> str:
+    if engine is None:
+        return UNKNOWN_ENGINE
+    return getattr(engine, "value", engine)
+
+
+def _decode(raw: Mapping) -> dict[str, int]:
+    return {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in raw.items()}
+
+
+async def pending_usage(subscription_ids: Iterable[uuid.UUID], redis=None) -> dict[uuid.UUID, dict[str, int]]:
+    """Unflushed bytes per engine for each subscription; empty if Redis is unavailable."""
+    ids = list(subscription_ids)
+    if not ids:
+        return {}
+    redis = redis or get_redis()
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for sub_id in ids:
+                pipe.hgetall(usage_key(sub_id))
+            raw = await asyncio.wait_for(pipe.execute(), 1.0)
+    except Exception as e:  # noqa: BLE001 - live view degrades to the stored counter
+        log.warning("usage_pending_read_failed", error=str(e))
+        return {}
+    return {sub_id: _decode(r) for sub_id, r in zip(ids, raw) if r}
+
+
+def report_enforcements(counts: Mapping[str, int]) -> None:
+    """Add deactivations per reason to ``quota_enforcements_total``."""
+    for reason, n in counts.items():
+        if n:
+            quota_enforcements_total.labels(reason=reason).inc(n)
+    if any(counts.values()):
+        log.info("subscriptions_enforced", **counts)
+
+
+class UsageCounters:
+    def __init__(self, session_factory: async_sessionmaker, redis=None, *, flush_batch: int = 1000):
+        self.session_factory = session_factory
+        self._redis = redis
+        self.flush_batch = flush_batch
+        self._task: asyncio.Task | None = None
+
+    @property
+    def redis(self):
+        return self._redis or get_redis()
+
+    async def _incr(self, usage: Mapping[tuple[uuid.UUID, object], int]) -> dict[uuid.UUID, int]:
+        """``HINCRBY`` ``usage``; returns each touched subscription's pending bytes afterwards."""
+        sub_ids = sorted({sub_id for sub_id, _ in usage}, key=str)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (sub_id, engine), n in usage.items():
+                pipe.hincrby(usage_key(sub_id), _engine_field(engine), n)
+            pipe.sadd(DIRTY_KEY, *{str(sub_id) for sub_id in sub_ids})
+            for sub_id in sub_ids:
+                pipe.hvals(usage_key(sub_id))
+            results = await pipe.execute()
+        return {sub_id: sum(int(v) for v in vals) for sub_id, vals in zip(sub_ids, results[-len(sub_ids):])}
+
+    async def _retract(self, usage: Mapping[tuple[uuid.UUID, object], int]) -> None:
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for (sub_id, engine), n in usage.items():
+                    pipe.hincrby(usage_key(sub_id), _engine_field(engine), -n)
+                await pipe.execute()
+        except Exception as e:  # noqa: BLE001 - the rows were not committed; this usage is now overcounted
+            log.error("usage_counter_retract_failed", error=str(e), subscriptions=len(usage))
+
+    async def charge_and_commit(self, session: AsyncSession, usage: Mapping[tuple[uuid.UUID, object], int], now: datetime) -> Counter:
+        """Count ``(subscription_id, engine) -> bytes`` inserted in ``session``, then commit it.
+
+        Returns the subscriptions deactivated, per reason. Raises, with nothing
+        counted, if neither Redis nor the database takes the usage.
+        """
+        usage = {key: n for key, n in usage.items() if n}
+        counts: Counter = Counter()
+        if not usage:
+            await session.commit()
+            return counts
+        try:
+            pending = await self._incr(usage)
+        except Exception as e:  # noqa: BLE001 - never lose usage: charge it with the rows instead
+            log.warning("usage_counter_incr_failed", error=str(e), subscriptions=len(usage))
+            usage_counter_fallbacks_total.inc()
+            counts = await charge_usage(session, per_subscription(usage), now)
+            await session.commit()
+            return counts
+        try:
+            await deactivate_over_quota(session, pending, now, counts)
+            await session.commit()
+        except BaseException:
+            await self._retract(usage)
+            raise
+        return counts
+
+    async def _charge(self, totals: Mapping[uuid.UUID, int]) -> Counter:
+        async with self.session_factory() as session:
+            counts = await charge_usage(session, totals, datetime.now(timezone.utc))
+            await session.commit()
+        report_enforcements(counts)
+        return counts
+
+    async def _take(self, sub_ids: list[str]) -> list[dict[str, int]]:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for sub_id in sub_ids:
+                pipe.hgetall(usage_key(sub_id))
+                pipe.delete(usage_key(sub_id))
+            results = await pipe.execute()
+        return [_decode(r) for r in results[::2]]
+
+    async def _restore(self, sub_ids: list[str], taken: list[dict[str, int]]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for sub_id, fields in zip(sub_ids, taken):
+                for engine, n in fields.items():
+                    pipe.hincrby(usage_key(sub_id), engine, n)
+            pipe.sadd(DIRTY_KEY, *sub_ids)
+            await pipe.execute()
+
+    async def flush(self) -> int:
+        """Fold pending counters into ``consumed_bytes``; returns the bytes flushed."""
+        flushed = 0
+        while True:
+            popped = await self.redis.spop(DIRTY_KEY, self.flush_batch)
+            if not popped:
+                return flushed
+            sub_ids = [s.decode() if isinstance(s, bytes) else s for s in popped]
+            taken = await self._take(sub_ids)
+            # Not ``+totals``: a retracted increment can leave a negative delta that must still be applied
+            totals = Counter({uuid.UUID(sub_id): sum(fields.values()) for sub_id, fields in zip(sub_ids, taken)})
+            try:
+                await self._charge(totals)
+            except Exception:
+                await self._restore(sub_ids, taken)
+                raise
+            flushed += sum(totals.values())
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:  # noqa: BLE001 - deltas stay in Redis for the next flush
+                log.exception("usage_flush_failed")
+
+    def start(self, interval: float) -> asyncio.Task:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+        return self._task
+
+    async def stop(self) -> None:
+        """Cancel the flush loop and fold in whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
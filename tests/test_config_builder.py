@@ -0,0 +1,123 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.control_api.config_builder import ConfigBuilder
+from apps.control_api.config_outbox import ConfigChangeConsumer
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import (
+    Assignment, ConfigChange, Credential, EngineType, Node, Plan, ProtocolType, Subscription, Tenant, User, UserEngines, XRayInbound,
+)
+from packages.common.vpnpanel_common.db.outbox import record_config_change
+
+TABLES = (Tenant, User, Node, Plan, Subscription, Credential, UserEngines, XRayInbound, Assignment, ConfigChange)
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in TABLES])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def _seed(sf):
+    tenant = Tenant(id=uuid.uuid4(), name="acme")
+    plan = Plan(id=uuid.uuid4(), tenant_id=tenant.id, name="basic", quota_bytes=1000)
+    nodes = [Node(id=uuid.uuid4(), name=f"node-{i}") for i in range(2)]
+    users, subs = [], []
+    async with sf() as session:
+        session.add_all([tenant, plan, *nodes])
+        session.add(XRayInbound(node_id=nodes[0].id, tag="vless-ws", port=443, protocol=ProtocolType.vless,
+                                settings={"clients": [], "streamSettings": {"network": "ws"}}))
+        for i in range(3):
+            user = User(id=uuid.uuid4(), email=f"u{i}@example.com", password_hash="x")
+            sub = Subscription(id=uuid.uuid4(), tenant_id=tenant.id, user_id=user.id, plan_id=plan.id)
+            session.add_all([
+                user, sub, UserEngines(user_id=user.id),
+                Credential(user_id=user.id, engine=EngineType.xray, secret={"uuid": f"xray-{i}"}),
+                Credential(user_id=user.id, engine=EngineType.wireguard, secret={"public_key": f"wg-{i}"}),
+                Assignment(user_id=user.id, node_id=nodes[0].id),
+            ])
+            users.append(user.id)
+            subs.append(str(sub.id))
+        await session.commit()
+    return [n.id for n in nodes], users, subs
+
+
+async def _write(sf, *stmts, **change):
+    async with sf() as session:
+        for stmt in stmts:
+            await session.execute(stmt)
+        revisions = await record_config_change(session, **change)
+        await session.commit()
+    return revisions
+
+
+@pytest.mark.asyncio
+async def test_outbox_drives_snapshot_and_incremental_delta(session_factory):
+    (node, other), users, subs = await _seed(session_factory)
+    builder = ConfigBuilder(session_factory, history=2)
+    consumer = ConfigChangeConsumer(builder)
+    pushed = []
+
+    async def on_delta(node_id, delta):
+        pushed.append((node_id, delta.from_revision, delta.revision))
+    consumer.add_listener(on_delta)
+
+    full = await builder.full(node)
+    assert full.revision == 0
+    assert [i.tag for i in full.xray_inbounds] == ["vless-ws"]
+    assert full.xray_inbounds[0].stream_settings_json == '{"network": "ws"}'
+    assert len(full.subscriptions) == 6
+    xray = next(e for e in full.subscriptions if e.subscription_id == subs[0] and e.engine == "xray")
+    assert (xray.secret, xray.quota_bytes, xray.status, xray.display_name) == ("xray-0", 1000, "active", "u0@example.com")
+    assert await consumer.poll() == {}
+
+    # user 0 loses wireguard: the write and its outbox row commit together
+    stmt = update(UserEngines).where(UserEngines.user_id == users[0]).values(allow_wireguard=False)
+    assert await _write(session_factory, stmt, user_ids=[users[0]]) == {node: 1}
+    assert (await builder.full(node)).revision == 0  # cached until the consumer catches up
+    assert await consumer.poll() == {node: 1}
+    assert pushed == [(node, 0, 1)]
+    d = await builder.delta(node, 0)
+    assert (d.revision, list(d.upserts), [(k.subscription_id, k.engine) for k in d.removed]) == (1, [], [(subs[0], "wireguard")])
+    assert not d.inbounds_changed and not d.full_resync
+
+    # user 1 is exhausted and moves to the other (uncached) node
+    assert await _write(
+        session_factory,
+        update(Subscription).where(Subscription.user_id == users[1]).values(active=False, consumed_bytes=1000),
+        update(Assignment).where(Assignment.user_id == users[1]).values(node_id=other),
+        user_ids=[users[1]], node_ids=[node],
+    ) == {node: 2, other: 1}
+    assert await consumer.poll() == {node: 2}
+    d = await builder.delta(node, 1)
+    assert [(k.subscription_id, k.engine) for k in d.removed] == [(subs[1], "wireguard"), (subs[1], "xray")]
+    assert (await builder.full(other)).revision == 1
+    assert {e.status for e in (await builder.full(other)).subscriptions} == {"exhausted"}
+
+    # two changes between polls are applied as one step
+    await _write(session_factory, delete(XRayInbound), node_ids=[node], inbounds=True)
+    await _write(session_factory, user_ids=[users[2]])  # nothing actually changed
+    assert await consumer.poll() == {node: 4}
+    d = await builder.delta(node, 1)  # merged over revisions 2..4
+    assert d.revision == 4 and d.inbounds_changed and list(d.xray_inbounds) == [] and len(d.removed) == 2
+    d = await builder.delta(node, 0)  # older than the kept history: rebuilt from the outbox rows
+    assert not d.full_resync and d.revision == 4 and d.inbounds_changed
+    assert {(k.subscription_id, k.engine) for k in d.removed} == {(subs[0], "wireguard"), (subs[1], "wireguard"), (subs[1], "xray")}
+    assert {(e.subscription_id, e.engine) for e in d.upserts} == {(subs[0], "xray"), (subs[2], "wireguard"), (subs[2], "xray")}
+    assert len((await builder.full(node)).subscriptions) == 3
+
+    assert await consumer.prune(now=datetime.now(timezone.utc) + timedelta(days=2)) == 5
+    assert (await builder.delta(node, 0)).full_resync  # older than the retained outbox too
+    async with session_factory() as session:
+        await session.execute(delete(Node).where(Node.id == node))
+        await session.commit()
+    await consumer.poll()
+    assert builder.cached() == {other: 1}
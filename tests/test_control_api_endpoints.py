@@ -53,11 +53,28 @@ async def test_control_api_auth_and_crud_flow():
         # Create subscription for second user
         r = await client.post("/subscriptions/", json={"tenant_id": tenant_id, "user_id": user2_id, "plan_id": plan_id}, headers=headers)
         assert r.status_code == 201, r.text
+        sub_id = r.json()["id"]
+
+        # Batch usage snapshot (effective quota from the plan; unknown ids reported as missing)
+        unknown_id = str(uuid.uuid4())
+        r = await client.post("/subscriptions/usage:batch", json={"ids": [sub_id, unknown_id]}, headers=headers)
+        assert r.status_code == 200, r.text
+        usage = r.json()
+        assert [(i["id"], i["consumed_bytes"], i["quota_bytes"], i["remaining_bytes"]) for i in usage["items"]] == [(sub_id, 0, 1000, 1000)]
+        assert usage["missing"] == [unknown_id]
 
         # Assign user to node
         r = await client.post("/assignments/", json={"user_id": user2_id, "node_id": node_id}, headers=headers)
         assert r.status_code == 201, r.text
 
+        # Node config snapshot (no credentials yet) and an up-to-date delta
+        r = await client.get(f"/nodes/{node_id}/config", headers=headers)
+        assert r.status_code == 200, r.text
+        revision = int(r.json()["revision"])
+        assert r.json()["subscriptions"] == []
+        r = await client.get(f"/nodes/{node_id}/config?since={revision}", headers=headers)
+        assert r.status_code == 200 and r.json()["full_resync"] is False, r.text
+
         # Ingest traffic events
         r = await client.post("/traffic/events", json=[{"user_id": user2_id, "node_id": node_id, "bytes_up": 10, "bytes_down": 20}], headers=headers)
         assert r.status_code == 202, r.text
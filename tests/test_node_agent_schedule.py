@@ -0,0 +1,56 @@
+import random
+import uuid
+
+import pytest
+
+from apps.node_agent.schedule import PhaseSchedule
+from packages.common.vpnpanel_common.sampling import node_phase
+
+
+def test_node_phases_spread_over_the_interval():
+    phases = [node_phase(str(uuid.UUID(int=i)), 60) for i in range(6000)]
+    per_10s = [sum(1 for p in phases if lo <= p < lo + 10) for lo in range(0, 60, 10)]
+    assert all(850 < n < 1150 for n in per_10s)
+    assert node_phase("node-1", 60) == node_phase("node-1", 60)
+
+
+def test_ticks_stay_on_the_phase_grid():
+    s = PhaseSchedule("node-1", 60)
+    s.phase = 15.0
+    assert s.next_tick(1000.0) == 1035.0  # 1035 = 17 * 60 + 15
+    s.last = 1035.0
+    assert s.next_tick(1036.3) == 1095.0  # slow sample: no drift
+    s.last = 1095.0
+    assert s.next_tick(1300.0) == 1335.0  # overslept: missed ticks are skipped, not bursted
+    s.last = 1335.0
+    s.set_phase(40.0)
+    assert s.next_tick(1336.0) == 1420.0  # 1380 is under half an interval after the last tick
+    s.set_phase(5.0)
+    assert s.next_tick(1336.0) == 1385.0
+
+
+@pytest.mark.asyncio
+async def test_wait_sleeps_to_the_jittered_tick(monkeypatch):
+    now = [1000.0]
+    slept = []
+
+    async def fake_sleep(delay):
+        slept.append(delay)
+        now[0] += delay
+
+    monkeypatch.setattr("apps.node_agent.schedule.asyncio.sleep", fake_sleep)
+    s = PhaseSchedule("node-1", 60, jitter=10.0, clock=lambda: now[0], rng=random.Random(7))
+    assert s.jitter == 3.0  # capped at 5% of the interval
+    s.phase = 20.0
+    ticks = [await s.wait() for _ in range(50)]
+    assert ticks == [1040.0 + 60 * k for k in range(50)]  # a wakeup up to 3s early never skips or repeats a tick
+    offsets = [now_tick - t for now_tick, t in zip(_wake_times(slept, 1000.0), ticks)]
+    assert max(abs(o) for o in offsets) <= 3.0 and len({round(o, 3) for o in offsets}) > 10
+
+
+def _wake_times(slept, start):
+    t, out = start, []
+    for d in slept:
+        t += d
+        out.append(t)
+    return out
@@ -0,0 +1,136 @@
+import asyncio
+import uuid
+
+import grpc
+import pytest
+
+from apps.node_agent.spool import RECORD, SampleSpool
+from apps.node_agent.testing import FakeCollector
+from apps.node_agent.traffic import TrafficShipper
+from packages.common.vpnpanel_common.metrics import node_spool_dropped_total, node_spool_high_watermark
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+from packages.common.vpnpanel_common.proto import node_control_pb2_grpc
+
+SUBS = [str(uuid.uuid4()) for _ in range(5)]
+
+
+def _samples(n: int, seq: int) -> list:
+    return [
+        pb.TrafficSample(node_id="node-1", subscription_id=SUBS[i % 5], engine="xray" if i % 2 else "wireguard",
+                         bytes_up=i, bytes_down=2 * i, interval_seconds=60, counter_seq=seq, period_end_unix=seq)
+        for i in range(n)
+    ]
+
+
+def test_spool_is_a_persistent_ring(tmp_path):
+    path = str(tmp_path / "samples.spool")
+    spool = SampleSpool(path, "node-1", capacity=10)
+    dropped_before = node_spool_dropped_total._value.get()
+    assert spool.append(_samples(7, seq=1)) == 0
+    assert node_spool_high_watermark._value.get() == 0
+    assert spool.append(_samples(1, seq=2) + [pb.TrafficSample(subscription_id="not-a-uuid", engine="xray")]) == 0
+    assert node_spool_high_watermark._value.get() == 1  # 8 of 10
+    spool.close()
+
+    spool = SampleSpool(path, "node-1", capacity=10)  # reopened after a restart
+    assert len(spool) == 8 and spool.read(spool.head, 100) == _samples(7, seq=1) + _samples(1, seq=2)
+    assert spool.append(_samples(5, seq=3)) == 3  # full: the oldest three are overwritten
+    assert node_spool_dropped_total._value.get() - dropped_before == 3
+    assert (spool.head, spool.tail) == (3, 13)
+    assert spool.read(0, 2) == _samples(7, seq=1)[3:5]  # reads start at head
+    spool.consume_to(11)
+    assert spool.read(spool.head, 100) == _samples(5, seq=3)[3:] and node_spool_high_watermark._value.get() == 0
+    spool.close()
+    assert (tmp_path / "samples.spool").stat().st_size == 64 + 10 * RECORD.size
+
+    assert len(SampleSpool(path, "node-1", capacity=20)) == 0  # capacity changed: starts over
+
+
+def test_appends_are_flushed_at_most_once_per_interval(tmp_path):
+    now = [100.0]
+    spool = SampleSpool(str(tmp_path / "samples.spool"), "node-1", capacity=100, flush_interval=1.0,
+                        monotonic=lambda: now[0])
+    for seq in range(5):  # a burst of appends: one msync at most
+        spool.append(_samples(3, seq=seq))
+        now[0] += 0.1
+    assert spool._dirty
+    now[0] += 0.6
+    spool.append(_samples(3, seq=5))  # the interval has passed
+    assert not spool._dirty
+    spool.append(_samples(3, seq=6))
+    assert spool._dirty
+    spool.flush()  # the agent's timer
+    assert not spool._dirty
+    spool.close()
+    assert len(SampleSpool(str(tmp_path / "samples.spool"), "node-1", capacity=100)) == 21
+
+
+@pytest.mark.asyncio
+async def test_samples_survive_a_collector_outage(tmp_path):
+    collector = FakeCollector()
+    channel = grpc.aio.insecure_channel(await collector.start())
+    spool = SampleSpool(str(tmp_path / "samples.spool"), "node-1", capacity=1000)
+    shipper = TrafficShipper(node_control_pb2_grpc.TrafficIngestStub(channel), spool, replay_batch=20,
+                             retry_base=0.05, retry_max=0.05)
+
+    async def until(predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            await asyncio.sleep(0.02)
+        raise AssertionError("timed out")
+
+    shipper.start()
+    try:
+        await until(lambda: shipper.connected)
+        shipper.submit(_samples(10, seq=1))
+        await until(lambda: len(collector.samples) == 10)
+        assert len(spool) == 0  # live samples never touch the spool
+
+        await collector.stop()
+        await until(lambda: not shipper.connected)
+        for seq in range(2, 12):
+            shipper.submit(_samples(10, seq=seq))
+        assert len(spool) == 100
+
+        await collector.start()  # same port: the shipper reconnects and replays
+        await until(lambda: len(spool) == 0 and shipper.connected)
+        shipper.submit(_samples(10, seq=12))
+        await until(lambda: len(collector.samples) == 120)
+        assert [s.counter_seq for s in collector.samples] == [seq for seq in range(1, 13) for _ in range(10)]
+        assert collector.streams == 2
+    finally:
+        await shipper.stop()
+        await channel.close()
+        await collector.stop()
+        spool.close()
+
+
+@pytest.mark.asyncio
+async def test_samples_the_collector_would_reject_are_not_sent(tmp_path):
+    collector = FakeCollector()
+    channel = grpc.aio.insecure_channel(await collector.start())
+    spool = SampleSpool(str(tmp_path / "samples.spool"), "node-1", capacity=100)
+    shipper = TrafficShipper(node_control_pb2_grpc.TrafficIngestStub(channel), spool, retry_base=0.05, retry_max=0.05)
+    shipper.start()
+    try:
+        for _ in range(200):
+            if shipper.connected:
+                break
+            await asyncio.sleep(0.02)
+        # an Xray client the panel does not manage reports stats under its own email
+        foreign = pb.TrafficSample(node_id="node-1", subscription_id="admin@example.com", engine="xray",
+                                   bytes_up=1, counter_seq=1, period_end_unix=1)
+        for seq in range(1, 4):
+            shipper.submit(_samples(2, seq=seq)[:1] + [foreign] + _samples(2, seq=seq)[1:])
+        for _ in range(200):
+            if len(collector.samples) == 6:
+                break
+            await asyncio.sleep(0.02)
+        assert [s.counter_seq for s in collector.samples] == [1, 1, 2, 2, 3, 3]
+        assert collector.streams == 1 and shipper.connected and len(spool) == 0
+    finally:
+        await shipper.stop()
+        await channel.close()
+        await collector.stop()
+        spool.close()
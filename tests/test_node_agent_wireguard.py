@@ -0,0 +1,78 @@
+import base64
+
+from apps.node_agent.testing import FakeNetlink
+from apps.node_agent.wireguard import PeerState, WgCli, WireGuardDriver
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+
+def _key(i: int) -> str:
+    return base64.b64encode(i.to_bytes(32, "big")).decode()
+
+
+def _entry(i: int, status: str = "active", engine: str = "wireguard") -> pb.SubscriptionEngineConfig:
+    entry = pb.SubscriptionEngineConfig(subscription_id=f"sub-{i}", engine=engine, public_key=_key(i), status=status)
+    entry.meta["address"] = f"10.8.{i // 250}.{i % 250 + 2}"
+    return entry
+
+
+def test_sync_applies_only_the_difference_in_batches():
+    kernel = FakeNetlink([
+        PeerState(_key(0), {"10.8.0.2/32"}),  # up to date
+        PeerState(_key(1), {"10.9.0.1/32"}),  # address moved
+        PeerState(_key(99), {"10.8.0.4/32"}),  # no longer assigned; its IP goes to sub-2
+    ])
+    driver = WireGuardDriver(netlink=kernel, batch_size=2)
+    driver.load(pb.FullNodeConfigPush(subscriptions=[_entry(0), _entry(1), _entry(2), _entry(3, "suspended"),
+                                                     _entry(4, engine="xray")]))
+
+    result = driver.sync()
+    assert (result.added, result.updated, result.removed) == (1, 1, 1)
+    assert kernel.dumps == 1 and kernel.messages == [2, 1]
+    assert {k: v.allowed_ips for k, v in kernel.peers.items()} == {
+        _key(0): {"10.8.0.2/32"}, _key(1): {"10.8.0.3/32"}, _key(2): {"10.8.0.4/32"},
+    }
+    assert driver.sync().messages == 0  # converged: one dump, nothing sent
+
+    # a delta: sub-0 suspended, sub-1 removed, sub-3 resumed
+    driver.update(pb.NodeConfigDelta(upserts=[_entry(0, "suspended"), _entry(3)],
+                                      removed=[pb.SubscriptionKey(subscription_id="sub-1", engine="wireguard")]))
+    result = driver.sync()
+    assert (result.added, result.updated, result.removed, result.messages) == (1, 0, 2, 2)
+    assert set(kernel.peers) == {_key(2), _key(3)}
+
+
+def test_dump_reads_counters_and_handshakes():
+    kernel = FakeNetlink()
+    driver = WireGuardDriver(netlink=kernel)
+    driver.load_peers(_entry(i) for i in range(3))
+    driver.sync()
+    kernel.traffic(_key(1), rx=1500, tx=300, handshake=1_760_000_000.5)
+    peers = driver.dump()
+    assert (peers[_key(1)].rx_bytes, peers[_key(1)].tx_bytes, peers[_key(1)].last_handshake) == (1500, 300, 1_760_000_000.5)
+    assert peers[_key(0)].last_handshake == 0.0
+    assert kernel.dumps == 2
+
+
+def test_wg_cli_fallback_reads_the_dump_and_batches_peers(monkeypatch):
+    cli = WgCli()
+    calls = []
+    dump = "\n".join([
+        "privkey\tpubkey\t51820\toff",
+        f"{_key(0)}\t(none)\t203.0.113.5:40000\t10.8.0.2/32,fd00::2/128\t1760000000\t1500\t300\t25",
+        f"{_key(1)}\t(none)\t(none)\t(none)\t0\t0\t0\toff",
+    ]) + "\n"
+    monkeypatch.setattr(cli, "_run", lambda *args: calls.append(args) or (dump if args[0] == "show" else ""))
+    driver = WireGuardDriver(netlink=cli)
+    driver.load_peers([_entry(0), _entry(2)])
+
+    peers = driver.dump()
+    assert peers[_key(0)] == PeerState(_key(0), {"10.8.0.2/32", "fd00::2/128"}, 25, 1500, 300, 1_760_000_000.0)
+    assert peers[_key(1)] == PeerState(_key(1), set(), 0, 0, 0, 0.0)
+
+    driver.sync()
+    assert calls[-1][:2] == ("set", "wg0")
+    clauses = " ".join(calls[-1][2:])
+    assert f"peer {_key(1)} remove" in clauses
+    assert f"peer {_key(0)} allowed-ips 10.8.0.2/32 persistent-keepalive off" in clauses
+    assert f"peer {_key(2)} allowed-ips 10.8.0.4/32 persistent-keepalive off" in clauses
+    assert len(calls) == 3  # dump, dump, one set for the whole batch
@@ -0,0 +1,91 @@
+import pytest
+
+from apps.node_agent.testing import FakeXrayStats
+from apps.node_agent.xray_stats import CounterTable, XraySampler, XrayStatsClient
+
+
+class Clock:
+    def __init__(self, now: float = 1_760_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _bytes(samples):
+    return {s.subscription_id: (s.bytes_up, s.bytes_down) for s in samples}
+
+
+@pytest.mark.asyncio
+async def test_sampler_emits_deltas_and_handles_restarts():
+    clock = Clock()
+    xray = FakeXrayStats(clock=clock)
+    address = await xray.start()
+    client = XrayStatsClient(address)
+    sampler = XraySampler(client, "node-1", clock=clock, monotonic=clock)
+    try:
+        xray.traffic("sub-a", 100, 1000)
+        xray.traffic("sub-b", 5, 50)
+        assert await sampler.sample() == []  # first round after agent start: baseline only
+
+        clock.now += 60
+        xray.traffic("sub-a", 10, 20)
+        xray.traffic("sub-c", 1, 2)  # new user counts from zero
+        samples = await sampler.sample()
+        assert _bytes(samples) == {"sub-a": (10, 20), "sub-c": (1, 2)}
+        first = samples[0]
+        assert (first.node_id, first.engine, first.interval_seconds, first.period_end_unix) == ("node-1", "xray", 60, int(clock.now))
+        assert first.counter_seq == int(clock.now) and len({s.counter_seq for s in samples}) == 1
+
+        clock.now += 60
+        assert await sampler.sample() == []  # idle round: nothing to send, seq untouched
+        xray.remove("sub-a")
+        xray.traffic("sub-a", 3, 4)  # re-added: counters restart below the last value
+        clock.now += 60
+        samples = await sampler.sample()
+        assert _bytes(samples) == {"sub-a": (3, 4)} and sampler.table.resets == 1
+        seq = samples[0].counter_seq
+
+        # Xray restarts and sub-b already pushed past its old value: still counted from zero
+        clock.now += 30
+        xray.restart()
+        clock.now += 30
+        xray.traffic("sub-b", 40, 400)
+        samples = await sampler.sample()
+        assert _bytes(samples) == {"sub-b": (40, 400)}
+        assert samples[0].counter_seq > seq
+        assert xray.queries == 5  # one QueryStats per round
+        assert len(sampler.table) == 1  # users gone from Xray released their slots
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+@pytest.mark.asyncio
+async def test_wall_clock_step_is_not_a_restart():
+    wall, mono = Clock(), Clock(5_000.0)
+    xray = FakeXrayStats(clock=mono)
+    address = await xray.start()
+    client = XrayStatsClient(address)
+    sampler = XraySampler(client, "node-1", clock=wall, monotonic=mono)
+    try:
+        xray.traffic("sub-a", 100, 1000)
+        await sampler.sample()
+        wall.now -= 30  # NTP steps the wall clock back; Xray's start time by wall clock seems to move forward
+        wall.now += 60
+        mono.now += 60
+        xray.traffic("sub-a", 1, 2)
+        samples = await sampler.sample()
+        assert _bytes(samples) == {"sub-a": (1, 2)}  # not the whole cumulative counter again
+        assert samples[0].interval_seconds == 60 and samples[0].period_end_unix == int(wall.now)
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+def test_counter_table_reuses_slots():
+    table = CounterTable()
+    table.advance({f"u{i}": (i, i) for i in range(100)}, baseline=True)
+    assert table.advance({f"u{i}": (i + 1, i) for i in range(50)}) == [(f"u{i}", 1, 0) for i in range(50)]
+    table.advance({f"n{i}": (1, 1) for i in range(50)} | {f"u{i}": (i + 1, i) for i in range(50)})
+    assert len(table) == 100 and len(table.up) == 100
@@ -0,0 +1,171 @@
+import pytest
+
+from apps.node_agent.testing import FakeXrayHandler, FakeXrayStats
+from apps.node_agent.xray_users import XrayHandlerClient, XrayUserDriver
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+from packages.common.vpnpanel_common.proto import xray_handler_pb2 as xh
+
+
+def _sub(sub_id: str, secret: str, status: str = "active", engine: str = "xray"):
+    return pb.SubscriptionEngineConfig(subscription_id=sub_id, engine=engine, secret=secret, status=status)
+
+
+def _full(subs, inbounds=(("vless-in", "vless"), ("trojan-in", "trojan"))):
+    return pb.FullNodeConfigPush(
+        node_id="node-1",
+        revision=1,
+        xray_inbounds=[pb.XrayInboundConfig(tag=t, protocol=p, settings_json='{"flow": "xtls-rprx-vision"}' if p == "vless" else "")
+                       for t, p in inbounds],
+        subscriptions=subs,
+    )
+
+
+def _secrets(xray: FakeXrayHandler, tag: str) -> dict:
+    out = {}
+    for email, user in xray.inbounds[tag].items():
+        if user.account.type == "xray.proxy.trojan.Account":
+            out[email] = xh.TrojanAccount.FromString(user.account.value).password
+        else:
+            acc = xh.VlessAccount.FromString(user.account.value)
+            out[email] = (acc.id, acc.flow)
+    return out
+
+
+@pytest.mark.asyncio
+async def test_sync_applies_deltas_with_minimal_calls():
+    xray = FakeXrayHandler(["vless-in", "trojan-in"])
+    client = XrayHandlerClient(await xray.start())
+    driver = XrayUserDriver(client, max_in_flight=8)
+    try:
+        driver.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b"), _sub("c", "uuid-c", status="suspended"),
+                           _sub("w", "wgkey", engine="wireguard")]))
+        result = await driver.sync()
+        assert (result.added, result.removed, result.failed) == (4, 0, 0)
+        assert _secrets(xray, "vless-in") == {"a": ("uuid-a", "xtls-rprx-vision"), "b": ("uuid-b", "xtls-rprx-vision")}
+        assert _secrets(xray, "trojan-in") == {"a": "uuid-a", "b": "uuid-b"}
+
+        xray.alters = 0
+        assert (await driver.sync()).calls == 0 and xray.alters == 0  # converged: nothing to send
+
+        delta = pb.NodeConfigDelta(revision=2, upserts=[_sub("b", "uuid-b2"), _sub("a", "uuid-a", status="exhausted"),
+                                                        _sub("c", "uuid-c")],
+                                   removed=[pb.SubscriptionKey(subscription_id="b", engine="wireguard")])
+        driver.update(delta)
+        result = await driver.sync()
+        # a removed, b replaced (remove + add), c added, on both inbounds
+        assert (result.removed, result.added, result.failed) == (4, 4, 0) and xray.alters == 8
+        assert _secrets(xray, "trojan-in") == {"b": "uuid-b2", "c": "uuid-c"}
+
+        driver.update(pb.NodeConfigDelta(revision=3, inbounds_changed=True,
+                                         xray_inbounds=[pb.XrayInboundConfig(tag="vless-in", protocol="vless")]))
+        result = await driver.sync()
+        # the flow changed on vless-in; trojan-in is no longer managed and is emptied
+        assert (result.removed, result.added) == (4, 2)
+        assert _secrets(xray, "vless-in") == {"b": ("uuid-b2", ""), "c": ("uuid-c", "")}
+        assert xray.inbounds["trojan-in"] == {} and "trojan-in" not in driver.applied
+        assert xray.max_in_flight <= 8
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("list_users", [True, False])
+async def test_sync_after_agent_restart_converges_on_existing_users(list_users):
+    xray = FakeXrayHandler(["vless-in", "trojan-in"], list_users=list_users)
+    client = XrayHandlerClient(await xray.start())
+    try:
+        first = XrayUserDriver(client)
+        first.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b"), _sub("stale", "uuid-s")]))
+        await first.sync()
+
+        second = XrayUserDriver(client)  # fresh agent: nothing applied as far as it knows
+        second.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b-rotated")]))
+        result = await second.sync()
+        assert result.failed == 0
+        assert _secrets(xray, "trojan-in")["b"] == "uuid-b-rotated"
+        if list_users:
+            # listed first: only the stale user and the rotated secret are touched
+            assert (result.removed, result.added) == (4, 2)
+            assert set(xray.inbounds["trojan-in"]) == {"a", "b"}
+        else:
+            # unknown state: every add collides and becomes remove + add; extras stay until listed
+            assert result.added == 4 and result.calls == 12
+        assert (await second.sync()).calls == 0
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+@pytest.mark.asyncio
+async def test_failed_calls_are_retried_on_next_sync():
+    xray = FakeXrayHandler(["vless-in"])
+    client = XrayHandlerClient(await xray.start())
+    driver = XrayUserDriver(client)
+    try:
+        driver.load(_full([_sub("a", "uuid-a")], inbounds=[("vless-in", "vless"), ("missing-in", "vless")]))
+        result = await driver.sync()
+        assert (result.added, result.failed) == (1, 1)  # Xray has no "missing-in" handler yet
+        xray.inbounds["missing-in"] = {}
+        result = await driver.sync()
+        assert (result.added, result.failed, result.calls) == (1, 0, 1)
+        assert set(xray.inbounds["missing-in"]) == {"a"}
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+class Clock:
+    def __init__(self, now: float = 1_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_xray_restart_re_adds_every_client():
+    clock = Clock()
+    xray = FakeXrayHandler(["vless-in", "trojan-in"], stats=FakeXrayStats(clock=clock))
+    client = XrayHandlerClient(await xray.start())
+    driver = XrayUserDriver(client, monotonic=clock)
+    try:
+        driver.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b")]))
+        await driver.sync()
+        clock.now += 60
+        assert (await driver.sync()).calls == 0
+
+        clock.now += 30
+        xray.restart()  # API-added clients are not persisted by Xray
+        clock.now += 30
+        result = await driver.sync()
+        assert (result.added, result.failed) == (4, 0)
+        assert set(xray.inbounds["vless-in"]) == set(xray.inbounds["trojan-in"]) == {"a", "b"}
+    finally:
+        await client.close()
+        await xray.stop()
+
+
+@pytest.mark.asyncio
+async def test_unlisted_leftover_clients_are_removed_when_revoked():
+    xray = FakeXrayHandler(["vless-in", "trojan-in"], list_users=False)
+    client = XrayHandlerClient(await xray.start())
+    try:
+        first = XrayUserDriver(client)
+        first.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b"), _sub("c", "uuid-c")]))
+        await first.sync()
+
+        # fresh agent on a core that cannot list clients: b is now suspended, c is deleted later
+        second = XrayUserDriver(client)
+        second.load(_full([_sub("a", "uuid-a"), _sub("b", "uuid-b", status="suspended"), _sub("c", "uuid-c")]))
+        result = await second.sync()
+        assert result.failed == 0 and second.can_list is False
+        assert set(xray.inbounds["vless-in"]) == set(xray.inbounds["trojan-in"]) == {"a", "c"}
+
+        second.update(pb.NodeConfigDelta(revision=2, removed=[pb.SubscriptionKey(subscription_id="c", engine="xray")]))
+        await second.sync()
+        assert set(xray.inbounds["vless-in"]) == set(xray.inbounds["trojan-in"]) == {"a"}
+        assert (await second.sync()).calls == 0
+    finally:
+        await client.close()
+        await xray.stop()
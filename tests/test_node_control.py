@@ -0,0 +1,179 @@
+import asyncio
+import uuid
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.control_api.config_builder import ConfigBuilder
+from apps.control_api.config_outbox import ConfigChangeConsumer
+from apps.control_api.node_control import NodeControlServicer, NodeQueue
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import (
+    Assignment, ConfigChange, Credential, EngineType, Node, Plan, Subscription, Tenant, User, UserEngines, XRayInbound,
+)
+from packages.common.vpnpanel_common.db.outbox import record_config_change
+from packages.common.vpnpanel_common.proto import node_control_pb2 as pb
+
+TABLES = (Tenant, User, Node, Plan, Subscription, Credential, UserEngines, XRayInbound, Assignment, ConfigChange)
+
+
+class FakeContext:
+    def auth_context(self):
+        return {}
+
+    async def abort(self, code, details):
+        raise RuntimeError(f"{code}: {details}")
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in TABLES])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def _seed(sf, n):
+    tenant, node = Tenant(id=uuid.uuid4(), name="acme"), Node(id=uuid.uuid4(), name="node-0")
+    users, subs = [], []
+    async with sf() as session:
+        session.add_all([tenant, node])
+        for i in range(n):
+            user = User(id=uuid.uuid4(), email=f"u{i}@example.com", password_hash="x")
+            sub = Subscription(id=uuid.uuid4(), tenant_id=tenant.id, user_id=user.id)
+            session.add_all([
+                user, sub, UserEngines(user_id=user.id),
+                Credential(user_id=user.id, engine=EngineType.xray, secret={"uuid": f"xray-{i}"}),
+                Assignment(user_id=user.id, node_id=node.id),
+            ])
+            users.append(user.id)
+            subs.append(str(sub.id))
+        await session.commit()
+    return node.id, users, subs
+
+
+async def _write(sf, stmt, **change):
+    async with sf() as session:
+        await session.execute(stmt)
+        await record_config_change(session, **change)
+        await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_gets_delta_from_retained_outbox(session_factory):
+    node, users, subs = await _seed(session_factory, 50)
+    # changes made while this control plane instance was not running
+    await _write(session_factory, update(Subscription).where(Subscription.user_id == users[0]).values(active=False),
+                 user_ids=[users[0]])
+    await _write(session_factory, delete(Subscription).where(Subscription.user_id == users[1]),
+                 user_ids=[users[1]], subscription_ids=[uuid.UUID(subs[1])])
+
+    builder = ConfigBuilder(session_factory)
+    consumer = ConfigChangeConsumer(builder)
+    servicer = NodeControlServicer(builder, consumer)
+
+    # slightly behind: only the two changed subscriptions travel
+    stream = servicer.StreamEnforcements(pb.NodeHello(node_id=str(node), current_revision=0), FakeContext())
+    first = await anext(stream)
+    assert first.WhichOneof("config") == "config_delta"
+    d = first.config_delta
+    assert (d.from_revision, d.revision, first.revision) == (0, 2, 2)
+    assert [(e.subscription_id, e.status) for e in d.upserts] == [(subs[0], "suspended")]
+    # removing a key the node never had (no WireGuard credential) is a no-op there
+    assert {(k.subscription_id, k.engine) for k in d.removed} == {(subs[0], "wireguard"), (subs[1], "xray"), (subs[1], "wireguard")}
+
+    # later changes are forwarded once the consumer applies them
+    await _write(session_factory, update(UserEngines).where(UserEngines.user_id == users[2]).values(allow_xray=False),
+                 user_ids=[users[2]])
+    following = asyncio.ensure_future(anext(stream))
+    assert await consumer.poll() == {node: 3}
+    d = (await asyncio.wait_for(following, 1)).config_delta
+    assert (d.from_revision, d.revision, [(k.subscription_id, k.engine) for k in d.removed]) == (2, 3, [(subs[2], "xray")])
+    await stream.aclose()
+
+    # older than the retained outbox: full config
+    async with session_factory() as session:
+        await session.execute(delete(ConfigChange).where(ConfigChange.revision == 1))
+        await session.commit()
+    stream = servicer.StreamEnforcements(pb.NodeHello(node_id=str(node), current_revision=0), FakeContext())
+    full = (await anext(stream)).full_config
+    assert full.revision == 3 and len(full.subscriptions) == 48
+    await stream.aclose()
+
+    ack = await servicer.PushFullConfig(pb.FullNodeConfigPush(node_id=str(node), revision=2), FakeContext())
+    assert (ack.revision, ack.success) == (3, False)
+    with pytest.raises(RuntimeError, match="NOT_FOUND"):
+        await anext(servicer.StreamEnforcements(pb.NodeHello(node_id=str(uuid.uuid4())), FakeContext()))
+
+
+def _command(sub, action, revision):
+    return pb.EnforcementCommand(subscription_id=sub, engine="xray", action=action, revision=revision)
+
+
+def test_queue_coalesces_windows_and_retries():
+    q = NodeQueue(window=2, batch_size=10, retry_base=1.0, retry_max=4.0)
+    q.put(_command("a", "suspend", 1))
+    q.put(_command("a", "resume", 2))  # supersedes the waiting suspend
+    q.put(_command("a", "suspend", 1))  # stale: ignored
+    q.put(_command("b", "suspend", 2))
+    q.put(_command("c", "suspend", 2))
+    assert len(q) == 3
+
+    assert [(c.subscription_id, c.action) for c in q.take(0.0)] == [("a", "resume"), ("b", "suspend")]
+    assert q.take(0.5) == []  # window full, nothing due
+    q.ack(("a", "xray"), 1, True, 0.5)  # ack for an older revision: ignored
+    q.ack(("a", "xray"), 2, True, 0.5)
+    assert [c.subscription_id for c in q.take(0.5)] == ["c"]
+
+    # nothing acked: each command is resent when due (b at 1.0, c at 1.5), then after twice as long
+    assert [c.subscription_id for c in q.take(1.0)] == ["b"]
+    assert [c.subscription_id for c in q.take(1.5)] == ["c"]
+    assert q.take(2.9) == []
+    assert [c.subscription_id for c in q.take(3.0)] == ["b"]
+    q.ack(("c", "xray"), 2, False, 3.0)  # a failure backs off from now
+    assert q.inflight[("c", "xray")].due == 5.0
+    q.put(_command("b", "revoke", 3))  # newer revision replaces the in-flight one on send
+    assert [(c.subscription_id, c.action) for c in q.take(3.0)] == [("b", "revoke")]
+    assert q.inflight[("b", "xray")].attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_suspension_fans_out_coalesced_commands(session_factory):
+    node, users, subs = await _seed(session_factory, 20)
+    builder = ConfigBuilder(session_factory)
+    consumer = ConfigChangeConsumer(builder)
+    servicer = NodeControlServicer(builder, consumer, window=8, batch_size=4, retry_base=0.2)
+    await builder.full(node)
+    stream = servicer.StreamEnforcements(pb.NodeHello(node_id=str(node), current_revision=0), FakeContext())
+    first = asyncio.ensure_future(anext(stream))  # up to date: the stream just waits
+    await asyncio.sleep(0.01)
+
+    # suspend everyone, then resume the first five before the node caught up
+    await _write(session_factory, update(Subscription).values(active=False), user_ids=users)
+    await _write(session_factory, update(Subscription).where(Subscription.user_id.in_(users[:5])).values(active=True),
+                 user_ids=users[:5])
+    assert await consumer.poll() == {node: 2}
+
+    received = [await asyncio.wait_for(first, 1)]
+    while len(received) < 1 + 8:
+        received.append(await asyncio.wait_for(anext(stream), 1))
+    config, commands = received[0], received[1:]
+    assert config.config_delta.revision == 2
+    assert len(commands) == 8  # window: 8 unacked at most
+    # the five resumed users were coalesced away: only the net suspensions remain
+    assert {c.action for c in commands} == {"suspend"}
+    assert {c.subscription_id for c in commands} <= set(subs[5:])
+
+    for c in commands:
+        await servicer.ReportEnforcementResult(pb.EnforcementResult(
+            node_id=str(node), subscription_id=c.subscription_id, engine=c.engine, action=c.action,
+            revision=c.revision, success=True), FakeContext())
+    rest = [await asyncio.wait_for(anext(stream), 1) for _ in range(7)]
+    assert {c.subscription_id for c in commands + rest} == set(subs[5:])
+    # nothing acked: the first unacked command is resent after the backoff
+    again = await asyncio.wait_for(anext(stream), 1)
+    assert again.subscription_id in {c.subscription_id for c in rest}
+    await stream.aclose()
@@ -0,0 +1,59 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.scheduler.enforcement import enforce_subscriptions
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import Assignment, AuditLog, ConfigChange, Node, Plan, Subscription, Tenant, User
+
+NOW = datetime(2026, 10, 1, 12, tzinfo=timezone.utc)
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in (Tenant, User, Node, Plan, Subscription, Assignment, ConfigChange, AuditLog)])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_enforcement_flips_expired_and_exhausted_in_batches(session_factory):
+    tenant = Tenant(id=uuid.uuid4(), name="acme")
+    capped = Plan(id=uuid.uuid4(), tenant_id=tenant.id, name="capped", quota_bytes=1000)
+    unlimited = Plan(id=uuid.uuid4(), tenant_id=tenant.id, name="unlimited", quota_bytes=None)
+    cases = {
+        "expired": dict(plan_id=unlimited.id, expiry_at=NOW - timedelta(seconds=1)),
+        "plan_quota": dict(plan_id=capped.id, consumed_bytes=1000),
+        "override": dict(plan_id=unlimited.id, quota_bytes_override=10, consumed_bytes=11),
+        "under_quota": dict(plan_id=capped.id, consumed_bytes=999, expiry_at=NOW + timedelta(days=1)),
+        "unlimited": dict(plan_id=unlimited.id, consumed_bytes=10**12),
+        "no_plan": dict(plan_id=None, consumed_bytes=10**12),
+    }
+    subs = {}
+    node = Node(id=uuid.uuid4(), name="node-1")
+    async with session_factory() as session:
+        session.add_all([tenant, capped, unlimited, node])
+        for name, fields in cases.items():
+            user = User(id=uuid.uuid4(), email=f"{name}@example.com", password_hash="x")
+            subs[name] = Subscription(id=uuid.uuid4(), tenant_id=tenant.id, user_id=user.id, **fields)
+            session.add_all([user, subs[name], Assignment(user_id=user.id, node_id=node.id)])
+        await session.commit()
+
+    assert await enforce_subscriptions(session_factory, batch_size=2, now=NOW) == {"expired": 1, "quota": 2}
+    assert await enforce_subscriptions(session_factory, batch_size=2, now=NOW) == {"expired": 0, "quota": 0}
+
+    async with session_factory() as session:
+        active = dict((await session.execute(select(Subscription.id, Subscription.active))).all())
+        actions = sorted((await session.execute(select(AuditLog.action))).scalars())
+        changes = (await session.execute(select(ConfigChange.revision, ConfigChange.subscription_ids).order_by(ConfigChange.revision))).all()
+    assert {name for name, sub in subs.items() if not active[sub.id]} == {"expired", "plan_quota", "override"}
+    assert actions == ["subscription.expired", "subscription.quota", "subscription.quota"]
+    # one outbox change per batch for the node serving those users
+    assert [rev for rev, _ in changes] == [1, 2]
+    assert {sub for _, ids in changes for sub in ids} == {str(subs[n].id) for n in ("expired", "plan_quota", "override")}
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.scheduler.enforcement import expire_subscriptions
+from apps.scheduler.expiry import ExpiryTimer
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import Assignment, AuditLog, ConfigChange, Node, Plan, Subscription, Tenant, User
+
+
+@pytest_asyncio.fixture
+async def session_factory(tmp_path):
+    # file-backed: the timer and the test read/write concurrently on separate connections
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'expiry.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in (Tenant, User, Node, Plan, Subscription, Assignment, ConfigChange, AuditLog)])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def _subscriptions(sf, *expiries):
+    tenant = Tenant(id=uuid.uuid4(), name="acme")
+    subs = []
+    async with sf() as session:
+        session.add(tenant)
+        for i, expiry_at in enumerate(expiries):
+            user = User(id=uuid.uuid4(), email=f"u{i}@example.com", password_hash="x")
+            subs.append(Subscription(id=uuid.uuid4(), tenant_id=tenant.id, user_id=user.id, expiry_at=expiry_at))
+            session.add_all([user, subs[-1]])
+        await session.commit()
+    return [s.id for s in subs]
+
+
+async def _active(sf):
+    async with sf() as session:
+        return dict((await session.execute(select(Subscription.id, Subscription.active))).all())
+
+
+async def _wait_for(sf, expected, timeout=3.0):
+    for _ in range(int(timeout / 0.05)):
+        if await _active(sf) == expected:
+            break
+        await asyncio.sleep(0.05)
+    return await _active(sf)
+
+
+def test_schedule_keeps_only_latest_deadline():
+    timer = ExpiryTimer(None, window_seconds=3600)
+    a, b = uuid.uuid4(), uuid.uuid4()
+    now = datetime.now(timezone.utc)
+    timer.schedule(a, now + timedelta(seconds=10))
+    timer.schedule(b, now + timedelta(seconds=20))
+    timer.schedule(a, now + timedelta(seconds=30))  # moved later
+    timer.schedule(b, now + timedelta(days=2))  # beyond the window: dropped until a reload
+    assert len(timer) == 1
+    assert timer.pop_due(now.timestamp() + 25) == []
+    assert timer.pop_due(now.timestamp() + 30) == [a]
+    timer.handle_message(json.dumps({"id": str(b), "expiry_at": (now + timedelta(seconds=5)).isoformat(), "active": True}))
+    timer.handle_message(json.dumps({"id": str(b), "expiry_at": None, "active": False}))
+    assert timer.next_deadline() is None
+
+
+@pytest.mark.asyncio
+async def test_expire_subscriptions_skips_unexpired(session_factory):
+    now = datetime.now(timezone.utc)
+    past, future = await _subscriptions(session_factory, now - timedelta(seconds=1), now + timedelta(hours=1))
+    assert await expire_subscriptions(session_factory, [past, future], now=now) == {"expired": 1, "quota": 0}
+    assert await _active(session_factory) == {past: False, future: True}
+
+
+@pytest.mark.asyncio
+async def test_timer_fires_at_deadline(session_factory):
+    now = datetime.now(timezone.utc)
+    soon, later, far = await _subscriptions(
+        session_factory, now + timedelta(seconds=0.3), now + timedelta(hours=1), now + timedelta(days=7),
+    )
+    timer = ExpiryTimer(session_factory, window_seconds=86400)
+    assert await timer.load() == 2
+    task = asyncio.create_task(timer.run())
+    try:
+        assert await _wait_for(session_factory, {soon: False, later: True, far: True}) == {soon: False, later: True, far: True}
+        pulled = datetime.now(timezone.utc)
+        async with session_factory() as session:
+            await session.execute(update(Subscription).where(Subscription.id == later).values(expiry_at=pulled))
+            await session.commit()
+        timer.schedule(later, pulled)  # pulled forward: wakes the sleeping timer
+        assert await _wait_for(session_factory, {soon: False, later: False, far: True}) == {soon: False, later: False, far: True}
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,171 @@
+import re
+from datetime import date
+
+import pytest
+
+from apps.scheduler.partitions import PartitionedTable, create_ahead, drop_expired
+from packages.common.vpnpanel_common.db.models import DAILY_ROLLUP_WATERMARK, HOURLY_ROLLUP_WATERMARK
+
+EVENTS = PartitionedTable("traffic_events", "event_time", timestamp_bounds=True, retention_days=30, require_rolled_up=True)
+HOURLY = PartitionedTable("traffic_rollups_hourly", "day", timestamp_bounds=False, retention_days=30, require_compacted=True)
+
+
+class Result:
+    def __init__(self, rows=(), rowcount=0):
+        self._rows = list(rows)
+        self.rowcount = rowcount
+
+    def scalar(self):
+        return self._rows[0][0] if self._rows else None
+
+    def all(self):
+        return self._rows
+
+
+class FakePartitions:
+    """Answers the statements ``partitions.py`` issues, over in-memory partitions.
+
+    Rows are dicts whose partition key is stored as the same literal the bounds
+    use, so string comparison orders them. Like PostgreSQL, creating a partition
+    fails while the DEFAULT partition holds rows in its range.
+    """
+
+    def __init__(self, table: PartitionedTable, watermarks=None):
+        self.table = table
+        self.parts: dict[str, tuple | None] = {}  # name -> (lo, hi), None for DEFAULT
+        self.rows: dict[str, list[dict]] = {}
+        self.watermarks = watermarks or {}
+        self.temp: list[dict] | None = None
+
+    def add_partition(self, name, bounds, rows=()):
+        self.parts[name] = bounds
+        self.rows[name] = list(rows)
+
+    def _match(self, row, where):
+        for col, op, value in re.findall(r'"?(\w+)"? (>=|<=|<) \'?([^\' ]+(?: [^\' ]+)?)\'?', where):
+            v = row[col]
+            value = int(value) if isinstance(v, int) else value
+            if not {"<": v < value, "<=": v <= value, ">=": v >= value}[op]:
+                return False
+        return True
+
+    def _route(self, row):
+        key = row[self.table.column]
+        for name, bounds in self.parts.items():
+            if bounds and bounds[0] <= key < bounds[1]:
+                return name
+        return f"{self.table.name}_default"
+
+    async def execute(self, stmt, params=None):
+        sql = str(stmt)
+        if "pg_inherits" in sql:
+            return Result([(n,) for n in self.parts])
+        if m := re.match(r"SELECT last_id FROM \w+ WHERE name = :name", sql):
+            return Result([(self.watermarks.get(params["name"]),)])
+        if m := re.match(r'SELECT max\(id\) FROM "(\w+)"', sql):
+            return Result([(max((r["id"] for r in self.rows[m[1]]), default=None),)])
+        if m := re.match(r'SELECT count\(\*\) FROM "(\w+)"', sql):
+            return Result([(len(self.rows[m[1]]),)])
+        if m := re.match(r'SELECT EXISTS \(SELECT 1 FROM "(\w+)" WHERE (.*)\)$', sql):
+            return Result([(any(self._match(r, m[2]) for r in self.rows[m[1]]),)])
+        if m := re.match(r'CREATE TABLE IF NOT EXISTS "(\w+)" PARTITION OF "\w+" FOR VALUES FROM \(\'(.*)\'\) TO \(\'(.*)\'\)', sql):
+            default = self.rows.get(f"{self.table.name}_default", [])
+            if any(m[2] <= r[self.table.column] < m[3] for r in default):
+                raise RuntimeError("updated partition constraint for default partition would be violated")
+            self.add_partition(m[1], (m[2], m[3]))
+            return Result()
+        if sql.startswith("CREATE TEMP TABLE partition_move"):
+            self.temp = []
+            return Result()
+        if m := re.match(r'WITH moved AS \(DELETE FROM "(\w+)" WHERE (.*) RETURNING \*\) INSERT INTO partition_move', sql):
+            moved = [r for r in self.rows[m[1]] if self._match(r, m[2])]
+            self.rows[m[1]] = [r for r in self.rows[m[1]] if r not in moved]
+            self.temp += moved
+            return Result(rowcount=len(moved))
+        if re.match(r'INSERT INTO "\w+" SELECT \* FROM partition_move', sql):
+            for r in self.temp:
+                self.rows[self._route(r)].append(r)
+            return Result(rowcount=len(self.temp))
+        if sql == "DROP TABLE partition_move":
+            self.temp = None
+            return Result()
+        if m := re.match(r'ALTER TABLE "\w+" DETACH PARTITION "(\w+)"', sql):
+            del self.parts[m[1]]
+            return Result()
+        if m := re.match(r'DROP TABLE "(\w+)"', sql):
+            del self.rows[m[1]]
+            return Result()
+        if m := re.match(r'DELETE FROM "(\w+)" WHERE (.*)$', sql):
+            keep = [r for r in self.rows[m[1]] if not self._match(r, m[2])]
+            deleted = len(self.rows[m[1]]) - len(keep)
+            self.rows[m[1]] = keep
+            return Result(rowcount=deleted)
+        raise AssertionError(f"unexpected statement: {sql}")
+
+
+def ts(day: date, hour: int = 0) -> str:
+    return f"{day.isoformat()} {hour:02d}:00:00+00"
+
+
+def event_day(day: date) -> tuple[str, str]:
+    return ts(day), ts(date.fromordinal(day.toordinal() + 1))
+
+
+@pytest.mark.asyncio
+async def test_create_ahead_fills_the_window_and_moves_default_rows():
+    pg = FakePartitions(EVENTS)
+    today = date(2026, 10, 17)
+    pg.add_partition("traffic_events_20261017", event_day(today), [{"id": 1, "event_time": ts(today, 3)}])
+    pg.add_partition("traffic_events_default", None, [
+        {"id": 2, "event_time": ts(date(2026, 10, 19), 5)},  # inside the window, before its partition exists
+        {"id": 3, "event_time": ts(date(2027, 1, 1))},  # beyond it
+    ])
+
+    assert await create_ahead(pg, EVENTS, today, days_ahead=3) == 4  # yesterday and +1..+3
+    assert sorted(pg.parts) == [
+        "traffic_events_20261016", "traffic_events_20261017", "traffic_events_20261018",
+        "traffic_events_20261019", "traffic_events_20261020", "traffic_events_default",
+    ]
+    assert [r["id"] for r in pg.rows["traffic_events_20261019"]] == [2]
+    assert [r["id"] for r in pg.rows["traffic_events_default"]] == [3]
+    assert pg.temp is None
+    # Idempotent
+    assert await create_ahead(pg, EVENTS, today, days_ahead=3) == 0
+
+
+@pytest.mark.asyncio
+async def test_drop_expired_waits_for_the_rollup_watermark_and_prunes_default():
+    pg = FakePartitions(EVENTS, {HOURLY_ROLLUP_WATERMARK: 20})
+    today = date(2026, 10, 17)  # cutoff 2026-09-17
+    old, older, kept = date(2026, 9, 10), date(2026, 9, 11), date(2026, 9, 20)
+    pg.add_partition("traffic_events_20260910", event_day(old), [{"id": 5, "event_time": ts(old)}])
+    pg.add_partition("traffic_events_20260911", event_day(older), [{"id": 25, "event_time": ts(older)}])  # not rolled up
+    pg.add_partition("traffic_events_20260920", event_day(kept), [{"id": 30, "event_time": ts(kept)}])
+    pg.add_partition("traffic_events_default", None, [
+        {"id": 1, "event_time": ts(date(2026, 1, 1))},  # expired, rolled up
+        {"id": 21, "event_time": ts(date(2026, 1, 2))},  # expired, above the watermark
+        {"id": 2, "event_time": ts(date(2027, 1, 1))},  # not expired
+    ])
+
+    assert await drop_expired(pg, EVENTS, today) == 1
+    assert sorted(pg.parts) == ["traffic_events_20260911", "traffic_events_20260920", "traffic_events_default"]
+    assert sorted(r["id"] for r in pg.rows["traffic_events_default"]) == [2, 21]
+
+    pg.watermarks[HOURLY_ROLLUP_WATERMARK] = 40
+    assert await drop_expired(pg, EVENTS, today) == 1
+    assert sorted(pg.parts) == ["traffic_events_20260920", "traffic_events_default"]
+    assert [r["id"] for r in pg.rows["traffic_events_default"]] == [2]
+
+
+@pytest.mark.asyncio
+async def test_hourly_partitions_are_dropped_only_once_compacted():
+    pg = FakePartitions(HOURLY, {DAILY_ROLLUP_WATERMARK: date(2026, 9, 10).toordinal()})
+    today = date(2026, 10, 17)
+    for d in (10, 11):
+        day = date(2026, 9, d)
+        pg.add_partition(f"traffic_rollups_hourly_202609{d}", (day.isoformat(), date(2026, 9, d + 1).isoformat()),
+                         [{"id": d, "day": day.isoformat()}])
+
+    assert await drop_expired(pg, HOURLY, today) == 1
+    assert sorted(pg.parts) == ["traffic_rollups_hourly_20260911"]
+    assert await drop_expired(pg, HOURLY, today) == 0
@@ -0,0 +1,145 @@
+import uuid
+from datetime import date, datetime, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.scheduler.compaction import compact_rollups
+from apps.scheduler.rollups import rollup_hourly
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.ingest import build_event_rows, bulk_insert_traffic_events
+from packages.common.vpnpanel_common.db.models import (
+    NO_ID, Node, RollupWatermark, Subscription, Tenant, TrafficEvent, TrafficRollupDaily, TrafficRollupHourly,
+    TrafficRollupMonthly, User,
+)
+
+TABLES = [
+    Tenant, User, Node, Subscription, TrafficEvent, TrafficRollupHourly, TrafficRollupDaily, TrafficRollupMonthly,
+    RollupWatermark,
+]
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in TABLES])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def ingest(session_factory, samples):
+    async with session_factory() as session:
+        await bulk_insert_traffic_events(session, build_event_rows(samples))
+        await session.commit()
+
+
+async def totals(session_factory):
+    async with session_factory() as session:
+        rows = (await session.execute(select(TrafficRollupHourly).order_by(TrafficRollupHourly.hour_start))).scalars().all()
+    return [(r.hour_start.hour, r.bytes_up, r.bytes_down) for r in rows]
+
+
+@pytest.mark.asyncio
+async def test_rollup_is_incremental_and_rerunnable(session_factory):
+    user_id = uuid.uuid4()
+    t = lambda h, m: datetime(2026, 10, 1, h, m, tzinfo=timezone.utc)  # noqa: E731
+    await ingest(session_factory, [
+        {"user_id": user_id, "event_time": t(10, 5), "bytes_up": 1, "bytes_down": 10},
+        {"user_id": user_id, "event_time": t(10, 55), "bytes_up": 2, "bytes_down": 20},
+        {"user_id": user_id, "event_time": t(11, 1), "bytes_up": 4, "bytes_down": 40},
+    ])
+    assert await rollup_hourly(session_factory, settle_seconds=0, chunk_ids=2) == 3
+    assert await totals(session_factory) == [(10, 3, 30), (11, 4, 40)]
+
+    # Re-running without new events changes nothing
+    assert await rollup_hourly(session_factory, settle_seconds=0) == 0
+    assert await totals(session_factory) == [(10, 3, 30), (11, 4, 40)]
+
+    # A late event for 10:00 is added onto the existing bucket
+    await ingest(session_factory, [{"user_id": user_id, "event_time": t(10, 30), "bytes_up": 100, "bytes_down": 0}])
+    assert await rollup_hourly(session_factory, settle_seconds=0) == 1
+    assert await totals(session_factory) == [(10, 103, 30), (11, 4, 40)]
+
+
+@pytest.mark.asyncio
+async def test_compaction_builds_daily_and_monthly_from_closed_days(session_factory):
+    user_id = uuid.uuid4()
+    t = lambda d, h: datetime(2026, 9, d, h, tzinfo=timezone.utc)  # noqa: E731
+    await ingest(session_factory, [
+        {"user_id": user_id, "event_time": t(29, 1), "bytes_up": 1, "bytes_down": 10},
+        {"user_id": user_id, "event_time": t(29, 23), "bytes_up": 2, "bytes_down": 20},
+        {"user_id": user_id, "event_time": t(30, 5), "bytes_up": 4, "bytes_down": 40},
+        {"user_id": user_id, "event_time": datetime(2026, 10, 1, 5, tzinfo=timezone.utc), "bytes_up": 8, "bytes_down": 80},
+    ])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    now = datetime(2026, 10, 1, 12, tzinfo=timezone.utc)
+    assert await compact_rollups(session_factory, grace_hours=6, now=now) == 2  # Oct 1 is still open
+
+    async with session_factory() as session:
+        daily = (await session.execute(select(TrafficRollupDaily).order_by(TrafficRollupDaily.day))).scalars().all()
+        monthly = (await session.execute(select(TrafficRollupMonthly))).scalars().all()
+    assert [(d.day.day, d.bytes_up, d.bytes_down) for d in daily] == [(29, 3, 30), (30, 4, 40)]
+    assert [(m.month.month, m.bytes_up, m.bytes_down) for m in monthly] == [(9, 7, 70)]
+
+    # Nothing new is closed: a rerun is a no-op
+    assert await compact_rollups(session_factory, grace_hours=6, now=now) == 0
+
+
+@pytest.mark.asyncio
+async def test_rollups_keep_nodes_and_unattributed_traffic(session_factory):
+    user_id, node_a, node_b = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    t = lambda d, h: datetime(2026, 9, d, h, tzinfo=timezone.utc)  # noqa: E731
+    await ingest(session_factory, [
+        {"user_id": user_id, "node_id": node_a, "event_time": t(29, 1), "bytes_up": 1, "bytes_down": 10},
+        {"user_id": user_id, "node_id": node_b, "event_time": t(29, 1), "bytes_up": 2, "bytes_down": 20},
+        {"user_id": None, "node_id": node_a, "event_time": t(29, 1), "bytes_up": 4, "bytes_down": 40},
+        {"user_id": user_id, "node_id": None, "event_time": t(29, 2), "bytes_up": 8, "bytes_down": 80},
+    ])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await compact_rollups(session_factory, grace_hours=0, now=datetime(2026, 10, 1, tzinfo=timezone.utc))
+
+    async with session_factory() as session:
+        hourly = (await session.execute(select(TrafficRollupHourly))).scalars().all()
+        daily = (await session.execute(select(TrafficRollupDaily))).scalars().all()
+        monthly = (await session.execute(select(TrafficRollupMonthly))).scalars().all()
+    assert {(r.hour_start.hour, r.user_id, r.node_id, r.bytes_up) for r in hourly} == {
+        (1, user_id, node_a, 1), (1, user_id, node_b, 2), (1, NO_ID, node_a, 4), (2, user_id, NO_ID, 8),
+    }
+    expected = {(user_id, node_a, 1), (user_id, node_b, 2), (NO_ID, node_a, 4), (user_id, NO_ID, 8)}
+    assert {(r.user_id, r.node_id, r.bytes_up) for r in daily} == expected
+    assert {(r.user_id, r.node_id, r.bytes_up) for r in monthly} == expected
+
+
+@pytest.mark.asyncio
+async def test_late_events_for_compacted_days_reach_daily_and_monthly(session_factory):
+    user_id = uuid.uuid4()
+    t = lambda m, d, h: datetime(2026, m, d, h, tzinfo=timezone.utc)  # noqa: E731
+    await ingest(session_factory, [
+        {"user_id": user_id, "event_time": t(9, 29, 1), "bytes_up": 1, "bytes_down": 10},
+        {"user_id": user_id, "event_time": t(9, 30, 1), "bytes_up": 2, "bytes_down": 20},
+    ])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    assert await compact_rollups(session_factory, grace_hours=0, now=t(10, 1, 0)) == 2
+
+    # A node replays its spool days later: Sep 29 is compacted already, Oct 1 is not
+    await ingest(session_factory, [
+        {"user_id": user_id, "event_time": t(9, 29, 5), "bytes_up": 4, "bytes_down": 40},
+        {"user_id": user_id, "event_time": t(10, 1, 5), "bytes_up": 8, "bytes_down": 80},
+    ])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    assert await compact_rollups(session_factory, grace_hours=0, now=t(10, 2, 0)) == 1
+
+    async with session_factory() as session:
+        daily = (await session.execute(select(TrafficRollupDaily).order_by(TrafficRollupDaily.day))).scalars().all()
+        monthly = (await session.execute(select(TrafficRollupMonthly).order_by(TrafficRollupMonthly.month))).scalars().all()
+    assert [(d.day.day, d.bytes_up, d.bytes_down) for d in daily] == [(29, 5, 50), (30, 2, 20), (1, 8, 80)]
+    assert [(m.month.month, m.bytes_up, m.bytes_down) for m in monthly] == [(9, 7, 70), (10, 8, 80)]
+
+    # Repeated passes do not add the late events twice
+    assert await rollup_hourly(session_factory, settle_seconds=0) == 0
+    assert await compact_rollups(session_factory, grace_hours=0, now=t(10, 2, 0)) == 0
+    async with session_factory() as session:
+        assert (await session.get(TrafficRollupDaily, (date(2026, 9, 29), user_id, NO_ID))).bytes_up == 5
@@ -0,0 +1,56 @@
+import uuid
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.ingest import RecentKeyFilter, build_event_rows, bulk_insert_traffic_events
+from packages.common.vpnpanel_common.db.models import Node, TrafficEvent, User
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[User.__table__, Node.__table__, TrafficEvent.__table__])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_bulk_insert_traffic_events(session_factory):
+    samples = [{"bytes_up": i, "bytes_down": 2 * i} for i in range(500)]
+    async with session_factory() as session:
+        assert await bulk_insert_traffic_events(session, build_event_rows(samples)) == 500
+        await session.commit()
+        count, up, down = (await session.execute(select(func.count(), func.sum(TrafficEvent.bytes_up), func.sum(TrafficEvent.bytes_down)))).one()
+    assert count == 500
+    assert up == sum(range(500))
+    assert down == 2 * sum(range(500))
+
+
+@pytest.mark.asyncio
+async def test_redelivered_samples_are_counted_once(session_factory):
+    node_id, sub_id = uuid.uuid4(), uuid.uuid4()
+    samples = [
+        {"node_id": node_id, "subscription_id": sub_id, "engine": "xray", "counter_seq": seq, "period_end_unix": 1_700_000_000 + 60 * seq, "bytes_up": 10, "bytes_down": 20}
+        for seq in range(1, 6)
+    ]
+    recent = RecentKeyFilter(ttl_seconds=60)
+    async with session_factory() as session:
+        rows = build_event_rows(samples)
+        assert await bulk_insert_traffic_events(session, rows) == 5
+        await session.commit()
+        recent.remember(rows)
+
+        # Agent retries the last three samples: the in-memory filter drops them
+        fresh, dropped = recent.filter(build_event_rows(samples[2:]))
+        assert fresh == [] and dropped == 3
+
+        # After a collector restart the filter is empty; the unique key still holds
+        assert await bulk_insert_traffic_events(session, build_event_rows(samples[2:] + samples[2:3])) == 0
+        await session.commit()
+        total = (await session.execute(select(func.sum(TrafficEvent.bytes_up)))).scalar()
+    assert total == 50
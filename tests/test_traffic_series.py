@@ -0,0 +1,227 @@
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.control_api.routers.traffic import traffic_summary
+from apps.scheduler.compaction import compact_rollups
+from apps.scheduler.rollups import rollup_hourly
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.ingest import build_event_rows, bulk_insert_traffic_events
+from packages.common.vpnpanel_common.db.models import (
+    Node, RollupWatermark, Subscription, Tenant, TrafficEvent, TrafficRollupDaily, TrafficRollupHourly,
+    TrafficRollupMonthly, User,
+)
+from packages.common.vpnpanel_common.db.series import SeriesFilter, plan_tiers, traffic_series, traffic_totals
+
+TABLES = [
+    Tenant, User, Node, Subscription, TrafficEvent, TrafficRollupHourly, TrafficRollupDaily, TrafficRollupMonthly,
+    RollupWatermark,
+]
+BASE = int(datetime(2026, 9, 21, 12, tzinfo=timezone.utc).timestamp())
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in TABLES])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def ingest(session_factory, user_id, offsets, node_id=None):
+    samples = [{"user_id": user_id, "node_id": node_id, "bytes_up": 1, "bytes_down": 10, "period_end_unix": BASE + o}
+               for o in offsets]
+    async with session_factory() as session:
+        await bulk_insert_traffic_events(session, build_event_rows(samples))
+        await session.commit()
+
+
+async def series(session_factory, bucket_seconds, hours=3):
+    since = datetime.fromtimestamp(BASE, tz=timezone.utc)
+    until = datetime.fromtimestamp(BASE + hours * 3600, tz=timezone.utc)
+    async with session_factory() as session:
+        return await traffic_series(session, since, until, SeriesFilter(), bucket_seconds)
+
+
+@pytest.mark.asyncio
+async def test_series_tiers_agree_and_include_raw_tail(session_factory):
+    uid = uuid.uuid4()
+    await ingest(session_factory, uid, [60, 120, 3700])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await ingest(session_factory, uid, [3800, 7300])  # not rolled up yet
+
+    tier, width, points = await series(session_factory, 3600)
+    assert (tier, width) == ("hourly", 3600)
+    assert [(p[1], p[2]) for p in points] == [(2, 20), (2, 20), (1, 10)]
+
+    tier, width, points = await series(session_factory, 900)
+    assert tier == "raw" and len(points) == 12
+    assert sum(p[1] for p in points) == 5
+
+    tier, width, points = await series(session_factory, None, hours=24 * 30)
+    assert (tier, width) == ("hourly", 21600) and sum(p[2] for p in points) == 50
+
+
+@pytest.mark.asyncio
+async def test_sub_hour_series_never_reach_past_raw_retention(session_factory):
+    uid = uuid.uuid4()
+    await ingest(session_factory, uid, [60, 120, 3700])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    async with session_factory() as session:  # raw retention has since dropped the partition
+        await session.execute(delete(TrafficEvent))
+        await session.commit()
+    since = datetime.fromtimestamp(BASE, tz=timezone.utc)
+    until, raw_since = since + timedelta(hours=3), since + timedelta(days=1)
+
+    async with session_factory() as session:
+        with pytest.raises(ValueError, match="raw retention"):
+            await traffic_series(session, since, until, SeriesFilter(), 300, raw_since=raw_since)
+        tier, width, points = await traffic_series(session, since, until, SeriesFilter(), raw_since=raw_since)
+    assert (tier, width) == ("hourly", 3600)
+    assert [(p[1], p[2]) for p in points] == [(2, 20), (1, 10), (0, 0)]
+
+
+@pytest.mark.asyncio
+async def test_series_caps_point_count(session_factory):
+    with pytest.raises(ValueError):
+        await series(session_factory, 60, hours=24 * 30)
+
+
+def test_plan_tiers_uses_coarsest_complete_tier():
+    t = lambda m, d, h=0: datetime(2026, m, d, h, tzinfo=timezone.utc)  # noqa: E731
+    plan = plan_tiers(t(7, 30, 5), t(10, 20, 3), compacted_through=date(2026, 10, 5))
+    assert sorted(plan, key=lambda p: p[1]) == [
+        ("hourly", t(7, 30, 5), t(7, 31)),
+        ("daily", t(7, 31), t(8, 1)),
+        ("monthly", t(8, 1), t(10, 1)),
+        ("daily", t(10, 1), t(10, 6)),
+        ("hourly", t(10, 6), t(10, 20, 3)),
+    ]
+    assert plan_tiers(t(7, 30, 5), t(7, 31, 2), date(2026, 10, 5)) == [("hourly", t(7, 30, 5), t(7, 31, 2))]
+
+
+@pytest.mark.asyncio
+async def test_totals_and_daily_series_after_compaction(session_factory):
+    uid = uuid.uuid4()
+    day = 86400
+    await ingest(session_factory, uid, [60, 3700, day + 60, 2 * day + 60])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await compact_rollups(session_factory, grace_hours=0, now=datetime.fromtimestamp(BASE + 2 * day, tz=timezone.utc))
+    await ingest(session_factory, uid, [2 * day + 120])  # raw tail
+
+    async with session_factory() as session:
+        assert await traffic_totals(session, None, None, SeriesFilter()) == {uid: [5, 50]}
+        since = datetime(2026, 9, 21, tzinfo=timezone.utc)
+        tier, _, points = await traffic_series(session, since, since + timedelta(days=3), SeriesFilter(), 86400)
+    assert tier == "daily"
+    assert [(p[1], p[2]) for p in points] == [(2, 20), (1, 10), (2, 20)]
+
+
+@pytest.mark.asyncio
+async def test_totals_report_userless_traffic_under_none_in_every_tier(session_factory):
+    uid = uuid.uuid4()
+    await ingest(session_factory, uid, [60])
+    await ingest(session_factory, None, [120])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await ingest(session_factory, None, [180])  # raw tail
+
+    async with session_factory() as session:
+        assert await traffic_totals(session, None, None, SeriesFilter()) == {uid: [1, 10], None: [2, 20]}
+
+
+@pytest.mark.asyncio
+async def test_node_reads_use_rollups_after_raw_events_are_gone(session_factory):
+    uid, node_a, node_b = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    day = 86400
+    await ingest(session_factory, uid, [60, day + 60], node_id=node_a)
+    await ingest(session_factory, uid, [120], node_id=node_b)
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await compact_rollups(session_factory, grace_hours=0, now=datetime.fromtimestamp(BASE + 2 * day, tz=timezone.utc))
+    await ingest(session_factory, uid, [day + 120], node_id=node_a)  # raw tail
+    async with session_factory() as session:
+        await session.execute(delete(TrafficEvent).where(TrafficEvent.id <= 3))  # raw retention
+        await session.commit()
+
+    async with session_factory() as session:
+        assert await traffic_totals(session, None, None, SeriesFilter(node_id=node_a)) == {uid: [3, 30]}
+        assert await traffic_totals(session, None, None, SeriesFilter(node_id=node_b)) == {uid: [1, 10]}
+        since = datetime(2026, 9, 21, tzinfo=timezone.utc)
+        tier, _, points = await traffic_series(session, since, since + timedelta(days=2), SeriesFilter(node_id=node_a), 86400)
+    assert tier == "daily"
+    assert [(p[1], p[2]) for p in points] == [(1, 10), (2, 20)]
+
+
+@pytest.mark.asyncio
+async def test_tenant_reads_agree_across_the_watermark_for_a_user_in_two_tenants(session_factory):
+    old, current, uid, other = uuid.uuid4(), uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    async with session_factory() as session:
+        session.add_all([
+            Subscription(tenant_id=old, user_id=uid, plan_id=uuid.uuid4(), active=False,
+                         created_at=datetime(2026, 1, 1, tzinfo=timezone.utc)),
+            Subscription(tenant_id=current, user_id=uid, plan_id=uuid.uuid4(), active=True),
+            Subscription(tenant_id=old, user_id=other, plan_id=uuid.uuid4(), active=True),
+        ])
+        await session.commit()
+    await ingest(session_factory, uid, [60, 3700])
+    await ingest(session_factory, other, [120])
+    since = datetime.fromtimestamp(BASE, tz=timezone.utc)
+
+    async def reads():
+        async with session_factory() as session:
+            return [
+                (await traffic_totals(session, None, None, SeriesFilter(tenant_id=tenant)),
+                 [(p[1], p[2]) for p in (await traffic_series(
+                     session, since, since + timedelta(hours=2), SeriesFilter(tenant_id=tenant), 3600))[2]])
+                for tenant in (old, current)
+            ]
+
+    before = await reads()
+    await rollup_hourly(session_factory, settle_seconds=0)
+    assert await reads() == before == [
+        ({other: [1, 10]}, [(1, 10), (0, 0)]),
+        ({uid: [2, 20]}, [(1, 10), (1, 10)]),
+    ]
+
+
+async def summary(session_factory, since=None, until=None):
+    async with session_factory() as session:
+        rows = await traffic_summary(user_id=None, tenant_id=None, node_id=None, since=since, until=until,
+                                     session=session, user=None)
+    return {r.user_id: (r.total_up, r.total_down) for r in rows}
+
+
+@pytest.mark.asyncio
+async def test_summary_counts_each_event_once_across_the_hourly_watermark(session_factory):
+    uid = uuid.uuid4()
+    await ingest(session_factory, uid, [0, 3599, 3600])  # hour H (incl. its first second), then H+1 at its start
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await ingest(session_factory, uid, [1800, 3600, 7199])  # same hours again, above the watermark
+    at = lambda s: datetime.fromtimestamp(BASE + s, tz=timezone.utc)  # noqa: E731
+
+    assert await summary(session_factory) == {uid: (6, 60)}
+    assert await summary(session_factory, at(0), at(3600)) == {uid: (3, 30)}
+    assert await summary(session_factory, at(3600), at(7200)) == {uid: (3, 30)}
+    assert await summary(session_factory, at(7200), at(10800)) == {}
+
+
+@pytest.mark.asyncio
+async def test_summary_truncates_since_and_until_to_the_hour(session_factory):
+    uid = uuid.uuid4()
+    await ingest(session_factory, uid, [60, 3660, 7260])
+    await rollup_hourly(session_factory, settle_seconds=0)
+    await ingest(session_factory, uid, [120, 3720, 7320])
+    at = lambda s: datetime.fromtimestamp(BASE + s, tz=timezone.utc)  # noqa: E731
+
+    # [H:30, H+1:30) reads as [H, H+1); adjacent truncated windows neither overlap nor leave a gap
+    assert await summary(session_factory, at(1800), at(5400)) == {uid: (2, 20)}
+    assert await summary(session_factory, at(5400), at(9000)) == {uid: (2, 20)}
+    assert await summary(session_factory, at(9000), at(12600)) == {uid: (2, 20)}
+    assert await summary(session_factory, at(1800), at(12600)) == {uid: (6, 60)}
+    # Naive datetimes are taken as UTC
+    naive = at(1800).replace(tzinfo=None)
+    assert await summary(session_factory, naive, naive + timedelta(hours=1)) == {uid: (2, 20)}
@@ -0,0 +1,141 @@
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.collector.ingest import TrafficWriter
+from apps.collector.sketches import SketchAggregator
+from apps.control_api import schemas
+from apps.control_api.routers import traffic
+from apps.control_api.routers.traffic import ingest_events
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.ingest import RecentKeyFilter
+from packages.common.vpnpanel_common.db.models import AuditLog, Plan, Subscription, Tenant, TrafficEvent, TrafficSketchHourly, User
+from packages.common.vpnpanel_common.db.sketches import load_sketches
+from packages.common.vpnpanel_common.sketches import HyperLogLog, SpaceSaving
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[
+            m.__table__ for m in (Tenant, User, Plan, Subscription, TrafficEvent, AuditLog, TrafficSketchHourly)
+        ])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+def test_sketches_estimate_and_merge():
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+        a.add(f"u{i}")
+    for i in range(2000, 6000):
+        b.add(f"u{i}")
+    merged = HyperLogLog.from_bytes(a.to_bytes()).merge(b).count()
+    assert abs(merged - 6000) < 6000 * 0.05
+
+    top = SpaceSaving(capacity=4)
+    for i in range(50):
+        top.add(f"small{i}", 1)
+        top.add("heavy", 100)
+    other = SpaceSaving.from_dict(SpaceSaving(capacity=4).to_dict())
+    other.add("heavy", 7)
+    item, count, error = top.merge(other).top(1)[0]
+    assert item == "heavy" and count - error <= 5007 <= count
+
+
+@pytest.mark.asyncio
+async def test_aggregator_persists_and_merges_hourly_rows(session_factory):
+    node_id, tenant_id = uuid.uuid4(), uuid.uuid4()
+    sub_id = uuid.uuid4()
+    hour = datetime(2026, 10, 1, 10, tzinfo=timezone.utc)
+    agg = SketchAggregator(session_factory)
+
+    def rows(users, minute):
+        return [
+            {"user_id": u, "subscription_id": sub_id, "node_id": node_id, "bytes_up": 10, "bytes_down": 90,
+             "event_time": hour.replace(minute=minute)}
+            for u in users
+        ]
+
+    heavy = uuid.uuid4()
+    agg.observe(rows([heavy] + [uuid.uuid4() for _ in range(9)], 5), {sub_id: tenant_id})
+    assert await agg.persist() == 2  # (node, hour) and (tenant, hour)
+    agg.observe(rows([heavy, heavy, uuid.uuid4()], 50), {sub_id: tenant_id})
+    assert await agg.persist() == 2  # merged into the existing rows
+
+    async with session_factory() as session:
+        [(_, hll, top)] = await load_sketches(session, "node", node_id, hour, hour.replace(hour=11))
+    assert hll.count() == 11
+    assert top.top(1)[0][:2] == (str(heavy), 300)
+
+
+@pytest.mark.asyncio
+async def test_http_ingest_feeds_the_same_sketches(session_factory):
+    node_id, tenant_id, user_id, other = uuid.uuid4(), uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    async with session_factory() as session:
+        session.add(Subscription(tenant_id=tenant_id, user_id=user_id, plan_id=uuid.uuid4(), active=True))
+        await session.commit()
+    events = [
+        schemas.TrafficEventIn(user_id=user_id, node_id=node_id, bytes_up=100, bytes_down=900),
+        schemas.TrafficEventIn(user_id=other, node_id=node_id, bytes_up=1, bytes_down=9),
+    ]
+    async with session_factory() as session:
+        await ingest_events(events, session=session, user=SimpleNamespace(id=uuid.uuid4()))
+
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    async with session_factory() as session:
+        [(_, hll, top)] = await load_sketches(session, "node", node_id, hour, hour.replace(minute=59))
+        [(_, tenant_hll, _)] = await load_sketches(session, "tenant", tenant_id, hour, hour.replace(minute=59))
+    assert hll.count() == 2 and tenant_hll.count() == 1
+    assert top.top(1)[0][:2] == (str(user_id), 1000)
+
+
+PERIOD_END = 1_700_000_060
+PERIOD_HOUR = datetime.fromtimestamp(PERIOD_END, timezone.utc).replace(minute=0, second=0)
+
+
+async def _top(session_factory, node_id):
+    async with session_factory() as session:
+        [(_, hll, top)] = await load_sketches(session, "node", node_id, PERIOD_HOUR, PERIOD_HOUR.replace(minute=59))
+    return hll.count(), top.top(2)
+
+
+@pytest.mark.asyncio
+async def test_http_redelivery_does_not_count_twice_in_the_sketches(session_factory, monkeypatch):
+    node_id, sub_a, sub_b = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    events = [
+        schemas.TrafficEventIn(node_id=node_id, subscription_id=sub_id, engine="xray", counter_seq=1,
+                               period_end_unix=PERIOD_END, bytes_up=n, bytes_down=n)
+        for sub_id, n in ((sub_a, 500), (sub_b, 50))
+    ]
+    counts = []
+    for _ in range(2):
+        # A fresh in-memory filter, as on another API replica: only the unique constraint catches the redelivery
+        monkeypatch.setattr(traffic, "recent_keys", RecentKeyFilter())
+        async with session_factory() as session:
+            await ingest_events(events, session=session, user=SimpleNamespace(id=uuid.uuid4()))
+        counts.append(await _top(session_factory, node_id))
+    assert counts[0] == counts[1] == (2, [(str(sub_a), 1000, 0), (str(sub_b), 100, 0)])
+
+
+@pytest.mark.asyncio
+async def test_collector_redelivery_does_not_count_twice_in_the_sketches(session_factory):
+    node_id, sub_a, sub_b = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    sketches = SketchAggregator(session_factory)
+    batch = [
+        ({"node_id": node_id, "subscription_id": sub_id, "engine": "xray", "counter_seq": 1,
+          "period_end_unix": PERIOD_END, "bytes_up": n, "bytes_down": n}, [])
+        for sub_id, n in ((sub_a, 500), (sub_b, 50))
+    ]
+    counts = []
+    for _ in range(2):
+        writer = TrafficWriter(session_factory, recent_keys=RecentKeyFilter(), sketches=sketches)  # e.g. after a restart
+        await writer.flush(batch)
+        await sketches.persist()
+        counts.append(await _top(session_factory, node_id))
+    assert counts[0] == counts[1] == (2, [(str(sub_a), 1000, 0), (str(sub_b), 100, 0)])
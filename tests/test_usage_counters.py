@@ -0,0 +1,105 @@
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.collector.ingest import TrafficWriter
+from packages.common.vpnpanel_common import usage as usage_module
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import (
+    Assignment, AuditLog, ConfigChange, EngineType, Node, Plan, Subscription, Tenant, TrafficEvent, User,
+)
+from packages.common.vpnpanel_common.usage import DIRTY_KEY, UsageCounters, pending_usage
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[m.__table__ for m in (Tenant, User, Node, Plan, Subscription, Assignment, ConfigChange, AuditLog, TrafficEvent)])
+    yield async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    await engine.dispose()
+
+
+async def _subscriptions(sf, n, quota_bytes):
+    tenant = Tenant(id=uuid.uuid4(), name="acme")
+    plan = Plan(id=uuid.uuid4(), tenant_id=tenant.id, name="capped", quota_bytes=quota_bytes)
+    ids = []
+    async with sf() as session:
+        session.add_all([tenant, plan])
+        for i in range(n):
+            user = User(id=uuid.uuid4(), email=f"u{i}@example.com", password_hash="x")
+            sub = Subscription(id=uuid.uuid4(), tenant_id=tenant.id, user_id=user.id, plan_id=plan.id)
+            session.add_all([user, sub])
+            ids.append(sub.id)
+        await session.commit()
+    return ids
+
+
+async def _count(sf, counters, usage):
+    async with sf() as session:
+        return await counters.charge_and_commit(session, usage, datetime.now(timezone.utc))
+
+
+async def _stored(sf):
+    async with sf() as session:
+        return {s.id: (s.consumed_bytes, s.active) for s in (await session.execute(select(Subscription))).scalars()}
+
+
+@pytest.mark.asyncio
+async def test_hot_counters_flush_into_consumed_bytes(session_factory):
+    redis = fakeredis.FakeAsyncRedis()
+    a, b = await _subscriptions(session_factory, 2, quota_bytes=1000)
+    counters = UsageCounters(session_factory, redis, flush_batch=1)
+
+    assert await _count(session_factory, counters, {(a, EngineType.xray): 300, (a, EngineType.wireguard): 200, (b, None): 100}) == {}
+    # Over quota counting the pending delta: deactivated now, not at the next flush
+    assert await _count(session_factory, counters, {(a, EngineType.xray): 600}) == {"quota": 1}
+    assert await pending_usage([a, b], redis) == {a: {"xray": 900, "wireguard": 200}, b: {"unknown": 100}}
+    assert await _stored(session_factory) == {a: (0, False), b: (0, True)}
+
+    assert await counters.flush() == 1200
+    assert await pending_usage([a, b], redis) == {}
+    assert await redis.scard(DIRTY_KEY) == 0
+    assert await _stored(session_factory) == {a: (1100, False), b: (100, True)}
+    async with session_factory() as session:
+        assert (await session.execute(select(AuditLog.action))).scalars().all() == ["subscription.quota"]
+
+
+class BrokenRedis:
+    def pipeline(self, transaction=True):
+        raise ConnectionError("redis down")
+
+
+@pytest.mark.asyncio
+async def test_increment_writes_through_when_redis_is_down(session_factory):
+    (a,) = await _subscriptions(session_factory, 1, quota_bytes=None)
+    await _count(session_factory, UsageCounters(session_factory, BrokenRedis()), {(a, EngineType.xray): 42})
+    assert await _stored(session_factory) == {a: (42, True)}
+    assert await pending_usage([a], BrokenRedis()) == {}
+
+
+@pytest.mark.asyncio
+async def test_batch_is_retried_whole_when_redis_and_the_fallback_both_fail(session_factory, monkeypatch):
+    (a,) = await _subscriptions(session_factory, 1, quota_bytes=None)
+    writer = TrafficWriter(session_factory, counters=UsageCounters(session_factory, BrokenRedis()))
+    batch = [({"node_id": uuid.uuid4(), "subscription_id": a, "engine": "xray", "counter_seq": 1,
+               "period_end_unix": 1_700_000_060, "bytes_up": 10, "bytes_down": 32}, [])]
+
+    async def db_down(*args, **kwargs):
+        raise ConnectionError("database down")
+
+    monkeypatch.setattr(usage_module, "charge_usage", db_down)
+    with pytest.raises(ConnectionError):
+        await writer.flush(batch)
+    async with session_factory() as session:
+        assert (await session.execute(select(TrafficEvent))).scalars().all() == []
+
+    monkeypatch.undo()
+    assert await writer.flush(batch) == 1  # the retry is not mistaken for a redelivery
+    assert await _stored(session_factory) == {a: (42, True)}
@@ -1,6 +1,19 @@
+import uuid
+from types import SimpleNamespace
+
 import pytest
+import pytest_asyncio
 from httpx import AsyncClient
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from apps.control_api.db import get_session
 from apps.control_api.main import app
+from apps.control_api.security import get_current_user, require_admin
+from packages.common.vpnpanel_common.db.base import Base
+from packages.common.vpnpanel_common.db.models import (
+    Assignment, AuditLog, ConfigChange, Credential, Node, Subscription, User, UserEngines,
+)
 
 ADMIN_EMAIL = "admin@example.com"
 ADMIN_PASS = "Secret123!"
@@ -51,3 +64,78 @@ async def test_user_engine_toggle_and_wireguard_qr():
         r = await client.get(f"/users/{user_id}/wireguard/qr", headers=headers)
         assert r.status_code == 200
         assert r.headers.get("content-type", "").startswith("image/svg+xml")
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[
+            m.__table__ for m in (User, UserEngines, Credential, Node, Assignment, Subscription, ConfigChange, AuditLog)
+        ])
+    sf = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def session():
+        async with sf() as s:
+            yield s
+
+    admin = SimpleNamespace(id=uuid.uuid4())
+    app.dependency_overrides.update({get_session: session, get_current_user: lambda: admin, require_admin: lambda: admin})
+    yield sf
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_configs_and_qr_etags(session_factory):
+    from apps.control_api.render_cache import render_cache
+
+    user_id, node_a, node_b = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    async with session_factory() as session:
+        session.add_all([User(id=user_id, email="etag-user@example.com", password_hash="x"),
+                         Node(id=node_a, name="etag-a"), Node(id=node_b, name="etag-b")])
+        await session.flush()
+        session.add(UserEngines(user_id=user_id, allow_xray=True, allow_wireguard=True))
+        await session.commit()
+    engine = session_factory.kw["bind"].sync_engine
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        r = await client.get(f"/users/{user_id}/configs")
+        assert r.status_code == 200 and set(r.json()) == {"xray", "wireguard"}
+        etag = r.headers["etag"]
+        assert etag.startswith('"') and r.headers["cache-control"] == "private, no-cache"
+
+        # unchanged inputs: same tag, and a 304 with no body, after one query, when the client has it
+        again = await client.get(f"/users/{user_id}/configs")
+        assert again.headers["etag"] == etag and again.content == r.content
+        statements.clear()
+        r = await client.get(f"/users/{user_id}/configs", headers={"If-None-Match": f'"other", W/{etag}'})
+        assert r.status_code == 304 and r.content == b"" and r.headers["etag"] == etag
+        assert len(statements) == 1
+
+        qr = await client.get(f"/users/{user_id}/wireguard/qr")
+        assert qr.status_code == 200 and qr.headers["etag"] != etag
+        r = await client.get(f"/users/{user_id}/wireguard/qr", headers={"If-None-Match": qr.headers["etag"]})
+        assert r.status_code == 304
+        assert (await client.get(f"/users/{uuid.uuid4()}/wireguard/qr")).status_code == 404
+
+        # an engine change drops the cached renders and yields a new tag
+        r = await client.post(f"/users/{user_id}/engines", json={"engines": ["xray"]})
+        assert r.status_code == 200
+        assert user_id not in render_cache._users
+        r = await client.get(f"/users/{user_id}/configs", headers={"If-None-Match": etag})
+        assert r.status_code == 200 and "wireguard" not in r.json() and r.headers["etag"] != etag
+        etag = r.headers["etag"]
+
+        # so do creating and moving an assignment
+        r = await client.post("/assignments/", json={"user_id": str(user_id), "node_id": str(node_a)})
+        assert r.status_code == 201, r.text
+        assignment_id = r.json()["id"]
+        r = await client.get(f"/users/{user_id}/configs", headers={"If-None-Match": etag})
+        assert r.status_code == 200 and r.headers["etag"] != etag
+        etag = r.headers["etag"]
+        r = await client.post(f"/assignments/{assignment_id}/move", json={"node_id": str(node_b)})
+        assert r.status_code == 200, r.text
+        r = await client.get(f"/users/{user_id}/configs", headers={"If-None-Match": etag})
+        assert r.status_code == 200 and r.headers["etag"] != etag